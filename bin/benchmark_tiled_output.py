@@ -0,0 +1,163 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""compare the encoding cost of striped, tiled and cloud optimized
+GeoTIFF outputs with the downstream cost of reading a region and a
+preview of them, for the given areas of the mpop areas file:
+./benchmark_tiled_output.py -a euro4 -a germ -n 3
+for synthetic areas of the given size:
+./benchmark_tiled_output.py -s 3712x3712 -s 1334x667
+"""
+
+import argparse
+import os
+import random
+import shutil
+import tempfile
+import time
+from datetime import datetime
+
+import numpy as np
+from mpop.imageo.geo_image import GeoImage
+from pyresample.geometry import AreaDefinition
+
+from dwd_extensions.tools.area_cache import get_area_def
+from dwd_extensions.trollduction.postprocessor import encode_image
+from dwd_extensions.trollduction.postprocessor import get_save_arguments
+
+VARIANTS = [
+    ('striped', {}),
+    ('tiled', {'tile_size': '256'}),
+    ('tiled_overviews', {'tile_size': '256', 'overviews': 'auto'}),
+    ('cog', {'cloud_optimized': 'true'}),
+    ('cog_predictor', {'cloud_optimized': 'true', 'predictor': '2'}),
+]
+
+
+def synthetic_area(shape):
+    '''Return an equidistant cylindrical AreaDefinition of *shape*
+    (WIDTHxHEIGHT) covering the globe
+    '''
+    width, height = [int(val) for val in shape.split('x')]
+    return AreaDefinition('synthetic_%s' % shape, 'synthetic', 'synthetic',
+                          {'proj': 'eqc', 'ellps': 'WGS84'}, width, height,
+                          (-20037508.34, -10018754.17,
+                           20037508.34, 10018754.17))
+
+
+def synthetic_image(area):
+    '''Return a single channel image with smooth structures and noise
+    (compresses similar to satellite imagery)
+    '''
+    rows, cols = np.mgrid[0:area.y_size, 0:area.x_size]
+    data = (np.sin(rows / 37.0) * np.cos(cols / 53.0) + 1) / 2.0
+    data = 0.8 * data + 0.2 * np.random.random(data.shape)
+    return GeoImage((np.ma.array(data),), area, datetime.utcnow(),
+                    mode='L', fill_value=(0,))
+
+
+def read_times(fname, window=256, num_windows=20, preview=512):
+    '''Return the mean seconds to read a *window* sized region and a
+    preview of at most *preview* pixels
+    '''
+    from osgeo import gdal
+
+    dst = gdal.Open(fname, gdal.GA_ReadOnly)
+    band = dst.GetRasterBand(1)
+    width, height = dst.RasterXSize, dst.RasterYSize
+    t_start = time.time()
+    for _ in range(num_windows):
+        xoff = random.randint(0, max(0, width - window))
+        yoff = random.randint(0, max(0, height - window))
+        band.ReadAsArray(xoff, yoff, min(window, width),
+                         min(window, height))
+    t_window = (time.time() - t_start) / num_windows
+
+    scale = max(1, max(width, height) / preview)
+    t_start = time.time()
+    # uses the overviews if available
+    band.ReadAsArray(0, 0, width, height, buf_xsize=width / scale,
+                     buf_ysize=height / scale)
+    t_preview = time.time() - t_start
+    overviews = band.GetOverviewCount()
+    dst = None
+    return t_window, t_preview, overviews
+
+
+def benchmark(area, out_dir, repetitions):
+    '''Encode an image of *area* with all variants, returns a list of
+    result dicts
+    '''
+    geo_img = synthetic_image(area)
+    results = []
+    for name, format_params in VARIANTS:
+        save_params = get_save_arguments({'format': 'tif',
+                                          'format_params': format_params})
+        fname = os.path.join(out_dir, '%s_%s.tif' % (area.area_id, name))
+        t_start = time.time()
+        for _ in range(repetitions):
+            encode_image(geo_img, fname, save_params)
+        t_encode = (time.time() - t_start) / repetitions
+        t_window, t_preview, overviews = read_times(fname)
+        results.append({'area': area.area_id, 'variant': name,
+                        'encode': t_encode, 'mbytes':
+                        os.path.getsize(fname) / float(2 ** 20),
+                        'overviews': overviews, 'window': t_window,
+                        'preview': t_preview})
+    return results
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-a", "--area", dest="areas", action="append",
+                        default=[],
+                        help="Area name of the mpop areas file "
+                        "(repeatable).")
+    parser.add_argument("-s", "--shape", dest="shapes", action="append",
+                        default=[],
+                        help="Size WIDTHxHEIGHT of a synthetic area "
+                        "(repeatable).")
+    parser.add_argument("-n", "--repetitions", dest="repetitions",
+                        type=int, default=1,
+                        help="Number of encodings per variant.")
+    parser.add_argument("-o", "--output_dir", dest="output_dir",
+                        type=str, default=None,
+                        help="Directory for the files (default: a "
+                        "temporary directory, removed afterwards).")
+    args = parser.parse_args()
+
+    areas = [get_area_def(name) for name in args.areas] + \
+        [synthetic_area(shape) for shape in args.shapes]
+    if not areas:
+        parser.error("no area given")
+
+    out_dir = args.output_dir or tempfile.mkdtemp()
+    try:
+        print '%-20s %-16s %9s %9s %4s %11s %11s' % (
+            'area', 'variant', 'encode s', 'MB', 'ovr', 'window ms',
+            'preview ms')
+        for area in areas:
+            for res in benchmark(area, out_dir, args.repetitions):
+                print '%-20s %-16s %9.3f %9.2f %4d %11.2f %11.2f' % (
+                    res['area'], res['variant'], res['encode'],
+                    res['mbytes'], res['overviews'], res['window'] * 1000,
+                    res['preview'] * 1000)
+        print "(read times with warm page cache, remote readers profit " \
+            "more from tiles and overviews)"
+    finally:
+        if args.output_dir is None:
+            shutil.rmtree(out_dir)
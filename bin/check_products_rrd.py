@@ -24,7 +24,6 @@
 written by trollduction postprocessor
 """
 
-from tempfile import mkstemp
 from optparse import OptionParser
 import stat
 import fnmatch
@@ -35,6 +34,8 @@ from os.path import splitext
 from datetime import datetime
 from datetime import timedelta
 from dwd_extensions.qm.sat_incidents.service import SatDataAvailabilityService
+from dwd_extensions.tools.publish import FSYNC_FILE
+from dwd_extensions.tools.publish import write_file
 from dwd_extensions.tools.rrd_utils import to_unix_seconds
 from dwd_extensions.tools.script_utils import listfiles
 
@@ -133,33 +134,25 @@ def write_result_and_exit(code, message, cache_file):
     writes message to stdout and exits with code
     """
     if cache_file is not None:
-        _, temp_file = mkstemp()
         try:
-            with open(temp_file, 'w') as f:
-                f.write(str(code) + '\n')
-                if code == STATUS_OK:
-                    f.write('OK - ')
-                elif code == STATUS_WARNING:
-                    f.write('WARNING - ')
-                elif code == STATUS_CRITICAL:
-                    f.write('CRITICAL - ')
-                elif code == STATUS_UNKNOWN:
-                    f.write('UNKNOWN - ')
-                f.write(message)
-                f.flush()
-                os.fsync(f.fileno())
-            if os.path.exists(cache_file):
-                os.remove(cache_file)
-            os.system('mv -f %s %s' % (temp_file, cache_file))
-            # used mv to allow cross-device links
-            # os.rename(temp_file, cache_file)
-            # add read permissions for everyone
-            os.chmod(cache_file,
-                     os.stat(cache_file).st_mode | stat.S_IRGRP | stat.S_IROTH)
+            if code == STATUS_OK:
+                prefix = 'OK - '
+            elif code == STATUS_WARNING:
+                prefix = 'WARNING - '
+            elif code == STATUS_CRITICAL:
+                prefix = 'CRITICAL - '
+            elif code == STATUS_UNKNOWN:
+                prefix = 'UNKNOWN - '
+            else:
+                prefix = ''
+            # staged in the directory of the cache file and renamed,
+            # readable for everyone
+            write_file(cache_file, str(code) + '\n' + prefix + message,
+                       fsync=FSYNC_FILE,
+                       mode=stat.S_IRUSR | stat.S_IWUSR |
+                       stat.S_IRGRP | stat.S_IROTH)
         except Exception as e:
             print e
-            if os.path.exists(temp_file):
-                os.remove(temp_file)
     print message
     exit(code)
 
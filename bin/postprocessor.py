@@ -34,6 +34,7 @@ import sys
 import os
 import time
 from dwd_extensions.trollduction.postprocessor import PostProcessor
+from dwd_extensions.trollduction.sharding import ShardedPostProcessor
 
 if __name__ == '__main__':
 
@@ -46,6 +47,17 @@ if __name__ == '__main__':
                         type=str,
                         default='',
                         help="The item in the file with configuration.")
+    parser.add_argument("--shards", dest="shards",
+                        type=int,
+                        default=None,
+                        help="Number of worker processes (default: "
+                        "postproc_shards of the config item or 1).")
+    parser.add_argument("--shard-by", dest="shard_by",
+                        choices=['area', 'product', 'uri'],
+                        default=None,
+                        help="Message attribute used to select the worker "
+                        "(default: postproc_shard_by of the config item "
+                        "or area).")
 
     args = parser.parse_args()
 
@@ -94,7 +106,12 @@ if __name__ == '__main__':
         print "Template file given as trollstalker product config, " \
             "aborting!"
 
-    pp = PostProcessor(cfg)
+    shards = args.shards or int(cfg.get("postproc_shards", 1))
+    shard_by = args.shard_by or cfg.get("postproc_shard_by", "area")
+    if shards > 1:
+        pp = ShardedPostProcessor(cfg, shards, route_by=shard_by)
+    else:
+        pp = PostProcessor(cfg)
 
     def shutdown(*args):
         print "starting shutdown procedure"
@@ -0,0 +1,147 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""replay recorded (or generated) messages through the postprocessor
+without posttroll and report throughput and stage latencies.
+./replay_postprocessor.py -c /path/to/master_config.ini -C noaa_hrpt \
+    -m messages.txt
+./replay_postprocessor.py -c /path/to/master_config.ini -C noaa_hrpt \
+    -i /data/in -p "{product_name}_{area_name}_{time:%Y%m%d%H%M}.tif"
+only plan the outputs (no I/O), e.g. to compare configurations:
+./replay_postprocessor.py -c /path/to/master_config.ini -C noaa_hrpt \
+    -m messages.txt --plan -j actions.jsonl
+"""
+
+import argparse
+import json
+import logging
+from ConfigParser import ConfigParser
+import os
+import sys
+import time
+
+import trollduction.helper_functions as helper_functions
+
+from dwd_extensions.trollduction.replay import ReplayPostProcessor
+from dwd_extensions.trollduction.replay import ReplayShardedPostProcessor
+from dwd_extensions.trollduction.replay import format_action
+from dwd_extensions.trollduction.replay import format_report
+from dwd_extensions.trollduction.replay import generate_messages
+from dwd_extensions.trollduction.replay import load_messages
+from dwd_extensions.trollduction.replay import plan
+from dwd_extensions.trollduction.replay import replay
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-c", "--config_file", dest="config_file",
+                        type=str, required=True,
+                        help="The file containing configuration parameters.")
+    parser.add_argument("-C", "--config_item", dest="config_item",
+                        type=str, required=True,
+                        help="The item in the file with configuration.")
+    parser.add_argument("-m", "--messages", dest="messages",
+                        type=str, default=None,
+                        help="File with recorded messages "
+                        "(one encoded posttroll message per line).")
+    parser.add_argument("-i", "--input_dir", dest="input_dir",
+                        type=str, default=None,
+                        help="Directory with images to generate "
+                        "messages for.")
+    parser.add_argument("-p", "--pattern", dest="pattern",
+                        type=str,
+                        default="{product_name}_{area_name}_"
+                        "{time:%Y%m%d%H%M}.tif",
+                        help="Pattern of the images in the input directory.")
+    parser.add_argument("-a", "--area", dest="area",
+                        type=str, default=None,
+                        help="Area name if not part of the pattern.")
+    parser.add_argument("-s", "--speed", dest="speed",
+                        type=float, default=0,
+                        help="Replay speed relative to the message times "
+                        "(1 = real time, default: 0 = maximum speed).")
+    parser.add_argument("--shards", dest="shards",
+                        type=int, default=1,
+                        help="Number of worker processes.")
+    parser.add_argument("--shard-by", dest="shard_by",
+                        choices=['area', 'product', 'uri'], default='area',
+                        help="Message attribute used to select the worker.")
+    parser.add_argument("--plan", dest="plan",
+                        action='store_true',
+                        help="Only plan the outputs without reading or "
+                        "writing images.")
+    parser.add_argument("-j", "--json", dest="json",
+                        type=str, default=None,
+                        help="Write the report as JSON to this file "
+                        "(with --plan: the planned actions as JSON lines).")
+    parser.add_argument("-v", "--verbose", dest="verbose",
+                        action='store_true',
+                        help="Log postprocessor messages.")
+
+    args = parser.parse_args()
+
+    if (args.messages is None) == (args.input_dir is None):
+        print "Either recorded messages (-m) or an input directory (-i) " \
+            "required!"
+        sys.exit(1)
+
+    logging.basicConfig(level=logging.INFO if args.verbose
+                        else logging.WARNING)
+
+    config = ConfigParser()
+    config.read(args.config_file)
+    cfg = dict(config.items(args.config_item))
+    cfg["config_item"] = args.config_item
+    cfg["config_file"] = args.config_file
+    os.environ["TZ"] = cfg.get("timezone", "UTC")
+    time.tzset()
+
+    if args.messages is not None:
+        messages = load_messages(args.messages)
+    else:
+        messages = generate_messages(args.input_dir, args.pattern,
+                                     area=args.area)
+
+    if args.plan:
+        print "Planning %d messages" % len(messages)
+        product_config = helper_functions.read_config_file(
+            cfg['product_config_file'], args.config_item)
+        plans, report = plan(product_config, messages)
+        print "%d outputs, %d messages to decode" % (report['outputs'],
+                                                    report['decodes'])
+        print format_report(report)
+        if args.json is not None:
+            with open(args.json, 'w') as fid:
+                for msg, actions in plans:
+                    for action in actions:
+                        fid.write(json.dumps(format_action(msg, action),
+                                             sort_keys=True,
+                                             default=str) + '\n')
+        sys.exit(0)
+
+    print "Replaying %d messages" % len(messages)
+
+    if args.shards > 1:
+        pp = ReplayShardedPostProcessor(cfg, args.shards,
+                                        route_by=args.shard_by)
+    else:
+        pp = ReplayPostProcessor(cfg)
+
+    report = replay(pp, messages, args.speed)
+    print format_report(report)
+    if args.json is not None:
+        with open(args.json, 'w') as fid:
+            json.dump(report, fid, indent=2, sort_keys=True, default=str)
@@ -21,7 +21,7 @@ import numpy as np
 import logging
 
 from pycoast import ContourWriterAGG  # @UnresolvedImport
-from mpop.projector import get_area_def  # @UnresolvedImport
+from dwd_extensions.tools.area_cache import get_area_def
 from ConfigParser import NoSectionError, NoOptionError
 
 LOGGER = logging.getLogger(__name__)
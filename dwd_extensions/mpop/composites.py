@@ -3,13 +3,18 @@ Created on 05.01.2015
 
 @author: Christian Kliche <chk@ebp.de>
 '''
+import ConfigParser
 import numpy as np
 import logging
 import copy
+import os
 
 import mpop.imageo.geo_image as geo_image  # @UnresolvedImport
+from mpop import CONFIG_PATH  # @UnresolvedImport
 from mpop.channel import Channel, NotLoadedError  # @UnresolvedImport
 
+from dwd_extensions.mpop.quantized_image import QuantizedImage
+
 try:
     from pyorbital.astronomy import sun_zenith_angle as sza
 except ImportError:
@@ -35,9 +40,28 @@ SUN_ZEN_NIGHT_LIMIT = 87
 IMAGETYPES = Enum(('DAY_ONLY', 'NIGHT_ONLY', 'DAY_NIGHT'))
 
 
+def quantized_images_setting(fname=None):
+    """Return the option quantized_images of the section [composites] of
+    the mpop config file *fname* (default mpop.cfg), False if not set.
+    """
+    if fname is None:
+        fname = os.path.join(CONFIG_PATH, "mpop.cfg")
+    conf = ConfigParser.ConfigParser()
+    conf.read(fname)
+    try:
+        return conf.getboolean('composites', 'quantized_images')
+    except (ConfigParser.Error, ValueError):
+        return False
+
+# return images with 8 bit channels (QuantizedImage) if the image is not
+# blended or stretched afterwards (quantized_images in mpop.cfg)
+QUANTIZED_IMAGES = quantized_images_setting()
+
+
 def _dwd_create_single_channel_image(self, chn,
                                      sun_zenith_angle_correction=True,
-                                     backup_orig_data=False):
+                                     backup_orig_data=False,
+                                     quantized=None):
     """Creates a calibrated and corrected single channel black/white image.
     Data calibration:
     HRV, VIS channels: albedo 0 - 125 %
@@ -45,6 +69,7 @@ def _dwd_create_single_channel_image(self, chn,
     Data correction:
     HRV, VIS channels: sun zenith angle correction
     IR channels: atmospheric correction (not implemented yet)
+    A QuantizedImage is returned if *quantized* (default QUANTIZED_IMAGES).
     """
     if not isinstance(chn, basestring):
         return None
@@ -57,20 +82,24 @@ def _dwd_create_single_channel_image(self, chn,
                                          backup_orig_data=backup_orig_data):
         return None
 
+    if quantized is None:
+        quantized = QUANTIZED_IMAGES
+    image_class = QuantizedImage if quantized else geo_image.GeoImage
+
     if self._is_solar_channel(chn):
-        return geo_image.GeoImage(self[chn].data,
-                                  self.area,
-                                  get_first(self.time_slot),
-                                  fill_value=0,
-                                  mode="L",
-                                  crange=(0, 125))
-
-    return geo_image.GeoImage(self[chn].data,
-                              self.area,
-                              get_first(self.time_slot),
-                              fill_value=0,
-                              mode="L",
-                              crange=(40, -87.5))
+        return image_class(self[chn].data,
+                           self.area,
+                           get_first(self.time_slot),
+                           fill_value=0,
+                           mode="L",
+                           crange=(0, 125))
+
+    return image_class(self[chn].data,
+                       self.area,
+                       get_first(self.time_slot),
+                       fill_value=0,
+                       mode="L",
+                       crange=(40, -87.5))
 
 
 def _dwd_apply_sun_zenith_angle_correction(self, chn, backup_orig_data=False):
@@ -279,8 +308,11 @@ def _dwd_get_image_type(self):
     return self._data_holder.info["image_type"]
 
 
-def _dwd_create_RGB_image(self, channels, cranges):
-    """Returns an RGB image of the given channel data and color ranges.
+def _dwd_create_RGB_image(self, channels, cranges, gamma=1.0,
+                          quantized=None):
+    """Returns an RGB image of the given channel data and color ranges,
+    gamma corrected with *gamma*. A QuantizedImage is returned if
+    *quantized* (default QUANTIZED_IMAGES).
     """
     if not isinstance(channels, (list, tuple, set)) and \
             not isinstance(cranges, (tuple, list, set)) and \
@@ -290,19 +322,34 @@ def _dwd_create_RGB_image(self, channels, cranges):
             and they must have the same length of 3 or 4 elements")
 
     if len(channels) == 3:
-        return geo_image.GeoImage(channels,
-                                  self.area,
-                                  get_first(self.time_slot),
-                                  fill_value=(0, 0, 0),
-                                  mode="RGB",
-                                  crange=cranges)
-    if len(channels) == 4:
-        return geo_image.GeoImage(channels,
-                                  self.area,
-                                  get_first(self.time_slot),
-                                  fill_value=(0, 0, 0, 0),
-                                  mode="RGBA",
-                                  crange=cranges)
+        mode = "RGB"
+        fill_value = (0, 0, 0)
+    elif len(channels) == 4:
+        mode = "RGBA"
+        fill_value = (0, 0, 0, 0)
+    else:
+        return None
+
+    if quantized is None:
+        quantized = QUANTIZED_IMAGES
+    if quantized:
+        return QuantizedImage(channels,
+                              self.area,
+                              get_first(self.time_slot),
+                              fill_value=fill_value,
+                              mode=mode,
+                              crange=cranges,
+                              gamma=gamma)
+
+    img = geo_image.GeoImage(channels,
+                             self.area,
+                             get_first(self.time_slot),
+                             fill_value=fill_value,
+                             mode=mode,
+                             crange=cranges)
+    if gamma != 1.0:
+        img.enhance(gamma=gamma)
+    return img
 
 
 def dwd_airmass(self, backup_orig_data=False):
@@ -361,8 +408,8 @@ def dwd_schwere_konvektion_tag(self, backup_orig_data=False):
     img = self._dwd_create_RGB_image((ch1, ch2, ch3),
                                      ((-35, 5),
                                       (-5, 60),
-                                      (-75, 25)))
-    img.enhance(gamma=(1.0, 0.5, 1.0))
+                                      (-75, 25)),
+                                     gamma=(1.0, 0.5, 1.0))
 
     return img
 
@@ -395,8 +442,8 @@ def dwd_dust(self, backup_orig_data=False):
     img = self._dwd_create_RGB_image((ch1, ch2, ch3),
                                      ((-4, 2),
                                       (0, 15),
-                                      (261 - CONVERSION, 289 - CONVERSION)))
-    img.enhance(gamma=(1.0, 2.5, 1.0))
+                                      (261 - CONVERSION, 289 - CONVERSION)),
+                                     gamma=(1.0, 2.5, 1.0))
 
     return img
 
@@ -434,8 +481,8 @@ def dwd_RGB_12_12_1_N(self, backup_orig_data=False):
             (hrvc_chn.data, hrvc_chn.data, self[0.635].data),
             ((0, 100),
              (0, 100),
-             (0, 100)))
-        img.enhance(gamma=(1.3, 1.3, 1.3))
+             (0, 100)),
+            gamma=(1.3, 1.3, 1.3))
         merge_masks(img)
         return img
 
@@ -455,7 +502,8 @@ def dwd_RGB_12_12_1_N(self, backup_orig_data=False):
             ((0, 100),
              (0, 100),
              (0, 100),
-             (0, 255)))
+             (0, 255)),
+            quantized=False)
         day_img.enhance(
             inverse=(False, False, False, True), gamma=(1.3, 1.3, 1.3, 1.0))
         # create night image
@@ -464,7 +512,8 @@ def dwd_RGB_12_12_1_N(self, backup_orig_data=False):
             ((40, -87.5),
              (40, -87.5),
              (40, -87.5),
-             (0, 255)))
+             (0, 255)),
+            quantized=False)
         # blend day over night
         night_img.blend(day_img)
         # remove alpha channels
@@ -527,7 +576,8 @@ def dwd_RGB_12_12_9i_N(self, backup_orig_data=False):
             (self[3.75].data, self[10.8].data, self[12.0].data),
             ((40, -87.5),
              (40, -87.5),
-             (40, -87.5)))
+             (40, -87.5)),
+            quantized=False)
         img.enhance(stretch="histogram")
         return img
 
@@ -539,7 +589,8 @@ def dwd_RGB_12_12_9i_N(self, backup_orig_data=False):
             ((0, 100),
              (0, 100),
              (323 - CONVERSION, 203 - CONVERSION),
-             (0, 255)))
+             (0, 255)),
+            quantized=False)
         day_img.enhance(inverse=(False, False, False, True))
         # create night image
         night_img = self._dwd_create_RGB_image(
@@ -547,7 +598,8 @@ def dwd_RGB_12_12_9i_N(self, backup_orig_data=False):
             ((40, -87.5),
              (40, -87.5),
              (40, -87.5),
-             (0, 255)))
+             (0, 255)),
+            quantized=False)
         night_img.enhance(stretch="histogram")
         # blend day over night
         night_img.blend(day_img)
@@ -694,7 +746,8 @@ def _dwd_create_day_night_image(self,
         day_img = self._dwd_create_single_channel_image(
             day_chn_name,
             sun_zenith_angle_correction,
-            backup_orig_data=backup_orig_data)
+            backup_orig_data=backup_orig_data,
+            quantized=False)
         # day_img.channels[0].mask[alpha_data==1.0] = 0.0
         day_img.putalpha(alpha_data)
         day_img.enhance(inverse=(False, True))
@@ -703,7 +756,8 @@ def _dwd_create_day_night_image(self,
         night_img = self._dwd_create_single_channel_image(
             night_chn_name,
             sun_zenith_angle_correction,
-            backup_orig_data=backup_orig_data)
+            backup_orig_data=backup_orig_data,
+            quantized=False)
         night_img.putalpha(alpha_data)
 
         # blending does not work correctly when pixels are masked in only
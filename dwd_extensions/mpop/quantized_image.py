@@ -0,0 +1,248 @@
+# -*- coding: utf-8 -*-
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+'''8 bit quantized GeoImage
+
+A GeoImage keeps float64 channels scaled to [0, 1] until it is saved,
+although most products are written with 8 bits. The QuantizedImage
+holds uint8 channels (and their masks) instead, the color range is
+applied block by block and the inversion and gamma correction through a
+lookup table, so the float data is never held for the whole image.
+Saving converts the channels without a float round trip.
+
+The postprocessor reads 8 bit source images as QuantizedImage with the
+post_processing setting quantized_images (default false), 16 bit outputs
+of such images have 8 bit precision only. The composites of the
+l2processor are quantized with quantized_images in section [composites]
+of mpop.cfg.
+'''
+
+import logging
+
+import numpy as np
+
+from mpop.imageo.geo_image import GeoImage
+
+LOGGER = logging.getLogger("postprocessor")
+
+QUANTIZED_MODES = ("L", "LA", "RGB", "RGBA")
+# maximum of the quantized values
+QMAX = np.iinfo(np.uint8).max
+# entries of the lookup table for the enhancement of float data
+LUT_SIZE = 65536
+# rows converted at once
+BLOCK_ROWS = 256
+
+
+def enhancement_lut(inverse=False, gamma=1.0, size=LUT_SIZE,
+                    dtype=np.uint8):
+    '''Return the lookup table of *size* entries mapping the normalized
+    values (index / (size - 1)) to *dtype* values, inverted and gamma
+    corrected like Image.enhance does.
+    '''
+    levels = np.linspace(0.0, 1.0, size)
+    if inverse:
+        levels = 1.0 - levels
+    if gamma != 1.0:
+        levels = levels ** (1.0 / gamma)
+    return (levels.clip(0, 1) * np.iinfo(dtype).max).astype(dtype)
+
+
+def quantize(data, crange=None, inverse=False, gamma=1.0,
+             rows=BLOCK_ROWS):
+    '''Return the (masked) array *data* as uint8 masked array: the color
+    range *crange* is mapped to [0, 255], then *inverse* and *gamma* are
+    applied like Image.enhance does.
+    '''
+    color_min, color_max = crange if crange is not None else (0.0, 1.0)
+    lut = None
+    if gamma != 1.0:
+        lut = enhancement_lut(gamma=gamma)
+    src = np.ma.getdata(data)
+    result = np.empty(src.shape, np.uint8)
+    for start in xrange(0, src.shape[0], rows):
+        block = ((src[start:start + rows] - color_min) * 1.0 /
+                 (color_max - color_min)).clip(0, 1)
+        if inverse:
+            block = 1.0 - block
+        if lut is None:
+            result[start:start + rows] = block * QMAX
+        else:
+            result[start:start + rows] = lut[
+                (block * (LUT_SIZE - 1) + 0.5).astype(np.intp)]
+    return np.ma.array(result, mask=np.ma.getmaskarray(data))
+
+
+def _per_channel(value, count, name):
+    if isinstance(value, (tuple, list)):
+        if len(value) != count:
+            raise ValueError("Number of channels and %s components differ."
+                             % name)
+        return list(value)
+    return [value] * count
+
+
+class QuantizedImage(GeoImage):
+
+    """GeoImage with 8 bit channels (uint8 masked arrays) for the modes
+    L, LA, RGB and RGBA. Float *channels* are scaled with *crange*
+    (a pair or one pair per channel) and enhanced with *inverse* and
+    *gamma* (see Image.enhance) while quantizing, uint8 channels are
+    taken as they are. Further enhancements work on the 8 bit values,
+    operations requiring float channels need to_geo_image().
+    """
+
+    def __init__(self, channels, area, time_slot, mode="L", crange=None,
+                 fill_value=None, inverse=False, gamma=1.0):
+        if mode not in QUANTIZED_MODES:
+            raise ValueError("Mode %s can not be quantized" % mode)
+        GeoImage.__init__(self, None, area, time_slot, mode=mode,
+                          fill_value=fill_value)
+        if not isinstance(channels, (tuple, list)):
+            channels = [channels]
+        if len(channels) != len(mode):
+            raise ValueError("Number of channels does not match mode.")
+        if crange is None or not isinstance(crange[0], (tuple, list)):
+            crange = [crange] * len(channels)
+        inverse = _per_channel(inverse, len(channels), 'inverse')
+        gamma = _per_channel(gamma, len(channels), 'gamma')
+
+        self.channels = []
+        for chn, chn_range, chn_inverse, chn_gamma in zip(channels, crange,
+                                                          inverse, gamma):
+            if np.ma.getdata(chn).dtype == np.uint8:
+                chn = np.ma.array(chn, mask=np.ma.getmaskarray(chn))
+                if chn_inverse or chn_gamma != 1.0:
+                    lut = enhancement_lut(chn_inverse, chn_gamma, QMAX + 1)
+                    chn = np.ma.array(lut[chn.data], mask=chn.mask)
+            else:
+                chn = quantize(chn, chn_range, chn_inverse, chn_gamma)
+            if self.channels and chn.shape != self.channels[0].shape:
+                raise ValueError("Channels must have the same shape.")
+            self.channels.append(chn)
+        self.shape = self.channels[0].shape
+        self.height, self.width = self.shape
+
+    def enhance(self, inverse=False, gamma=1.0, stretch="no"):
+        '''Invert and gamma correct the 8 bit values through a lookup
+        table. Stretching needs float channels (see to_geo_image).
+        '''
+        if stretch != "no":
+            raise ValueError("Stretching of quantized images is not "
+                             "supported")
+        count = len(self.channels)
+        for idx, (chn_inverse, chn_gamma) in enumerate(
+                zip(_per_channel(inverse, count, 'inverse'),
+                    _per_channel(gamma, count, 'gamma'))):
+            if chn_inverse or chn_gamma != 1.0:
+                lut = enhancement_lut(chn_inverse, chn_gamma, QMAX + 1)
+                chn = self.channels[idx]
+                self.channels[idx] = np.ma.array(lut[chn.data],
+                                                 mask=chn.mask)
+
+    def _finalize(self, dtype=np.uint8):
+        '''Return copies of the channels in *dtype* (8 or 16 bit) and the
+        fill value, like Image._finalize does for float channels.
+        '''
+        maxval = np.iinfo(dtype).max
+        factor = maxval // QMAX
+        channels = []
+        for chn in self.channels:
+            data = chn.data.astype(dtype)
+            if factor != 1:
+                data *= factor
+            channels.append(np.ma.array(data, mask=chn.mask.copy()))
+        if self.fill_value is not None:
+            fill_value = [int(col * maxval) for col in self.fill_value]
+        else:
+            fill_value = None
+        return channels, fill_value
+
+    def to_geo_image(self):
+        '''Return the image as GeoImage with float channels
+        '''
+        img = GeoImage([np.ma.array(chn.data / float(QMAX), mask=chn.mask)
+                        for chn in self.channels], self.area, self.time_slot,
+                       mode=self.mode, fill_value=self.fill_value)
+        img.tags.update(self.tags)
+        img.gdal_options.update(self.gdal_options)
+        return img
+
+    def save(self, filename, *args, **kwargs):
+        '''Save the image like GeoImage.save, single channel ninjotiff
+        images are written by save() of this module.
+        '''
+        fformat = kwargs.get('fformat')
+        if fformat and 'ninjotiff' in fformat and self.mode == 'L':
+            kwargs['fformat'] = __name__
+        return GeoImage.save(self, filename, *args, **kwargs)
+
+
+def ninjotiff_data(geo_img, dtype, value_range):
+    '''Return the data of the single channel *geo_img* (QuantizedImage)
+    as ninjotiff._finalize computes it for the physical *value_range*
+    of data scaled to [0, 1]: the minimum is kept for transparent pixels.
+    Returns the data, the scale, the offset and the fill value.
+    '''
+    maxval = np.iinfo(dtype).max
+    chn = geo_img.channels[0]
+    fill_value = 0
+    if geo_img.fill_value is not None:
+        fill_value = int(geo_img.fill_value[0] * maxval)
+    if chn.mask.all():
+        return np.zeros(chn.shape, dtype), 1, 0, fill_value
+    levels = np.arange(QMAX + 1) / float(QMAX)
+    lut = ((levels * (maxval / (maxval + 1.0)) +
+            1 / (maxval + 1.0)).clip(0, 1) * maxval).astype(dtype)
+    data = lut[chn.data]
+    data[chn.mask] = fill_value
+    scale = (value_range[1] - value_range[0]) / maxval or 1
+    return data, scale, value_range[0] - scale, fill_value
+
+
+def save(geo_img, filename, ninjo_product_name=None, writer_options=None,
+         **kwargs):
+    '''Write the single channel QuantizedImage *geo_img* as ninjotiff
+    (entry point of GeoImage.save for this module as format, see
+    mpop.imageo.formats.ninjotiff.save for the arguments). Without the
+    physical value range of scaled data the image is converted to float
+    for the automatic scaling of ninjotiff.
+    '''
+    from mpop.imageo.formats import ninjotiff
+
+    if writer_options:
+        kwargs.update(writer_options)
+        ninjo_product_name = writer_options.get('ninjo_product_name',
+                                                ninjo_product_name)
+    try:
+        value_range = (float(kwargs["ch_min_measurement_unit"]),
+                       float(kwargs["ch_max_measurement_unit"]))
+    except KeyError:
+        value_range = None
+    if value_range is None or \
+            not bool(kwargs.get("data_is_scaled_01", True)):
+        LOGGER.debug("Converting %s to float for ninjotiff", filename)
+        return ninjotiff.save(geo_img.to_geo_image(), filename,
+                              ninjo_product_name, **kwargs)
+
+    dtype = np.uint16 if int(kwargs.get('nbits', 8)) == 16 else np.uint8
+    data, scale, offset, fill_value = ninjotiff_data(geo_img, dtype,
+                                                     value_range)
+    kwargs['gradient'] = scale
+    kwargs['axis_intercept'] = offset
+    kwargs['transparent_pix'] = fill_value
+    kwargs['image_dt'] = geo_img.time_slot
+    kwargs['is_calibrated'] = True
+    ninjotiff.write(data, filename, geo_img.area, ninjo_product_name,
+                    **kwargs)
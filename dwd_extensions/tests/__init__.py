@@ -6,13 +6,50 @@ Created on 12.05.2016
 '''
 import unittest
 import doctest
-from dwd_extensions.tests import (test_dataset_processors)
+from dwd_extensions.tests import (test_area_cache,
+                                   test_dataset_processors,
+                                   test_data_writer,
+                                   test_downsample,
+                                   test_event_loop,
+                                   test_image_io,
+                                   test_instrumentation,
+                                   test_output_index,
+                                   test_product_config,
+                                   test_publish,
+                                   test_quantized_image,
+                                   test_rrd_sink,
+                                   test_rule_index,
+                                   test_scheduler,
+                                   test_strip_writer,
+                                   test_template_cache)
 
 
 def suite():
     """The global test suite.
     """
+    # the postprocessor tests need trollduction
+    from dwd_extensions.tests import (test_postprocessor, test_replay,
+                                      test_sharding)
+
     mysuite = unittest.TestSuite()
+    mysuite.addTests(test_area_cache.suite())
     mysuite.addTests(test_dataset_processors.suite())
+    mysuite.addTests(test_data_writer.suite())
+    mysuite.addTests(test_downsample.suite())
+    mysuite.addTests(test_event_loop.suite())
+    mysuite.addTests(test_image_io.suite())
+    mysuite.addTests(test_instrumentation.suite())
+    mysuite.addTests(test_output_index.suite())
+    mysuite.addTests(test_postprocessor.suite())
+    mysuite.addTests(test_product_config.suite())
+    mysuite.addTests(test_publish.suite())
+    mysuite.addTests(test_quantized_image.suite())
+    mysuite.addTests(test_replay.suite())
+    mysuite.addTests(test_rrd_sink.suite())
+    mysuite.addTests(test_rule_index.suite())
+    mysuite.addTests(test_scheduler.suite())
+    mysuite.addTests(test_sharding.suite())
+    mysuite.addTests(test_strip_writer.suite())
+    mysuite.addTests(test_template_cache.suite())
 
     return mysuite
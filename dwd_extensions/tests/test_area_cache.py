@@ -0,0 +1,101 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Unit testing for the cache of area definitions
+"""
+
+import os
+import shutil
+import tempfile
+import unittest
+from mock import patch
+
+from dwd_extensions.tools.area_cache import AreaCache
+
+AREAS_FILE = os.path.join(os.path.dirname(__file__), 'data', 'testareas.def')
+
+
+class TestAreaCache(unittest.TestCase):
+    """Unit testing for AreaCache
+    """
+
+    def setUp(self):
+        """Setting up the testing
+        """
+        self.tmp_dir = tempfile.mkdtemp()
+        self.areas_file = os.path.join(self.tmp_dir, 'areas.def')
+        shutil.copy(AREAS_FILE, self.areas_file)
+        patcher = patch('mpop.projector.get_area_file',
+                        return_value=self.areas_file)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.cache = AreaCache()
+
+    def tearDown(self):
+        """Cleaning up
+        """
+        shutil.rmtree(self.tmp_dir)
+
+    def test_area_def(self):
+        """Test that areas are parsed only once per areas file version"""
+        area = self.cache.get_area_def('testwcm')
+        self.assertEqual(area.area_id, 'testwcm')
+        self.assertTrue(self.cache.get_area_def('testwcm') is area)
+        self.assertEqual(self.cache.stats()['area_loads'], 1)
+
+        mtime = os.path.getmtime(self.areas_file)
+        os.utime(self.areas_file, (mtime + 10, mtime + 10))
+        self.assertFalse(self.cache.get_area_def('testwcm') is area)
+        self.assertEqual(self.cache.stats()['area_loads'], 2)
+
+    def test_lonlats(self):
+        """Test that the lons/lats are computed once and read-only"""
+        lons, lats = self.cache.get_lonlats('testwcm')
+        self.assertEqual(lons.shape, (667, 1334))
+        self.assertFalse(lons.flags.writeable)
+        self.assertRaises(ValueError, lats.__setitem__, (0, 0), 1.0)
+        again = self.cache.get_lonlats(self.cache.get_area_def('testwcm'))
+        self.assertTrue(again[0] is lons)
+        stats = self.cache.stats()
+        self.assertEqual(stats['lonlats_computed'], 1)
+        self.assertEqual(stats['lonlats_hits'], 1)
+        self.assertAlmostEqual(stats['lonlats_mbytes'],
+                               2 * lons.nbytes / float(2 ** 20))
+
+    def test_byte_budget(self):
+        """Test that the lons/lats are evicted beyond the byte budget"""
+        lons, _ = self.cache.get_lonlats('testwcm')
+        self.cache.configure(lons.nbytes)
+        stats = self.cache.stats()
+        self.assertEqual(stats['lonlats'], 0)
+        self.assertEqual(stats['lonlats_evicted'], 1)
+        # too large for the budget: not cached at all
+        self.cache.get_lonlats('testwcm')
+        self.assertEqual(self.cache.stats()['lonlats'], 0)
+        self.assertEqual(self.cache.stats()['lonlats_computed'], 2)
+
+
+def suite():
+    """The suite for test_area_cache
+    """
+    loader = unittest.TestLoader()
+    mysuite = unittest.TestSuite()
+    mysuite.addTest(loader.loadTestsFromTestCase(TestAreaCache))
+
+    return mysuite
+
+if __name__ == "__main__":
+    unittest.TextTestRunner(verbosity=2).run(suite())
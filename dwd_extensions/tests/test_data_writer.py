@@ -0,0 +1,455 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Unit testing for the postprocessor data writer pool
+"""
+
+import multiprocessing
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+
+from dwd_extensions.tools.instrumentation import get_instrumentation
+from dwd_extensions.tools.rrd_utils import configure_rrd_sink
+from dwd_extensions.trollduction.data_writer import DEFAULT_LANE
+from dwd_extensions.trollduction.data_writer import DataWriter
+from dwd_extensions.trollduction.data_writer import InFlightLimiter
+from dwd_extensions.trollduction.data_writer import MemoryBudget
+from dwd_extensions.trollduction.data_writer import MessageTracker
+from dwd_extensions.trollduction.data_writer import lane_config
+from dwd_extensions.trollduction.data_writer import mount_point
+
+INSTRUMENTATION = get_instrumentation()
+
+
+def _worker_job(fname):
+    '''Job recording a measurement and an rrd update, writes the pid of
+    its process to *fname*
+    '''
+    INSTRUMENTATION.record('worker_job', 0.5)
+    configure_rrd_sink().submit('test.rrd', 'steps', 0, 1.0, 2.0)
+    with open(fname, 'w') as fid:
+        fid.write(str(os.getpid()))
+
+
+class TestDataWriter(unittest.TestCase):
+    """Unit testing for DataWriter
+    """
+
+    def setUp(self):
+        """Setting up the testing
+        """
+        self.lock = threading.Lock()
+        self.events = []
+        self.active = {}
+        self.max_active = {}
+
+    def _job(self, out_box, name, duration=0.02):
+        with self.lock:
+            self.active[out_box] = self.active.get(out_box, 0) + 1
+            self.max_active[out_box] = max(self.max_active.get(out_box, 0),
+                                           self.active[out_box])
+        time.sleep(duration)
+        with self.lock:
+            self.active[out_box] -= 1
+            self.events.append(name)
+
+    def test_parallel_writes(self):
+        """Test that independent jobs run concurrently"""
+        writer = DataWriter(num_threads=4)
+        writer.start()
+        for idx in range(4):
+            writer.write_to('box', 'file%d' % idx, self._job, 'box', idx,
+                            0.1)
+        writer.join()
+        writer.stop()
+        self.assertEqual(len(self.events), 4)
+        self.assertEqual(self.max_active['box'], 4)
+
+    def test_out_box_limit(self):
+        """Test the per out_box concurrency limit"""
+        writer = DataWriter(num_threads=4, out_box_limits={'slow': 1})
+        writer.start()
+        for idx in range(3):
+            writer.write_to('slow', 'slow%d' % idx, self._job, 'slow', idx)
+            writer.write_to('fast', 'fast%d' % idx, self._job, 'fast', idx)
+        writer.join()
+        writer.stop()
+        self.assertEqual(len(self.events), 6)
+        self.assertEqual(self.max_active['slow'], 1)
+        self.assertTrue(self.max_active['fast'] > 1)
+
+    def test_order_per_destination(self):
+        """Test that jobs for the same file keep their order"""
+        writer = DataWriter(num_threads=4)
+        writer.start()
+        for idx in range(5):
+            writer.write_to('box', 'same_file', self._job, 'box', idx,
+                            0.01 * (5 - idx))
+        writer.join()
+        writer.stop()
+        self.assertEqual(self.events, range(5))
+        self.assertEqual(self.max_active['box'], 1)
+
+    def test_failing_job(self):
+        """Test that a failing job does not block the writer"""
+        def _fail():
+            raise ValueError('failed')
+        writer = DataWriter(num_threads=2)
+        writer.start()
+        writer.write_to('box', 'file', _fail)
+        writer.write_to('box', 'file', self._job, 'box', 'after')
+        writer.join()
+        writer.stop()
+        self.assertEqual(self.events, ['after'])
+
+    def test_worker_processes(self):
+        """Test that jobs run in worker processes unless queued in_process
+        and that their measurements and rrd updates reach the parent"""
+        tmp_dir = tempfile.mkdtemp()
+        sink = configure_rrd_sink()
+        writer = DataWriter(num_threads=1, num_processes=1)
+        writer.start()
+        try:
+            with INSTRUMENTATION.capture() as records:
+                with sink.capture() as updates:
+                    for name in ('worker', 'parent'):
+                        writer.write_to('box', name, _worker_job,
+                                        os.path.join(tmp_dir, name),
+                                        in_process=name == 'parent')
+                    writer.join()
+            pids = {}
+            for name in ('worker', 'parent'):
+                with open(os.path.join(tmp_dir, name)) as fid:
+                    pids[name] = int(fid.read())
+        finally:
+            writer.stop()
+            shutil.rmtree(tmp_dir)
+        self.assertEqual(pids['parent'], os.getpid())
+        self.assertNotEqual(pids['worker'], os.getpid())
+        self.assertEqual([rec for rec in records if rec[0] == 'worker_job'],
+                         [('worker_job', 0.5, None, None)] * 2)
+        self.assertEqual(updates, [('test.rrd', 'steps', 0, 1.0, 2.0)] * 2)
+
+    def test_after(self):
+        """Test jobs waiting for jobs of other out_boxes"""
+        release = threading.Event()
+        writer = DataWriter(num_threads=1, lanes={'b': {}},
+                            out_box_lanes={'b': 'b'})
+        writer.start()
+        encoded = writer.write_to('a', 'first', release.wait, 5)
+        published = writer.write_to('b', 'second', self._job, 'b',
+                                    'published', after=[encoded])
+        # later jobs of the destination keep their order
+        writer.write_to('b', 'second', self._job, 'b', 'later')
+        writer.write_to('b', 'other', self._job, 'b', 'other')
+        writer.write_to('a', 'first', self._job, 'a', 'committed',
+                        after=[published])
+        time.sleep(0.1)
+        self.assertEqual(self.events, ['other'])
+        release.set()
+        writer.join()
+        writer.stop()
+        self.assertEqual(sorted(self.events),
+                         ['committed', 'later', 'other', 'published'])
+        self.assertTrue(self.events.index('published') <
+                        self.events.index('later'))
+        self.assertTrue(self.events.index('published') <
+                        self.events.index('committed'))
+        done = writer.write_to('a', 'third', self._job, 'a', 'done',
+                               after=[encoded])
+        self.assertEqual(done.num_after, 0)
+
+
+class TestWriterLanes(unittest.TestCase):
+    """Unit testing for the writer lanes of the DataWriter
+    """
+
+    def setUp(self):
+        """Setting up the testing
+        """
+        self.tmp_dir = tempfile.mkdtemp()
+        self.events = []
+        self.release = threading.Event()
+
+    def tearDown(self):
+        """Cleaning up
+        """
+        self.release.set()
+        shutil.rmtree(self.tmp_dir)
+
+    def _hang(self, name):
+        self.release.wait(5)
+        self.events.append(name)
+
+    def _write(self, fname, nbytes):
+        with open(fname, 'wb') as fid:
+            fid.write('x' * nbytes)
+        self.events.append(os.path.basename(fname))
+
+    def test_slow_lane_isolation(self):
+        """Test that a hanging lane does not delay other lanes"""
+        writer = DataWriter(num_threads=1,
+                            lanes={'nfs': {'num_threads': 1}},
+                            out_box_lanes={'browser': 'nfs'})
+        writer.start()
+        writer.write_to('browser', 'b0', self._hang, 'b0')
+        writer.write_to('browser', 'b1', self._hang, 'b1')
+        tracker = MessageTracker('ninjo')
+        for idx in range(3):
+            writer.write_to('ninjo', 'n%d' % idx, self.events.append,
+                            'n%d' % idx, tracker=tracker)
+        tracker.seal()
+        self.assertTrue(tracker.wait(2))
+        self.assertEqual(self.events, ['n0', 'n1', 'n2'])
+        stats = writer.stats()
+        self.assertEqual(stats['nfs']['active'], 1)
+        self.assertEqual(stats['nfs']['queued'], 1)
+        self.assertEqual(stats[DEFAULT_LANE]['done'], 3)
+        self.release.set()
+        writer.join()
+        writer.stop()
+        self.assertEqual(self.events[3:], ['b0', 'b1'])
+
+    def test_timeout(self):
+        """Test that jobs waiting longer than the lane timeout are
+        dropped"""
+        writer = DataWriter(lanes={'nfs': {'timeout': 0.1}},
+                            out_box_lanes={'browser': 'nfs'})
+        writer.start()
+        self.release.clear()
+        writer.write_to('browser', 'b0', self._hang, 'b0')
+        writer.write_to('browser', 'b1', self._hang, 'b1')
+        time.sleep(0.3)
+        self.release.set()
+        writer.join()
+        writer.stop()
+        self.assertEqual(self.events, ['b0'])
+        stats = writer.stats()['nfs']
+        self.assertEqual((stats['done'], stats['dropped'], stats['slow']),
+                         (1, 1, 1))
+
+    def test_timeout_after(self):
+        """Test that the time spent waiting for other jobs does not count
+        against the lane timeout and that undroppable jobs are not
+        dropped"""
+        writer = DataWriter(num_threads=1,
+                            lanes={'nfs': {'timeout': 0.1}},
+                            out_box_lanes={'browser': 'nfs'})
+        writer.start()
+        self.release.clear()
+        encoded = writer.write_to('box', 'a', self._hang, 'encoded')
+        writer.write_to('browser', 'b', self.events.append, 'published',
+                        after=[encoded])
+        writer.write_to('browser', 'c', self._hang, 'hanging')
+        writer.write_to('browser', 'd', self.events.append, 'committed',
+                        droppable=False)
+        time.sleep(0.3)
+        self.release.set()
+        writer.join()
+        writer.stop()
+        self.assertEqual(sorted(self.events),
+                         ['committed', 'encoded', 'hanging', 'published'])
+        stats = writer.stats()['nfs']
+        self.assertEqual((stats['done'], stats['dropped']), (3, 0))
+
+    def test_bandwidth_limit(self):
+        """Test the bandwidth limit of a lane"""
+        writer = DataWriter(lanes={'slow': {'mbytes_per_second': 1}},
+                            out_box_lanes={'box': 'slow'})
+        writer.start()
+        t_start = time.time()
+        for idx in range(3):
+            fname = os.path.join(self.tmp_dir, 'file%d' % idx)
+            writer.write_to('box', fname, self._write, fname, 2 ** 18)
+        writer.join()
+        writer.stop()
+        # 3 * 256 kB at 1 MB/s: the third write starts after 0.5 s
+        self.assertTrue(time.time() - t_start >= 0.45)
+        self.assertEqual(writer.stats()['slow']['mbytes'], 0.75)
+
+    def test_reconfigure(self):
+        """Test that queued jobs move when their lane is removed"""
+        writer = DataWriter(lanes={'nfs': {}},
+                            out_box_lanes={'browser': 'nfs'})
+        writer.write_to('browser', 'b0', self.events.append, 'b0')
+        self.assertEqual(writer.stats()['nfs']['queued'], 1)
+        writer.configure(num_threads=2)
+        self.assertEqual(writer.stats().keys(), [DEFAULT_LANE])
+        writer.start()
+        writer.join()
+        writer.stop()
+        self.assertEqual(self.events, ['b0'])
+
+    def test_lane_config(self):
+        """Test the assignment of out_boxes to lanes"""
+        out_boxes = {'ninjo': {'output_dir': self.tmp_dir},
+                     'browser': {'output_dir': '/nonexisting/dir',
+                                 'lane_threads': '2',
+                                 'lane_timeout': '60'},
+                     'warnapp': {'output_dir': self.tmp_dir,
+                                 'writer_lane': 'warn'}}
+        lanes, out_box_lanes = lane_config(out_boxes, {'writer_threads': 4})
+        self.assertEqual(out_box_lanes, {'warnapp': 'warn'})
+        self.assertEqual(lanes[DEFAULT_LANE]['num_threads'], 4)
+
+        lanes, out_box_lanes = lane_config(out_boxes,
+                                           {'writer_lanes': 'out_box'})
+        self.assertEqual(out_box_lanes, {'ninjo': 'ninjo',
+                                         'browser': 'browser',
+                                         'warnapp': 'warn'})
+        self.assertEqual(lanes['browser'], {'num_threads': '2',
+                                            'timeout': '60'})
+
+        lanes, out_box_lanes = lane_config(out_boxes,
+                                           {'writer_lanes': 'filesystem'})
+        self.assertEqual(out_box_lanes['ninjo'], mount_point(self.tmp_dir))
+        self.assertEqual(out_box_lanes['browser'], '/')
+        self.assertEqual(lanes['/']['num_threads'], '2')
+
+
+class TestPipelining(unittest.TestCase):
+    """Unit testing for MessageTracker and InFlightLimiter
+    """
+
+    def test_message_tracker(self):
+        """Test completion tracking of the jobs of one message"""
+        done = []
+        writer = DataWriter(num_threads=2)
+        writer.start()
+        tracker = MessageTracker('msg1', callback=done.append)
+        for idx in range(3):
+            writer.write_to('box', 'file%d' % idx, time.sleep, 0.05,
+                            tracker=tracker)
+        self.assertEqual(done, [])
+        tracker.seal()
+        self.assertTrue(tracker.wait())
+        self.assertEqual(done, [tracker])
+        self.assertTrue(tracker.duration() >= 0.05)
+        writer.stop()
+
+    def test_empty_message_tracker(self):
+        """Test that a tracker without jobs is done when sealed"""
+        done = []
+        tracker = MessageTracker('msg1', callback=done.append)
+        tracker.seal()
+        self.assertEqual(done, [tracker])
+
+    def test_in_flight_limiter(self):
+        """Test that begin blocks while too many messages are in flight"""
+        limiter = InFlightLimiter(max_messages=1, max_bytes=100)
+        limiter.begin()
+        limiter.add_bytes(80)
+        started = threading.Event()
+
+        def _second():
+            limiter.begin()
+            started.set()
+        thr = threading.Thread(target=_second)
+        thr.start()
+        self.assertFalse(started.wait(0.2))
+        limiter.finish(80)
+        self.assertTrue(started.wait(2))
+        thr.join()
+        self.assertEqual(limiter.messages, 1)
+        self.assertEqual(limiter.nbytes, 0)
+
+    def test_in_flight_bytes(self):
+        """Test that add_bytes only waits for the bytes of other
+        messages"""
+        limiter = InFlightLimiter(max_bytes=100)
+        limiter.begin()
+        limiter.add_bytes(80)
+        # e.g. the image read for a rule after the size of the input
+        # file was accounted for a copy-only rule
+        limiter.add_bytes(80, own_nbytes=80)
+        self.assertEqual(limiter.nbytes, 160)
+
+        limiter.begin()
+        added = threading.Event()
+
+        def _other():
+            limiter.add_bytes(10)
+            added.set()
+        thr = threading.Thread(target=_other)
+        thr.start()
+        self.assertFalse(added.wait(0.2))
+        limiter.finish(160)
+        self.assertTrue(added.wait(2))
+        thr.join()
+        self.assertEqual(limiter.nbytes, 10)
+
+    def test_memory_budget(self):
+        """Test that admit blocks while the budget is exhausted"""
+        budget = MemoryBudget(max_bytes=100)
+        self.assertEqual(budget.admit(1000), 0)
+        budget.acquire(80)
+        self.assertEqual(budget.admit(20), 0)
+        admitted = threading.Event()
+
+        def _second():
+            budget.admit(30)
+            admitted.set()
+        thr = threading.Thread(target=_second)
+        thr.start()
+        self.assertFalse(admitted.wait(0.2))
+        budget.release(80)
+        self.assertTrue(admitted.wait(2))
+        thr.join()
+        stats = budget.stats()
+        self.assertEqual(stats['used_mbytes'], 0)
+        self.assertEqual(stats['peak_mbytes'], 80 / 2.0 ** 20)
+        self.assertEqual(stats['waits'], 1)
+
+    def test_shared_memory_budget(self):
+        """Test the accounting of a budget shared by processes"""
+        budget = MemoryBudget(shared=True)
+        budget.configure(100)
+        proc = multiprocessing.Process(target=budget.acquire, args=(150,))
+        proc.start()
+        proc.join()
+        self.assertEqual(budget.used(), 150)
+        admitted = threading.Event()
+
+        def _admit():
+            budget.admit()
+            admitted.set()
+        thr = threading.Thread(target=_admit)
+        thr.start()
+        self.assertFalse(admitted.wait(0.2))
+        proc = multiprocessing.Process(target=budget.release, args=(150,))
+        proc.start()
+        proc.join()
+        self.assertTrue(admitted.wait(2))
+        thr.join()
+
+
+def suite():
+    """The suite for test_data_writer
+    """
+    loader = unittest.TestLoader()
+    mysuite = unittest.TestSuite()
+    mysuite.addTest(loader.loadTestsFromTestCase(TestDataWriter))
+    mysuite.addTest(loader.loadTestsFromTestCase(TestWriterLanes))
+    mysuite.addTest(loader.loadTestsFromTestCase(TestPipelining))
+
+    return mysuite
+
+if __name__ == "__main__":
+    unittest.TextTestRunner(verbosity=2).run(suite())
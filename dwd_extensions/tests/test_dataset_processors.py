@@ -26,7 +26,10 @@ import numpy
 from mock import patch
 from datetime import datetime
 import os
+from pyresample.geometry import AreaDefinition
+from dwd_extensions.tools.dataset_processors import _blend
 from dwd_extensions.tools.dataset_processors import _create_world_composite
+from dwd_extensions.tools.dataset_processors import _world_composite_blocks
 from dwd_extensions.tools.image_io import read_image
 
 
@@ -115,12 +118,88 @@ class TestWorldComposite(unittest.TestCase):
         self.assertTrue(_compare_images(image.pil_image(),
                                         ref_image.pil_image()) == 0)
 
+    @patch('mpop.projector.get_area_file',
+           return_value=os.path.join(os.path.dirname(__file__),
+                                     'data', 'testareas.def'))
+    def test_world_composite_blocks(self, get_area_file_function):
+        """Test that the world composite computed block by block equals
+        the composite of the whole images"""
+        timeslot = datetime(2016, 4, 29, 10, 15)
+        lon_limits = {'meteosat10': [-37.5, 28.75],
+                      'meteosat7': [20.75, 83.2],
+                      'himawari8': [73.2, -177.15],
+                      'goes15': [-177.15, -105.],
+                      'goes13': [-105., -37.5]
+                      }
+        items = [(path, 'testwcm', timeslot) for path in self.files]
+        image = _create_world_composite(items, lon_limits)
+        blocks = list(_world_composite_blocks(items, lon_limits, rows=50))
+        for idx, chn in enumerate(image.channels):
+            block_chn = numpy.ma.concatenate([block[idx]
+                                              for block in blocks])
+            self.assertTrue(numpy.allclose(block_chn.data, chn.data))
+            self.assertTrue((numpy.ma.getmaskarray(block_chn) ==
+                             numpy.ma.getmaskarray(chn)).all())
+
     def tearDown(self):
         """Closing down
         """
         pass
 
 
+class _ArrayReader(object):
+
+    """Stand-in for a TiffRowReader reading from *channels*
+    """
+
+    def __init__(self, channels):
+        self.channels = channels
+        self.height, self.width = channels[0].shape
+        self.count = len(channels)
+        self.rows_read = 0
+
+    def read(self, start, rows):
+        self.rows_read = max(self.rows_read, rows)
+        return [chn[start:start + rows].copy() for chn in self.channels]
+
+
+class TestWorldCompositeBlocks(unittest.TestCase):
+    """Unit testing for the world composite computed block by block
+    """
+
+    def test_blocks_with_smoothing(self):
+        """Test that the blocks equal the composite of the whole
+        images, with the rows around the blocks for the smoothing"""
+        area = AreaDefinition('test', 'test', 'test',
+                              {'proj': 'eqc', 'ellps': 'WGS84'}, 360, 90,
+                              (-180., -45., 180., 45.))
+        rand = numpy.random.RandomState(1)
+        images = []
+        for left, right in ((0, 200), (150, 360)):
+            mask = numpy.ones((90, 360), bool)
+            mask[:, left:right] = False
+            mask[rand.random_sample((90, 360)) < 0.05] = True
+            images.append([numpy.ma.array(rand.random_sample((90, 360)),
+                                          mask=mask)])
+        items = [('sat1.tif', area, None), ('sat2.tif', area, None)]
+        lon_limits = {'sat2': (-30., 170.)}
+
+        expected = [chn.copy() for chn in images[0]]
+        _blend(expected, [chn.copy() for chn in images[1]], 'sat2.tif',
+               area, lon_limits, 20, 20)
+        readers = [_ArrayReader(channels) for channels in images]
+        blocks = list(_world_composite_blocks(
+            items, lon_limits, 20, 20, rows=16, readers=readers))
+        self.assertEqual([block[0].shape for block in blocks],
+                         [(16, 360)] * 5 + [(10, 360)])
+        # 16 rows and 2 x 9 rows around them
+        self.assertEqual(readers[0].rows_read, 34)
+        result = numpy.ma.concatenate([block[0] for block in blocks])
+        self.assertTrue(numpy.allclose(result.data, expected[0].data))
+        self.assertTrue((numpy.ma.getmaskarray(result) ==
+                         numpy.ma.getmaskarray(expected[0])).all())
+
+
 def _compare_images(img1, img2):
     if img1.size != img2.size or img1.getbands() != img2.getbands():
         return -1
@@ -146,6 +225,7 @@ def suite():
     loader = unittest.TestLoader()
     mysuite = unittest.TestSuite()
     mysuite.addTest(loader.loadTestsFromTestCase(TestWorldComposite))
+    mysuite.addTest(loader.loadTestsFromTestCase(TestWorldCompositeBlocks))
 
     return mysuite
 
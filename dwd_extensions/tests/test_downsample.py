@@ -0,0 +1,115 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Unit testing for the images derived from a parent area
+"""
+
+import unittest
+from datetime import datetime
+
+import numpy as np
+from mpop.imageo.geo_image import GeoImage
+from pyresample.geometry import AreaDefinition
+
+from dwd_extensions.mpop.quantized_image import QuantizedImage
+from dwd_extensions.tools.downsample import block_average
+from dwd_extensions.tools.downsample import decimate
+from dwd_extensions.tools.downsample import derive_image
+from dwd_extensions.tools.downsample import grid_ratio
+
+PROJ = {'proj': 'eqc', 'ellps': 'WGS84'}
+
+
+def _area(name, width, height, extent, proj=PROJ):
+    return AreaDefinition(name, name, name, proj, width, height, extent)
+
+
+class TestDownsample(unittest.TestCase):
+    """Unit testing for the derivation of coarser images
+    """
+
+    def setUp(self):
+        """Setting up the testing
+        """
+        self.parent = _area('fine', 12, 8, (0., 0., 1200., 800.))
+
+    def test_grid_ratio(self):
+        """Test the position and ratio of derived areas"""
+        self.assertEqual(grid_ratio(self.parent, _area(
+            'coarse', 4, 2, (0., 0., 1200., 800.))), (0, 0, 4, 3))
+        self.assertEqual(grid_ratio(self.parent, _area(
+            'part', 2, 3, (200., 100., 600., 700.))), (1, 2, 2, 2))
+        # not an integer ratio, not aligned, outside, other projection
+        for area in (_area('a', 5, 2, (0., 0., 1200., 800.)),
+                     _area('b', 2, 2, (50., 0., 450., 400.)),
+                     _area('c', 2, 2, (800., 0., 1600., 800.)),
+                     _area('d', 4, 2, (0., 0., 1200., 800.),
+                           {'proj': 'merc', 'ellps': 'WGS84'})):
+            self.assertRaises(ValueError, grid_ratio, self.parent, area)
+
+    def test_reduce(self):
+        """Test block averaging and decimation of masked data"""
+        data = np.ma.array(np.arange(24, dtype=float).reshape((4, 6)))
+        data[0:2, 0:2] = np.ma.masked
+        data[0, 2] = np.ma.masked
+        result = block_average(data, 2, 2)
+        self.assertEqual(result.shape, (2, 3))
+        self.assertTrue(result.mask[0, 0])
+        self.assertAlmostEqual(result[0, 1], (3 + 8 + 9) / 3.0)
+        self.assertAlmostEqual(result[1, 2], (16 + 17 + 22 + 23) / 4.0)
+
+        result = block_average(data.astype(np.uint8), 2, 2)
+        self.assertEqual(result.dtype, np.uint8)
+        self.assertEqual(result[0, 1], 7)
+
+        result = decimate(data, 2, 3)
+        self.assertEqual(result.shape, (2, 2))
+        self.assertTrue(result.mask[0, 0])
+        self.assertEqual(result[1, 1], 22)
+
+    def test_derive_image(self):
+        """Test deriving GeoImages and QuantizedImages"""
+        coarse = _area('coarse', 4, 2, (0., 0., 1200., 800.))
+        data = np.ma.array(np.random.random((8, 12)))
+        img = GeoImage((data, data, data), self.parent, datetime(2016, 1, 1),
+                       mode='RGB', fill_value=(0, 0, 0))
+        derived = derive_image(img, coarse)
+        self.assertTrue(isinstance(derived, GeoImage))
+        self.assertTrue(derived.area is coarse)
+        self.assertEqual(derived.mode, 'RGB')
+        self.assertEqual(derived.channels[1].shape, (2, 4))
+        self.assertAlmostEqual(derived.channels[1][1, 3],
+                               data[4:8, 9:12].mean())
+
+        img = QuantizedImage(data, self.parent, datetime(2016, 1, 1),
+                             fill_value=0)
+        derived = derive_image(img, coarse, 'decimate')
+        self.assertTrue(isinstance(derived, QuantizedImage))
+        self.assertEqual(derived.channels[0][1, 3], img.channels[0][6, 10])
+        self.assertRaises(ValueError, derive_image, img, coarse, 'cubic')
+
+
+def suite():
+    """The suite for test_downsample
+    """
+    loader = unittest.TestLoader()
+    mysuite = unittest.TestSuite()
+    mysuite.addTest(loader.loadTestsFromTestCase(TestDownsample))
+
+    return mysuite
+
+if __name__ == "__main__":
+    unittest.TextTestRunner(verbosity=2).run(suite())
@@ -0,0 +1,155 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Unit testing for the event loop of the postprocessor
+"""
+
+import threading
+import time
+import unittest
+
+from dwd_extensions.trollduction.event_loop import EventLoop
+from dwd_extensions.trollduction.event_loop import Executor
+
+
+class TestEventLoop(unittest.TestCase):
+    """Unit testing for EventLoop
+    """
+
+    def setUp(self):
+        """Setting up the testing
+        """
+        self.loop = EventLoop()
+        self.calls = []
+
+    def tearDown(self):
+        """Cleaning up
+        """
+        self.loop.close()
+
+    def _run(self, timeout=5):
+        # safety net against hanging tests
+        timer = threading.Timer(timeout, self.loop.stop)
+        timer.start()
+        t_start = time.time()
+        self.loop.run()
+        timer.cancel()
+        return time.time() - t_start
+
+    def test_post_from_thread(self):
+        """Test that events posted by other threads are handled at once"""
+        def post():
+            self.loop.post(self.calls.append, 'msg')
+            self.loop.post(self.loop.stop)
+
+        thr = threading.Thread(target=post)
+        thr.start()
+        elapsed = self._run()
+        thr.join()
+        self.assertEqual(self.calls, ['msg'])
+        self.assertLess(elapsed, 1)
+
+    def test_timers(self):
+        """Test one-shot, periodic and cancelled timers"""
+        self.loop.call_later(0.05, self.calls.append, 'later')
+        cancelled = self.loop.call_later(0.01, self.calls.append, 'never')
+        self.loop.cancel(cancelled)
+        self.loop.call_every(0.02, self.calls.append, 'every')
+        self.loop.call_later(0.15, self.loop.stop)
+        self._run()
+        self.assertNotIn('never', self.calls)
+        self.assertEqual(self.calls.count('later'), 1)
+        self.assertGreaterEqual(self.calls.count('every'), 3)
+        self.assertEqual(self.calls[0], 'every')
+
+    def test_error_in_handler(self):
+        """Test that an error of a handler does not stop the loop"""
+        self.loop.post(lambda: 1 / 0)
+        self.loop.post(self.calls.append, 'next')
+        self.loop.post(self.loop.stop)
+        self._run()
+        self.assertEqual(self.calls, ['next'])
+
+    def test_stop_after_close(self):
+        """Test that stopping a closed loop is harmless"""
+        self.loop.close()
+        self.loop.stop()
+        self.loop.post(self.calls.append, 'lost')
+        self.assertEqual(self.calls, [])
+
+    def test_post_while_closing(self):
+        """Test that posting from another thread while the loop is
+        closed does not fail"""
+        errors = []
+        done = threading.Event()
+
+        def post():
+            try:
+                while not done.is_set():
+                    self.loop.post(self.calls.append, 'msg')
+            except BaseException as err:
+                errors.append(err)
+
+        thr = threading.Thread(target=post)
+        thr.start()
+        time.sleep(0.05)
+        self.loop.close()
+        time.sleep(0.05)
+        done.set()
+        thr.join(5)
+        self.assertEqual(errors, [])
+
+
+class TestExecutor(unittest.TestCase):
+    """Unit testing for Executor
+    """
+
+    def test_callbacks(self):
+        """Test that results and errors are handed to the loop"""
+        loop = EventLoop()
+        executor = Executor(loop, num_threads=2)
+        results = []
+
+        def callback(result, error):
+            self.assertIs(threading.current_thread(), loop.thread)
+            results.append((result, type(error)))
+            if len(results) == 2:
+                loop.stop()
+
+        executor.submit(sum, ([1, 2],), callback)
+        executor.submit(int, ('x',), callback)
+        timer = threading.Timer(5, loop.stop)
+        timer.start()
+        loop.run()
+        timer.cancel()
+        executor.shutdown(wait=True)
+        loop.close()
+        self.assertEqual(sorted(results),
+                         sorted([(3, type(None)), (None, ValueError)]))
+
+
+def suite():
+    """The suite for test_event_loop
+    """
+    loader = unittest.TestLoader()
+    mysuite = unittest.TestSuite()
+    mysuite.addTest(loader.loadTestsFromTestCase(TestEventLoop))
+    mysuite.addTest(loader.loadTestsFromTestCase(TestExecutor))
+
+    return mysuite
+
+if __name__ == "__main__":
+    unittest.TextTestRunner(verbosity=2).run(suite())
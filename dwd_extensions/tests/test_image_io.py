@@ -0,0 +1,59 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Unit testing for the tiled GeoTIFF options
+"""
+
+import unittest
+
+from dwd_extensions.tools.image_io import geotiff_options
+from dwd_extensions.tools.image_io import overview_levels
+
+
+class TestTiledGeotiff(unittest.TestCase):
+    """Unit testing for the creation options and overview levels
+    """
+
+    def test_geotiff_options(self):
+        """Test the creation options of the save arguments"""
+        self.assertEqual(geotiff_options({'compression': 6,
+                                          'blocksize': 0}),
+                         ['COMPRESS=DEFLATE', 'ZLEVEL=6'])
+        self.assertEqual(
+            geotiff_options({'compression': '0', 'blocksize': 256,
+                             'gdal_options': {'predictor': '2'}}),
+            ['PREDICTOR=2', 'TILED=YES', 'BLOCKXSIZE=256',
+             'BLOCKYSIZE=256'])
+
+    def test_overview_levels(self):
+        """Test that the smallest overview fits into one block"""
+        self.assertEqual(overview_levels(1000, 500, 256), [2, 4])
+        self.assertEqual(overview_levels(3712, 3712, 256), [2, 4, 8, 16])
+        self.assertEqual(overview_levels(256, 100, 256), [])
+        self.assertEqual(overview_levels(257, 100, 256), [2])
+
+
+def suite():
+    """The suite for test_image_io
+    """
+    loader = unittest.TestLoader()
+    mysuite = unittest.TestSuite()
+    mysuite.addTest(loader.loadTestsFromTestCase(TestTiledGeotiff))
+
+    return mysuite
+
+if __name__ == "__main__":
+    unittest.TextTestRunner(verbosity=2).run(suite())
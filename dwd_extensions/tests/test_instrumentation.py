@@ -0,0 +1,88 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Unit testing for the latency instrumentation
+"""
+
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+from dwd_extensions.tools.instrumentation import Histogram
+from dwd_extensions.tools.instrumentation import Instrumentation
+
+
+class TestInstrumentation(unittest.TestCase):
+    """Unit testing for Histogram and Instrumentation
+    """
+
+    def test_histogram(self):
+        """Test the histogram summary"""
+        hist = Histogram()
+        for value in [0.01] * 90 + [1.5] * 10:
+            hist.add(value)
+        summary = hist.to_dict()
+        self.assertEqual(summary['count'], 100)
+        self.assertAlmostEqual(summary['mean'], 0.159)
+        self.assertTrue(0.01 <= summary['p50'] <= 0.02)
+        self.assertEqual(summary['p99'], 1.5)
+        self.assertEqual(summary['min'], 0.01)
+
+    def test_record_and_dump(self):
+        """Test recording per stage, product and out_box"""
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            fname = os.path.join(tmp_dir, 'stages.jsonl')
+            instr = Instrumentation(fname)
+            instr.record('save', 0.5, 'IR_108', 'ninjo')
+            instr.record('save', 1.5, 'IR_108', 'browser')
+            with instr.timer('read_image', 'IR_108'):
+                pass
+            instr.set_sink(None)
+
+            dump = instr.dump()
+            self.assertEqual([(item['stage'], item['out_box'])
+                              for item in dump],
+                             [('read_image', None), ('save', 'browser'),
+                              ('save', 'ninjo')])
+            totals = instr.stage_totals()
+            self.assertEqual(totals['save']['count'], 2)
+            self.assertEqual(totals['save']['max'], 1.5)
+
+            with open(fname) as fid:
+                lines = [json.loads(line) for line in fid]
+            self.assertEqual(len(lines), 3)
+            self.assertEqual(lines[0]['out_box'], 'ninjo')
+
+            instr.reset()
+            self.assertEqual(instr.dump(), [])
+        finally:
+            shutil.rmtree(tmp_dir)
+
+
+def suite():
+    """The suite for test_instrumentation
+    """
+    loader = unittest.TestLoader()
+    mysuite = unittest.TestSuite()
+    mysuite.addTest(loader.loadTestsFromTestCase(TestInstrumentation))
+
+    return mysuite
+
+if __name__ == "__main__":
+    unittest.TextTestRunner(verbosity=2).run(suite())
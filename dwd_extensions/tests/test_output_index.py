@@ -0,0 +1,117 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Unit testing for the index of written output files
+"""
+
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+from dwd_extensions.tools.output_index import INDEX_HIT
+from dwd_extensions.tools.output_index import INDEX_LINK
+from dwd_extensions.tools.output_index import INDEX_MISS
+from dwd_extensions.tools.output_index import OutputIndex
+from dwd_extensions.tools.output_index import output_key
+
+
+class TestOutputIndex(unittest.TestCase):
+    """Unit testing for OutputIndex
+    """
+
+    def setUp(self):
+        """Setting up the testing
+        """
+        self.tmp_dir = tempfile.mkdtemp()
+        self.src = self._write('src.tif', 'source')
+        self.index = OutputIndex(os.path.join(self.tmp_dir, 'index.db'))
+
+    def tearDown(self):
+        """Cleaning up
+        """
+        self.index.close()
+        shutil.rmtree(self.tmp_dir)
+
+    def _write(self, name, data):
+        fname = os.path.join(self.tmp_dir, name)
+        with open(fname, 'w') as fid:
+            fid.write(data)
+        return fname
+
+    def test_output_key(self):
+        """Test that the key depends on the source and the parameters"""
+        key = output_key(self.src, 'area', {'compression': 6})
+        self.assertEqual(key, output_key(self.src, 'area',
+                                         {'compression': 6}))
+        self.assertNotEqual(key, output_key(self.src, 'area',
+                                            {'compression': 7}))
+        os.utime(self.src, (0, 0))
+        self.assertNotEqual(key, output_key(self.src, 'area',
+                                            {'compression': 6}))
+
+    def test_lookup(self):
+        """Test hits, links and misses"""
+        key = output_key(self.src, 'area')
+        dest1 = os.path.join(self.tmp_dir, 'dest1.tif')
+        dest2 = os.path.join(self.tmp_dir, 'dest2.tif')
+        self.assertEqual(self.index.lookup(dest1, key), (INDEX_MISS, None))
+        self._write('dest1.tif', 'output')
+        self.index.record([(dest1, key), (dest2, key)])
+        self.assertEqual(self.index.record_count(), 1)
+
+        self.assertEqual(self.index.lookup(dest1, key), (INDEX_HIT, dest1))
+        self.assertEqual(self.index.lookup(dest2, key), (INDEX_LINK, dest1))
+        self.assertEqual(self.index.lookup(dest1, 'other'),
+                         (INDEX_MISS, None))
+        # changed output
+        self._write('dest1.tif', 'changed output')
+        self.assertEqual(self.index.lookup(dest1, key), (INDEX_MISS, None))
+        self.assertEqual(self.index.lookup(dest2, key), (INDEX_MISS, None))
+        self.assertEqual(self.index.stats(),
+                         {INDEX_HIT: 1, INDEX_LINK: 1, INDEX_MISS: 4})
+
+    def test_record_since(self):
+        """Test that files not written by the job are not recorded"""
+        dest = self._write('dest.tif', 'output')
+        self.index.record([(dest, 'key')], since=time.time() + 10)
+        self.assertEqual(self.index.record_count(), 0)
+        self.index.record([(dest, 'key')], since=time.time())
+        self.assertEqual(self.index.record_count(), 1)
+
+    def test_persistence(self):
+        """Test that the index is kept across instances"""
+        dest = self._write('dest.tif', 'output')
+        self.index.record([(dest, 'key')])
+        self.index.close()
+        self.index = OutputIndex(os.path.join(self.tmp_dir, 'index.db'))
+        self.assertEqual(self.index.lookup(dest, 'key'), (INDEX_HIT, dest))
+        self.index.delete_older_than(0)
+        self.assertEqual(self.index.record_count(), 0)
+
+
+def suite():
+    """The suite for test_output_index
+    """
+    loader = unittest.TestLoader()
+    mysuite = unittest.TestSuite()
+    mysuite.addTest(loader.loadTestsFromTestCase(TestOutputIndex))
+
+    return mysuite
+
+if __name__ == "__main__":
+    unittest.TextTestRunner(verbosity=2).run(suite())
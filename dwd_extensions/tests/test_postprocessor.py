@@ -0,0 +1,557 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Unit testing for the DataProcessor of the postprocessor
+"""
+
+import Queue
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+from datetime import datetime, timedelta
+
+import numpy as np
+
+from dwd_extensions.trollduction import postprocessor
+from dwd_extensions.trollduction.data_writer import MessageTracker
+from dwd_extensions.trollduction.event_loop import EventLoop
+from dwd_extensions.trollduction.postprocessor import DataProcessor
+from dwd_extensions.trollduction.postprocessor import PostProcessor
+from dwd_extensions.trollduction.postprocessor import encode_image
+from dwd_extensions.trollduction.postprocessor import get_save_arguments
+from dwd_extensions.trollduction.postprocessor import rule_timeslot
+from dwd_extensions.trollduction.product_config import ProductConfig
+
+
+class _Message(object):
+
+    """Stand-in for a posttroll message
+    """
+
+    def __init__(self, data, msg_type='file', subject='/test'):
+        self.type = msg_type
+        self.subject = subject
+        self.data = data
+
+
+def _message(fname, area='ccs4'):
+    return _Message({'uri': fname, 'source_uri': fname,
+                     'product_name': 'IR_108', 'area': {'name': area},
+                     'time': datetime(2016, 1, 1, 12),
+                     'product_filename': fname})
+
+
+class _Image(object):
+
+    """Stand-in for a GeoImage, records the saved files
+    """
+
+    saved = []
+
+    def __init__(self):
+        self.channels = [np.zeros((4, 4))]
+
+    def save(self, fname, **kwargs):
+        _Image.saved.append((fname, kwargs))
+        with open(fname, 'w') as fid:
+            fid.write('encoded')
+
+
+class _Listener(object):
+
+    """Stand-in for the ListenerContainer, a restart creates a new queue
+    """
+
+    def __init__(self, topics=None):
+        self.topics = topics
+        self.queue = Queue.Queue()
+
+    def restart_listener(self, topics):
+        self.__init__(topics)
+
+    def stop(self):
+        pass
+
+
+class _GeoImage(object):
+
+    """Stand-in for a GeoImage, merges the gdal_options and tags of a
+    save like GeoImage.save
+    """
+
+    def __init__(self):
+        self.gdal_options = {}
+        self.tags = {}
+        self.saved = []
+
+    def save(self, fname, gdal_options=None, tags=None, **kwargs):
+        self.gdal_options.update(gdal_options or {})
+        self.tags.update(tags or {})
+        self.saved.append((fname, dict(self.gdal_options)))
+
+
+def create_image(msg, params):
+    '''Dataset processor creating an _Image
+    '''
+    return _Image()
+
+
+def no_image(msg, params):
+    '''Dataset processor creating no image
+    '''
+    return None
+
+
+def _dataset_message():
+    return _Message({'product_name': 'WCM', 'area': {'name': 'world'},
+                     'time': datetime(2016, 1, 1, 12)},
+                    msg_type='dataset', subject='/WORLDCOMP')
+
+
+def _raw_config(tmp_dir, rules, out_boxes=('box',), **settings):
+    post_processing = {
+        'rrd_dir': tmp_dir + '/rrd',
+        'out_box': [{'name': name, 'output_dir': tmp_dir + '/' + name}
+                    for name in out_boxes],
+        'rule': rules}
+    post_processing.update(settings)
+    return {'post_processing': post_processing}
+
+
+class _FailingDataProcessor(DataProcessor):
+
+    """DataProcessor failing after a write job of the message was queued
+    """
+
+    def __init__(self):
+        DataProcessor.__init__(self)
+        self.release = threading.Event()
+        self.done = threading.Event()
+
+    def _run(self, msg, tracker):
+        self._account_image(msg, tracker, 100)
+        self.writer.write_to('box', 'file', self.release.wait, 5,
+                             tracker=tracker)
+        raise ValueError('failed')
+
+    def _message_done(self, msg, tracker):
+        DataProcessor._message_done(self, msg, tracker)
+        self.done.set()
+
+
+class TestDataProcessor(unittest.TestCase):
+    """Unit testing for DataProcessor
+    """
+
+    def setUp(self):
+        """Setting up the testing
+        """
+        self.tmp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        """Cleaning up
+        """
+        shutil.rmtree(self.tmp_dir)
+
+    def test_encode_once(self):
+        """Test that identical outputs are encoded once and published by
+        jobs of their own out_boxes"""
+        rules = [{'input_pattern': 'wcm', 'out_box_ref': 'a',
+                  'dest_filename': 'x.png', 'format': 'png'},
+                 {'input_pattern': 'wcm', 'out_box_ref': 'b',
+                  'dest_filename': 'x.png', 'format': 'png'},
+                 {'input_pattern': 'wcm', 'out_box_ref': 'a',
+                  'dest_filename': 'y.png', 'format': 'png'},
+                 {'input_pattern': 'wcm', 'out_box_ref': 'b',
+                  'dest_filename': 'z.tif', 'format': 'tif'}]
+        raw = _raw_config(self.tmp_dir, rules, out_boxes=('a', 'b'),
+                          writer_lanes='out_box')
+        raw['post_processing']['dataset_processor'] = {
+            'msg_subject_pattern': '.*WORLDCOMP', 'output_name': 'wcm',
+            'processing_function':
+            'dwd_extensions.tests.test_postprocessor|create_image'}
+        for name in ('a', 'b'):
+            os.makedirs(os.path.join(self.tmp_dir, name))
+        config = ProductConfig(raw, self.tmp_dir)
+        _Image.saved = []
+
+        proc = DataProcessor()
+        try:
+            actions = proc.plan(config, _dataset_message())
+            proc.run(config, _dataset_message())
+            stats = proc.writer.stats()
+        finally:
+            proc.writer.stop()
+
+        first = os.path.join(self.tmp_dir, 'a', 'x.png')
+        self.assertEqual(sorted(fname for fname, _ in _Image.saved),
+                         [os.path.join(self.tmp_dir, 'a', '.x.png'),
+                          os.path.join(self.tmp_dir, 'b', '.z.tif')])
+        self.assertEqual([action['encoded_by'] for action in actions],
+                         [first, first, first, actions[3]['dest_filename']])
+        for name in ('b/x.png', 'a/y.png'):
+            fname = os.path.join(self.tmp_dir, name)
+            self.assertEqual(os.stat(fname).st_ino, os.stat(first).st_ino)
+        self.assertEqual(sorted(os.listdir(os.path.join(self.tmp_dir, 'a'))),
+                         ['x.png', 'y.png'])
+        self.assertEqual(sorted(os.listdir(os.path.join(self.tmp_dir, 'b'))),
+                         ['x.png', 'z.tif'])
+        # encoding, publishing y.png and commit of x.png in out_box a
+        self.assertEqual(stats['a']['done'], 3)
+        self.assertEqual(stats['b']['done'], 2)
+
+    def test_derived_image_over_limit(self):
+        """Test that the image derived from the image of a message does
+        not wait for the bytes of the message itself"""
+        proc = DataProcessor()
+        derive_image = postprocessor.derive_image
+        get_area_def = postprocessor.get_area_def
+        postprocessor.derive_image = lambda geo_img, area, method: _Image()
+        postprocessor.get_area_def = lambda name: name
+        derived = {}
+        tracker = MessageTracker(None)
+        try:
+            # 128 bytes per image
+            proc.in_flight.configure(max_bytes=200)
+            proc.in_flight.begin()
+            geo_img = _Image()
+            proc._add_bytes(tracker, 128)
+            thr = threading.Thread(
+                target=proc._derived_image,
+                args=(geo_img, {'derived_area': 'coarse'}, derived,
+                      tracker, 'IR_108'))
+            thr.daemon = True
+            thr.start()
+            thr.join(5)
+            self.assertFalse(thr.is_alive())
+            self.assertEqual(tracker.nbytes, 256)
+            self.assertEqual(proc.in_flight.nbytes, 256)
+        finally:
+            postprocessor.derive_image = derive_image
+            postprocessor.get_area_def = get_area_def
+            proc.in_flight.finish(tracker.nbytes)
+            proc.writer.stop()
+
+    def test_dataset_without_image(self):
+        """Test a dataset message without image and copy only rules"""
+        raw = _raw_config(self.tmp_dir, [{'input_pattern': 'wcm',
+                                          'out_box_ref': 'box',
+                                          'dest_filename': 'x.png',
+                                          'copySrcFileOnly': 'true'}])
+        raw['post_processing']['dataset_processor'] = {
+            'msg_subject_pattern': '.*WORLDCOMP', 'output_name': 'wcm',
+            'processing_function':
+            'dwd_extensions.tests.test_postprocessor|no_image'}
+        config = ProductConfig(raw, self.tmp_dir)
+        proc = DataProcessor()
+        try:
+            proc.run(config, _dataset_message())
+        finally:
+            proc.writer.stop()
+        self.assertEqual(proc.in_flight.messages, 0)
+        self.assertEqual(proc.in_flight.nbytes, 0)
+
+    def test_error_after_queued_jobs(self):
+        """Test that the image of a failed message is held until its
+        queued jobs are done"""
+        config = ProductConfig(_raw_config(
+            self.tmp_dir, {'input_pattern': 'A_.*', 'out_box_ref': 'box'},
+            pipeline_max_messages='2'), self.tmp_dir)
+        proc = _FailingDataProcessor()
+        try:
+            self.assertRaises(ValueError, proc.run, config,
+                              _message('A_1.tif'))
+            self.assertEqual(proc.memory.used(), 100)
+            self.assertEqual(proc.in_flight.messages, 1)
+            self.assertFalse(proc.done.is_set())
+            proc.release.set()
+            self.assertTrue(proc.done.wait(5))
+            self.assertEqual(proc.memory.used(), 0)
+            self.assertEqual(proc.in_flight.messages, 0)
+        finally:
+            proc.release.set()
+            proc.writer.stop()
+
+
+class TestSaveArguments(unittest.TestCase):
+    """Unit testing for the save arguments of rules
+    """
+
+    def test_defaults(self):
+        """Test the save arguments without tiling options"""
+        self.assertEqual(get_save_arguments({'format': 'tif'}),
+                         {'fformat': 'tif', 'compression': 6,
+                          'blocksize': 0})
+        self.assertEqual(get_save_arguments(
+            {'format': 'tif', 'format_params': {'compression': 0,
+                                                'overviews': 'none'}}),
+            {'fformat': 'tif', 'compression': 0, 'blocksize': 0})
+
+    def test_tiles(self):
+        """Test tile size, predictor and overviews"""
+        format_params = {'tile_size': '512', 'predictor': '2',
+                         'gdal_options': {'BIGTIFF': 'NO'},
+                         'overviews': '2,4,8',
+                         'overview_resampling': 'nearest'}
+        rule = {'format': 'tif', 'format_params': format_params}
+        self.assertEqual(get_save_arguments(rule),
+                         {'fformat': 'tif', 'compression': 6,
+                          'blocksize': 512,
+                          'gdal_options': {'BIGTIFF': 'NO',
+                                           'PREDICTOR': '2'},
+                          'overviews': (2, 4, 8),
+                          'overview_resampling': 'nearest',
+                          'cloud_optimized': False})
+        # the rule is unchanged
+        self.assertEqual(format_params['gdal_options'], {'BIGTIFF': 'NO'})
+        self.assertEqual(format_params['tile_size'], '512')
+
+    def test_cloud_optimized(self):
+        """Test the defaults of cloud optimized GeoTIFFs"""
+        self.assertEqual(get_save_arguments(
+            {'format': 'tif', 'format_params': {'cloud_optimized': 'true'}}),
+            {'fformat': 'tif', 'compression': 6, 'blocksize': 256,
+             'overviews': 'auto', 'overview_resampling': 'average',
+             'cloud_optimized': True})
+        self.assertEqual(get_save_arguments(
+            {'format': 'tif', 'format_params': {'cloud_optimized': 'true',
+                                                'tile_size': '1024',
+                                                'overviews': '2,4'}}),
+            {'fformat': 'tif', 'compression': 6, 'blocksize': 1024,
+             'overviews': (2, 4), 'overview_resampling': 'average',
+             'cloud_optimized': True})
+
+    def test_ninjotiff(self):
+        """Test that ninjotiff gets its tile size, without predictor and
+        overviews"""
+        self.assertEqual(get_save_arguments(
+            {'format': 'mpop.imageo.formats.ninjotiff',
+             'format_params': {'tile_size': '256', 'predictor': '2',
+                               'overviews': 'auto'}}),
+            {'fformat': 'mpop.imageo.formats.ninjotiff', 'compression': 6,
+             'blocksize': 0, 'tile_width': 256, 'tile_length': 256,
+             'inv_def_temperature_cmap': False,
+             'omit_filename_path': True})
+
+    def test_encode_image(self):
+        """Test that the gdal_options of a save do not leak into the
+        image"""
+        geo_img = _GeoImage()
+        with_predictor = get_save_arguments(
+            {'format': 'tif', 'format_params': {'predictor': '2'}})
+        encode_image(geo_img, 'a.tif', with_predictor)
+        encode_image(geo_img, 'b.tif', get_save_arguments({'format': 'tif'}))
+        self.assertEqual(geo_img.saved, [('a.tif', {'PREDICTOR': '2'}),
+                                         ('b.tif', {})])
+        self.assertEqual(geo_img.gdal_options, {})
+        self.assertEqual(geo_img.tags, {})
+        self.assertEqual(with_predictor['gdal_options'], {'PREDICTOR': '2'})
+
+
+class TestTimeslot(unittest.TestCase):
+    """Unit testing for the timeslots of rules
+    """
+
+    def setUp(self):
+        """Setting up the testing
+        """
+        self.tmp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        """Cleaning up
+        """
+        shutil.rmtree(self.tmp_dir)
+
+    def test_rule_timeslot(self):
+        """Test the timeslot of a rule for a message"""
+        data = {'time': datetime(2016, 1, 1, 12),
+                'gatherer_time': datetime(2016, 1, 1, 11, 55),
+                'nominal_time': '20160101115000', 'other': 'x'}
+        duration = timedelta(minutes=5)
+        self.assertEqual(rule_timeslot({}, data, duration),
+                         datetime(2016, 1, 1, 12, 5))
+        self.assertEqual(rule_timeslot({'time_name': 'gatherer_time'},
+                                       data, duration),
+                         datetime(2016, 1, 1, 11, 55))
+        self.assertEqual(rule_timeslot({'time_name': 'nominal_time'},
+                                       data, duration),
+                         datetime(2016, 1, 1, 11, 50))
+        self.assertEqual(rule_timeslot({'time_name': 'other'}, data,
+                                       duration), None)
+        self.assertEqual(rule_timeslot({}, {}, duration), None)
+
+    def test_scheduling_timeslot(self):
+        """Test that messages are scheduled by the timeslots of their
+        rules, with the configured duration"""
+        rules = [{'input_pattern': 'A_.*', 'out_box_ref': 'box',
+                  'dest_filename': 'a_{time_eos:%H%M}.tif',
+                  'format': 'tif'},
+                 {'input_pattern': 'A_.*', 'out_box_ref': 'box',
+                  'dest_filename': 'b.tif', 'time_name': 'gatherer_time'},
+                 {'input_pattern': 'B_.*', 'out_box_ref': 'box',
+                  'dest_filename': 'b_{time_eos:%H%M}.tif',
+                  'format': 'tif'}]
+        config = ProductConfig(_raw_config(self.tmp_dir, rules,
+                                           timeslot_minutes='5'),
+                               self.tmp_dir)
+        proc = PostProcessor.__new__(PostProcessor)
+        proc.product_config = config
+
+        msg = _message('B_1.tif')
+        self.assertEqual(proc.timeslot(msg, proc.match_rules(msg)),
+                         datetime(2016, 1, 1, 12, 5))
+        msg = _message('A_1.tif')
+        msg.data['gatherer_time'] = datetime(2016, 1, 1, 12, 3)
+        self.assertEqual(proc.timeslot(msg, proc.match_rules(msg)),
+                         datetime(2016, 1, 1, 12, 3))
+        self.assertEqual(proc.timeslot(msg, []),
+                         datetime(2016, 1, 1, 12, 5))
+
+        data_processor = DataProcessor()
+        try:
+            actions = data_processor.plan(config, _message('B_1.tif'))
+        finally:
+            data_processor.writer.stop()
+        self.assertEqual([os.path.basename(action['dest_filename'])
+                          for action in actions], ['b_1205.tif'])
+
+    def test_match_rules_derive_from(self):
+        """Test that messages are scheduled by the rules the data
+        processor applies, i.e. derived areas only of their parent
+        area"""
+        rules = [{'input_pattern': 'A_.*', 'out_box_ref': 'box',
+                  'dest_filename': 'a.tif', 'format': 'tif'},
+                 {'input_pattern': 'A_.*', 'out_box_ref': 'box',
+                  'dest_filename': 'a_euro.tif', 'format': 'tif',
+                  'derive_from': 'euro4', 'derived_area': 'euro8',
+                  'time_name': 'gatherer_time'}]
+        config = ProductConfig(_raw_config(self.tmp_dir, rules),
+                               self.tmp_dir)
+        proc = PostProcessor.__new__(PostProcessor)
+        proc.product_config = config
+        data_processor = DataProcessor()
+        try:
+            for area, num in (('ccs4', 1), ('euro4', 2)):
+                msg = _message('A_1.tif', area)
+                msg.data['gatherer_time'] = datetime(2016, 1, 1, 11, 55)
+                self.assertEqual(len(proc.match_rules(msg)), num)
+                self.assertEqual(len(data_processor.plan(config, msg)),
+                                 num)
+        finally:
+            data_processor.writer.stop()
+        # the earlier timeslot of the derived area is ignored for ccs4
+        msg = _message('A_1.tif')
+        msg.data['gatherer_time'] = datetime(2016, 1, 1, 11, 55)
+        self.assertEqual(proc.timeslot(msg, proc.match_rules(msg)),
+                         datetime(2016, 1, 1, 12, 15))
+
+
+class TestPostProcessor(unittest.TestCase):
+    """Unit testing for PostProcessor
+    """
+
+    def setUp(self):
+        """Setting up the testing
+        """
+        self.tmp_dir = tempfile.mkdtemp()
+        self.proc = PostProcessor.__new__(PostProcessor)
+        self.proc.loop = EventLoop()
+        self.proc._timers = {}
+
+    def tearDown(self):
+        """Cleaning up
+        """
+        self.proc.loop.close()
+        shutil.rmtree(self.tmp_dir)
+
+    def _set_settings(self, **settings):
+        self.proc.product_config = ProductConfig(
+            _raw_config(self.tmp_dir, [], **settings), self.tmp_dir)
+
+    def _armed(self):
+        return sorted((timer[2], timer[3].__name__)
+                      for timer in self.proc.loop._timers
+                      if timer[3] is not None)
+
+    def _wait_events(self, num, timeout=5):
+        deadline = time.time() + timeout
+        while len(self.proc.loop._events) < num and \
+                time.time() < deadline:
+            time.sleep(0.01)
+
+    def test_receive_after_restart(self):
+        """Test that messages of a restarted listener are received"""
+        self.proc._loop = True
+        self.proc.listener = _Listener(['/a'])
+        old_queue = self.proc.listener.queue
+        thr = threading.Thread(target=self.proc.receive)
+        thr.daemon = True
+        thr.start()
+        try:
+            old_queue.put('first')
+            self._wait_events(1)
+            self.proc.listener.restart_listener(['/b'])
+            self.proc.listener.queue.put('second')
+            self._wait_events(2)
+            self.assertEqual([args for _, args in self.proc.loop._events],
+                             [('first',), ('second',)])
+        finally:
+            # like cleanup: wake up the thread through the new queue
+            self.proc._loop = False
+            self.proc.listener.queue.put(None)
+            thr.join(5)
+        self.assertFalse(thr.is_alive())
+
+    def test_arm_timers(self):
+        """Test that the periodic timers follow the settings"""
+        self._set_settings()
+        self.proc.arm_timers()
+        self.assertEqual(self._armed(), [(3600.0, 'housekeeping')])
+        housekeeping = self.proc._timers['housekeeping'][1]
+
+        self._set_settings(metrics_interval='600')
+        self.proc.arm_timers()
+        self.assertEqual(self._armed(), [(600.0, 'log_metrics'),
+                                         (3600.0, 'housekeeping')])
+        # unchanged intervals keep their timer
+        self.assertTrue(self.proc._timers['housekeeping'][1] is
+                        housekeeping)
+
+        self._set_settings(metrics_interval='60',
+                           housekeeping_interval='0')
+        self.proc.arm_timers()
+        self.assertEqual(self._armed(), [(60.0, 'log_metrics')])
+        self.proc.arm_timers()
+        self.assertEqual(self._armed(), [(60.0, 'log_metrics')])
+
+
+def suite():
+    """The suite for test_postprocessor
+    """
+    loader = unittest.TestLoader()
+    mysuite = unittest.TestSuite()
+    mysuite.addTest(loader.loadTestsFromTestCase(TestDataProcessor))
+    mysuite.addTest(loader.loadTestsFromTestCase(TestPostProcessor))
+    mysuite.addTest(loader.loadTestsFromTestCase(TestSaveArguments))
+    mysuite.addTest(loader.loadTestsFromTestCase(TestTimeslot))
+
+    return mysuite
+
+if __name__ == "__main__":
+    unittest.TextTestRunner(verbosity=2).run(suite())
@@ -0,0 +1,159 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Unit testing for the product config cache
+"""
+
+import unittest
+import tempfile
+import shutil
+import os
+
+from dwd_extensions.trollduction.product_config import CONFIG_LAYOUT
+from dwd_extensions.trollduction.product_config import CONFIG_OUT_BOXES
+from dwd_extensions.trollduction.product_config import CONFIG_PARTS
+from dwd_extensions.trollduction.product_config import CONFIG_RULES
+from dwd_extensions.trollduction.product_config import CONFIG_SETTINGS
+from dwd_extensions.trollduction.product_config import ProductConfig
+from dwd_extensions.trollduction.product_config import ProductConfigCache
+from dwd_extensions.trollduction.product_config import config_changes
+
+
+def _raw_config():
+    return {'post_processing': {
+        'rrd_dir': '/tmp/rrd',
+        'out_box': [{'name': 'ninjo', 'output_dir': '/tmp/ninjo'},
+                    {'name': 'browser', 'output_dir': '/tmp/browser'}],
+        'rule': [{'input_pattern': 'A_.*', 'out_box_ref': 'ninjo'},
+                 {'input_pattern': 'B_.*', 'out_box_ref': 'browser'}],
+        'dataset_processor': {'msg_subject_pattern': '.*WORLDCOMP',
+                              'output_name': 'wcm'}}}
+
+
+class TestProductConfigCache(unittest.TestCase):
+    """Unit testing for ProductConfig and ProductConfigCache
+    """
+
+    def setUp(self):
+        """Setting up the testing
+        """
+        self.tempdir = tempfile.mkdtemp()
+        self.fname = os.path.join(self.tempdir, 'product_config.xml')
+        with open(self.fname, 'w') as fid:
+            fid.write('<product_config/>')
+        self.loads = []
+        self.raw = _raw_config()
+
+    def _loader(self, fname, config_item=None):
+        self.loads.append((fname, config_item))
+        return self.raw
+
+    def test_product_config(self):
+        """Test parsing of the post_processing section"""
+        config = ProductConfig(_raw_config(), self.tempdir)
+        self.assertEqual(config.rrd_dir, '/tmp/rrd')
+        self.assertEqual(sorted(config.out_boxes.keys()),
+                         ['browser', 'ninjo'])
+        self.assertEqual(len(config.rules), 2)
+        self.assertEqual(len(config.dataset_processors), 1)
+        self.assertEqual(config.dataset_processors[0]['output_name'], 'wcm')
+        self.assertRaises(AttributeError, setattr, config, 'rules', [])
+
+    def test_cache_hit(self):
+        """Test that an unchanged file is parsed only once"""
+        cache = ProductConfigCache(self._loader)
+        first = cache.get(self.fname, 'item')
+        second = cache.get(self.fname, 'item')
+        self.assertTrue(first is second)
+        self.assertEqual(len(self.loads), 1)
+        self.assertEqual(cache.stats(), {'hits': 1, 'reloads': 1})
+
+    def test_reload_on_invalidate(self):
+        """Test reload after invalidation by the config watcher"""
+        cache = ProductConfigCache(self._loader)
+        first = cache.get(self.fname, 'item')
+        cache.invalidate(self.fname, None)
+        second = cache.get(self.fname, 'item')
+        self.assertFalse(first is second)
+        self.assertEqual(cache.stats(), {'hits': 0, 'reloads': 2})
+
+    def test_reload_on_mtime_change(self):
+        """Test reload after modification of the file"""
+        cache = ProductConfigCache(self._loader)
+        cache.get(self.fname, 'item')
+        mtime = os.path.getmtime(self.fname)
+        os.utime(self.fname, (mtime + 10, mtime + 10))
+        cache.get(self.fname, 'item')
+        self.assertEqual(len(self.loads), 2)
+
+    def test_config_changes(self):
+        """Test the detection of the changed parts"""
+        old = ProductConfig(_raw_config(), self.tempdir)
+        self.assertEqual(config_changes(None, old), set(CONFIG_PARTS))
+        self.assertEqual(config_changes(old, old), set())
+        self.assertEqual(
+            config_changes(old, ProductConfig(_raw_config(), self.tempdir)),
+            set())
+
+        raw = _raw_config()
+        raw['post_processing']['rule'][1]['input_pattern'] = 'C_.*'
+        raw['post_processing']['writer_threads'] = '2'
+        self.assertEqual(
+            config_changes(old, ProductConfig(raw, self.tempdir)),
+            set([CONFIG_RULES, CONFIG_SETTINGS]))
+
+        raw = _raw_config()
+        raw['post_processing']['out_box'][0]['output_dir'] = '/tmp/other'
+        raw['layout'] = {'coast': 'true'}
+        self.assertEqual(
+            config_changes(old, ProductConfig(raw, self.tempdir)),
+            set([CONFIG_OUT_BOXES, CONFIG_LAYOUT]))
+
+    def test_reuse_on_reload(self):
+        """Test that unchanged parts are reused after a reload"""
+        cache = ProductConfigCache(self._loader)
+        first = cache.get(self.fname, 'item')
+        self.raw = _raw_config()
+        self.raw['post_processing']['writer_threads'] = '2'
+        cache.invalidate(self.fname, None)
+        second = cache.get(self.fname, 'item')
+        self.assertEqual(second.settings['writer_threads'], '2')
+        self.assertTrue(second.rule_index is first.rule_index)
+
+        self.raw = _raw_config()
+        self.raw['post_processing']['rule'][0]['input_pattern'] = 'C_.*'
+        cache.invalidate()
+        third = cache.get(self.fname, 'item')
+        self.assertFalse(third.rule_index is first.rule_index)
+        self.assertEqual(len(self.loads), 3)
+
+    def tearDown(self):
+        """Closing down
+        """
+        shutil.rmtree(self.tempdir)
+
+
+def suite():
+    """The suite for test_product_config
+    """
+    loader = unittest.TestLoader()
+    mysuite = unittest.TestSuite()
+    mysuite.addTest(loader.loadTestsFromTestCase(TestProductConfigCache))
+
+    return mysuite
+
+if __name__ == "__main__":
+    unittest.TextTestRunner(verbosity=2).run(suite())
@@ -0,0 +1,127 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Unit testing for publishing of output files
+"""
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from dwd_extensions.tools.publish import FSYNC_BATCH
+from dwd_extensions.tools.publish import FSYNC_DIR
+from dwd_extensions.tools.publish import commit_file
+from dwd_extensions.tools.publish import publish_file
+from dwd_extensions.tools.publish import save_args_key
+from dwd_extensions.tools.publish import sync_dirs
+from dwd_extensions.tools.publish import write_file
+
+
+class TestPublish(unittest.TestCase):
+    """Unit testing for publish functions
+    """
+
+    def setUp(self):
+        """Setting up the testing
+        """
+        self.tmp_dir = tempfile.mkdtemp()
+        self.src = os.path.join(self.tmp_dir, 'src.tif')
+        with open(self.src, 'w') as fid:
+            fid.write('data')
+
+    def tearDown(self):
+        """Cleaning up
+        """
+        shutil.rmtree(self.tmp_dir)
+
+    def test_save_args_key(self):
+        """Test that identical save arguments give the same key"""
+        args1 = {'fformat': 'tif', 'compression': 6,
+                 'gdal_options': {'predictor': '2'}}
+        args2 = dict(args1)
+        self.assertEqual(save_args_key(args1, '/a/x.tif'),
+                         save_args_key(args2, '/b/y.tif'))
+        args2['compression'] = 0
+        self.assertNotEqual(save_args_key(args1, '/a/x.tif'),
+                            save_args_key(args2, '/b/y.tif'))
+        self.assertNotEqual(save_args_key(args1, '/a/x.tif'),
+                            save_args_key(args1, '/a/x.png'))
+
+    def test_save_args_key_ninjotiff(self):
+        """Test that ninjotiff files of other file names differ"""
+        args = {'fformat': 'mpop.imageo.formats.ninjotiff',
+                'compression': 6, 'physic_unit': 'C',
+                'ch_min_measurement_unit': [1, 2],
+                'omit_filename_path': True}
+        self.assertEqual(save_args_key(args, '/a/x.tif'),
+                         save_args_key(dict(args), '/b/x.tif'))
+        self.assertNotEqual(save_args_key(args, '/a/x.tif'),
+                            save_args_key(args, '/a/y.tif'))
+        args['omit_filename_path'] = False
+        self.assertNotEqual(save_args_key(args, '/a/x.tif'),
+                            save_args_key(args, '/b/x.tif'))
+
+    def test_publish_link(self):
+        """Test publishing as hardlink"""
+        dest = os.path.join(self.tmp_dir, 'out', 'dest.tif')
+        self.assertTrue(publish_file(self.src, dest))
+        self.assertEqual(os.stat(dest).st_ino, os.stat(self.src).st_ino)
+        self.assertEqual(os.listdir(os.path.dirname(dest)), ['dest.tif'])
+
+    def test_publish_copy(self):
+        """Test publishing as copy"""
+        dest = os.path.join(self.tmp_dir, 'dest.tif')
+        self.assertFalse(publish_file(self.src, dest, link=False))
+        self.assertNotEqual(os.stat(dest).st_ino, os.stat(self.src).st_ino)
+        with open(dest) as fid:
+            self.assertEqual(fid.read(), 'data')
+
+    def test_commit_file(self):
+        """Test committing with fsync policies"""
+        dest = os.path.join(self.tmp_dir, 'dest.tif')
+        for policy in ('none', 'file', FSYNC_DIR, FSYNC_BATCH):
+            tmp = os.path.join(self.tmp_dir, '.dest.tif')
+            shutil.copy(self.src, tmp)
+            commit_file(tmp, dest, policy)
+            self.assertFalse(os.path.exists(tmp))
+            self.assertTrue(os.path.exists(dest))
+        sync_dirs([self.tmp_dir, self.tmp_dir])
+        self.assertRaises(ValueError, commit_file, self.src, dest, 'always')
+
+    def test_write_file(self):
+        """Test atomic writing of a small file"""
+        dest = os.path.join(self.tmp_dir, 'cache.txt')
+        write_file(dest, 'one', mode=0644)
+        write_file(dest, 'two', mode=0644)
+        with open(dest) as fid:
+            self.assertEqual(fid.read(), 'two')
+        self.assertEqual(os.stat(dest).st_mode & 0777, 0644)
+        self.assertEqual(sorted(os.listdir(self.tmp_dir)),
+                         ['cache.txt', 'src.tif'])
+
+
+def suite():
+    """The suite for test_publish
+    """
+    loader = unittest.TestLoader()
+    mysuite = unittest.TestSuite()
+    mysuite.addTest(loader.loadTestsFromTestCase(TestPublish))
+
+    return mysuite
+
+if __name__ == "__main__":
+    unittest.TextTestRunner(verbosity=2).run(suite())
@@ -0,0 +1,156 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Unit testing for the 8 bit quantized GeoImage
+"""
+
+import copy
+import os
+import shutil
+import tempfile
+import unittest
+from datetime import datetime
+
+import numpy as np
+from PIL import Image
+from mpop.imageo.formats import ninjotiff
+from mpop.imageo.geo_image import GeoImage
+
+from dwd_extensions.mpop.composites import quantized_images_setting
+from dwd_extensions.mpop.quantized_image import QuantizedImage
+from dwd_extensions.mpop.quantized_image import ninjotiff_data
+
+TIME_SLOT = datetime(2016, 1, 1)
+
+
+def _finalized(img, dtype=np.uint8):
+    return img._finalize(dtype)[0][0]
+
+
+class TestQuantizedImage(unittest.TestCase):
+    """Unit testing for QuantizedImage
+    """
+
+    def setUp(self):
+        """Setting up the testing
+        """
+        np.random.seed(0)
+        self.data = np.ma.array(np.random.uniform(-90, 40, (150, 80)))
+        self.data[10:20] = np.ma.masked
+
+    def test_like_geo_image(self):
+        """Test that the 8 bit values are those of a GeoImage"""
+        for crange, inverse in (((40, -87.5), False), ((-90, 50), True)):
+            geo_img = GeoImage(self.data.copy(), None, TIME_SLOT,
+                               crange=crange, fill_value=0)
+            geo_img.enhance(inverse=inverse)
+            img = QuantizedImage(self.data, None, TIME_SLOT, crange=crange,
+                                 fill_value=0, inverse=inverse)
+            self.assertEqual(img.channels[0].dtype, np.uint8)
+            expected = _finalized(geo_img)
+            result = _finalized(img)
+            self.assertTrue((result.mask == expected.mask).all())
+            self.assertTrue((result.filled(0) == expected.filled(0)).all())
+
+        # gamma through the lookup table, at most 1 off
+        geo_img = GeoImage(self.data.copy(), None, TIME_SLOT,
+                           crange=(-90, 40), fill_value=0)
+        geo_img.enhance(gamma=2.5)
+        img = QuantizedImage(self.data, None, TIME_SLOT, crange=(-90, 40),
+                             fill_value=0, gamma=2.5)
+        diff = _finalized(img).astype(int) - _finalized(geo_img)
+        self.assertTrue(np.abs(diff).max() <= 1)
+
+    def test_uint8_channels(self):
+        """Test 8 bit channels, enhancement and conversion"""
+        data = np.arange(256, dtype=np.uint8).reshape((16, 16))
+        img = QuantizedImage((data, data, data), None, TIME_SLOT,
+                             mode='RGB', fill_value=(0, 0, 0))
+        self.assertTrue((_finalized(img) == data).all())
+        self.assertTrue((_finalized(img, np.uint16) ==
+                         data.astype(np.uint16) * 257).all())
+
+        geo_img = img.to_geo_image()
+        self.assertEqual(geo_img.mode, 'RGB')
+        self.assertTrue((_finalized(geo_img) == data).all())
+
+        geo_img.enhance(inverse=(True, False, False), gamma=1.5)
+        img.enhance(inverse=(True, False, False), gamma=1.5)
+        for idx in range(3):
+            self.assertTrue((img._finalize()[0][idx] ==
+                             geo_img._finalize()[0][idx]).all())
+        self.assertRaises(ValueError, img.enhance, stretch='linear')
+        self.assertRaises(ValueError, QuantizedImage, data, None,
+                          TIME_SLOT, mode='P')
+
+    def test_ninjotiff_data(self):
+        """Test the ninjotiff data of single channel images"""
+        data = np.ma.array(np.random.randint(0, 256, (40, 30)),
+                           dtype=np.uint8)
+        data[5:7] = np.ma.masked
+        img = QuantizedImage(data, None, TIME_SLOT, fill_value=0)
+        for dtype in (np.uint8, np.uint16):
+            expected = ninjotiff._finalize(copy.deepcopy(img.to_geo_image()),
+                                           dtype, (40., -87.5))
+            result = ninjotiff_data(img, dtype, (40., -87.5))
+            self.assertTrue((result[0] == np.asarray(expected[0])).all())
+            self.assertAlmostEqual(result[1], expected[1])
+            self.assertAlmostEqual(result[2], expected[2])
+
+    def test_save(self):
+        """Test saving without a float copy"""
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            fname = os.path.join(tmp_dir, 'test.png')
+            img = QuantizedImage(self.data, None, TIME_SLOT,
+                                 crange=(-90, 40))
+            img.save(fname)
+            saved = np.array(Image.open(fname))
+            self.assertTrue((saved[..., 0] == img.channels[0].filled(0))
+                            .all())
+            self.assertTrue((saved[10:20, :, 1] == 0).all())
+            self.assertTrue((saved[20:, :, 1] == 255).all())
+        finally:
+            shutil.rmtree(tmp_dir)
+
+    def test_quantized_images_setting(self):
+        """Test the quantized_images option of mpop.cfg"""
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            fname = os.path.join(tmp_dir, 'mpop.cfg')
+            self.assertFalse(quantized_images_setting(fname))
+            for value, expected in (('true', True), ('false', False),
+                                    ('maybe', False)):
+                with open(fname, 'w') as fid:
+                    fid.write('[composites]\n'
+                              'module = dwd_extensions.mpop.composites\n'
+                              'quantized_images = %s\n' % value)
+                self.assertEqual(quantized_images_setting(fname), expected)
+        finally:
+            shutil.rmtree(tmp_dir)
+
+
+def suite():
+    """The suite for test_quantized_image
+    """
+    loader = unittest.TestLoader()
+    mysuite = unittest.TestSuite()
+    mysuite.addTest(loader.loadTestsFromTestCase(TestQuantizedImage))
+
+    return mysuite
+
+if __name__ == "__main__":
+    unittest.TextTestRunner(verbosity=2).run(suite())
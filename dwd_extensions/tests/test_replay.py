@@ -0,0 +1,275 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Unit testing for the offline replay of postprocessor messages
+"""
+
+import json
+import os
+import shutil
+import tempfile
+import unittest
+from datetime import datetime
+
+from posttroll.message import Message
+
+from dwd_extensions.tools.instrumentation import Histogram
+from dwd_extensions.trollduction.product_config import ProductConfig
+from dwd_extensions.trollduction.replay import format_action
+from dwd_extensions.trollduction.replay import format_report
+from dwd_extensions.trollduction.replay import generate_messages
+from dwd_extensions.trollduction.replay import load_messages
+from dwd_extensions.trollduction.replay import plan
+
+
+def fail_image(msg, params):
+    '''Dataset processor failing, it is never called by a plan
+    '''
+    raise AssertionError('dataset processor called')
+
+
+def _summary(*values):
+    hist = Histogram()
+    for value in values:
+        hist.add(value)
+    return hist.to_dict()
+
+
+class TestReplay(unittest.TestCase):
+    """Unit testing for loading, generating and reporting replays
+    """
+
+    def setUp(self):
+        """Setting up the testing
+        """
+        self.tmp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        """Cleaning up
+        """
+        shutil.rmtree(self.tmp_dir)
+
+    def test_load_messages(self):
+        """Test reading recorded messages, skipping comments and blank
+        lines"""
+        data = {'uri': '/data/IR_108_ccs4.tif', 'product_name': 'IR_108',
+                'time': datetime(2016, 1, 1, 12)}
+        fname = os.path.join(self.tmp_dir, 'messages.log')
+        with open(fname, 'w') as fid:
+            fid.write('# recorded messages\n\n')
+            fid.write(Message('/test', 'file', data).encode() + '\n')
+            fid.write(Message('/other', 'dataset', {}).encode() + '\n')
+        messages = load_messages(fname)
+        self.assertEqual([(msg.subject, msg.type) for msg in messages],
+                         [('/test', 'file'), ('/other', 'dataset')])
+        self.assertEqual(messages[0].data, data)
+
+    def test_generate_messages(self):
+        """Test the messages generated from a directory of images"""
+        pattern = '{product_name}_{area_name}_{time:%Y%m%d%H%M}.tif'
+        for name in ('VIS006_euro4_201601011215.tif',
+                     'IR108_ccs4_201601011200.tif',
+                     'IR108_ccs4_201601011215.tif',
+                     'README'):
+            open(os.path.join(self.tmp_dir, name), 'w').close()
+        messages = generate_messages(self.tmp_dir, pattern, topic='/replay')
+        self.assertEqual([os.path.basename(msg.data['uri'])
+                          for msg in messages],
+                         ['IR108_ccs4_201601011200.tif',
+                          'IR108_ccs4_201601011215.tif',
+                          'VIS006_euro4_201601011215.tif'])
+        msg = messages[0]
+        self.assertEqual((msg.subject, msg.type), ('/replay', 'file'))
+        self.assertEqual(msg.time, datetime(2016, 1, 1, 12))
+        self.assertEqual(msg.data['uri'], os.path.join(
+            os.path.abspath(self.tmp_dir), 'IR108_ccs4_201601011200.tif'))
+        self.assertEqual(msg.data['source_uri'], msg.data['uri'])
+        self.assertEqual(msg.data['product_name'], 'IR108')
+        self.assertEqual(msg.data['area'], {'name': 'ccs4'})
+
+        # area of the messages if the pattern has none
+        messages = generate_messages(self.tmp_dir,
+                                     '{productname}_ccs4_{time}.tif',
+                                     area='ccs4')
+        self.assertEqual(len(messages), 2)
+        self.assertEqual(messages[0].data['area'], {'name': 'ccs4'})
+        self.assertEqual(messages[0].data['product_name'], 'IR108')
+
+    def test_format_report(self):
+        """Test the text of a replay report"""
+        report = {'messages': 10,
+                  'seconds': 4.0,
+                  'messages_per_second': 2.5,
+                  'peak_rss_kb': 2048,
+                  'peak_rss_children_kb': 1024,
+                  'stages': {'save': _summary(0.5, 1.5),
+                             'decode': _summary(0.25)},
+                  'queue_wait': {'file': _summary(0.002)},
+                  'memory': {'budget_mbytes': 512.0, 'used_mbytes': 0.0,
+                             'peak_mbytes': 100.5, 'waits': 2,
+                             'wait_seconds': 1.25},
+                  'shards': {1: {'stages': {'save': _summary(1.0)}},
+                             0: {}}}
+        lines = format_report(report).split('\n')
+        self.assertEqual(lines[:3], [
+            'messages: 10 in 4.0 s (2.50 msg/s)',
+            'peak rss: 2.0 MB (children 1.0 MB)',
+            'images in flight: peak 100.5 MB (budget 512 MB), '
+            '2 waits for 1.2 s'])
+        self.assertEqual(lines[3].split(),
+                         ['stage', 'count', 'mean', 'p50', 'p90', 'p99'])
+        self.assertEqual([line.split()[:3] for line in lines[4:]],
+                         [['decode', '1', '0.250'],
+                          ['queue_wait[file]', '1', '0.002'],
+                          ['save', '2', '1.000'],
+                          ['save[1]', '1', '1.000']])
+
+        # report of a plan, without memory, shards and queue waits
+        plans, report = plan(None, [])
+        self.assertEqual(plans, [])
+        self.assertEqual(sorted(report),
+                         ['decodes', 'messages', 'messages_per_second',
+                          'outputs', 'peak_rss_children_kb', 'peak_rss_kb',
+                          'seconds', 'stages'])
+        lines = format_report(report).split('\n')
+        self.assertEqual(lines[0], 'messages: 0 in %.1f s (%.2f msg/s)' %
+                         (report['seconds'], 0))
+        self.assertTrue(lines[1].startswith('peak rss: '))
+        self.assertEqual(len(lines), 3)
+
+
+class TestPlan(unittest.TestCase):
+    """Unit testing for planning the processing of messages
+    """
+
+    def setUp(self):
+        """Setting up the testing
+        """
+        self.tmp_dir = tempfile.mkdtemp()
+        dest = '{productname}_{areaname}_{time_eos:%Y%m%d%H%M}.tif'
+        rules = [{'input_pattern': 'IR_108_.*', 'out_box_ref': 'a',
+                  'dest_filename': dest, 'format': 'tif'},
+                 {'input_pattern': 'IR_108_.*', 'out_box_ref': 'b',
+                  'dest_filename': dest, 'format': 'tif'},
+                 {'input_pattern': 'IR_108_.*', 'out_box_ref': 'a',
+                  'dest_filename': 'copy_{areaname}.tif',
+                  'copySrcFileOnly': 'true'},
+                 {'input_pattern': 'VIS006_.*', 'out_box_ref': 'a',
+                  'dest_filename': dest, 'format': 'tif'},
+                 {'input_pattern': 'wcm', 'out_box_ref': 'b',
+                  'dest_filename': 'wcm.png', 'format': 'png'}]
+        self.config = ProductConfig({'post_processing': {
+            'rrd_dir': os.path.join(self.tmp_dir, 'rrd'),
+            'out_box': [{'name': name,
+                         'output_dir': os.path.join(self.tmp_dir, name)}
+                        for name in ('a', 'b')],
+            'rule': rules,
+            'dataset_processor': {
+                'msg_subject_pattern': '.*WORLDCOMP',
+                'output_name': 'wcm',
+                'processing_function':
+                'dwd_extensions.tests.test_replay|fail_image'}}},
+            self.tmp_dir)
+
+    def tearDown(self):
+        """Cleaning up
+        """
+        shutil.rmtree(self.tmp_dir)
+
+    def test_plan(self):
+        """Test the planned actions, without reading or writing files"""
+        uri = os.path.join(self.tmp_dir, 'missing', 'IR_108_ccs4.tif')
+        messages = [
+            Message('/test', 'file',
+                    {'uri': uri, 'product_name': 'IR_108',
+                     'area': {'name': 'ccs4'},
+                     'time': datetime(2016, 1, 1, 12)}),
+            Message('/WORLDCOMP', 'dataset',
+                    {'product_name': 'WCM', 'area': {'name': 'world'},
+                     'time': datetime(2016, 1, 1, 12)})]
+        plans, report = plan(self.config, messages)
+
+        self.assertEqual([msg for msg, _ in plans], messages)
+        actions = plans[0][1]
+        first = os.path.join(self.tmp_dir, 'a',
+                             'IR_108_ccs4_201601011215.tif')
+        self.assertEqual([action['dest_filename'] for action in actions],
+                         [first,
+                          os.path.join(self.tmp_dir, 'b',
+                                       'IR_108_ccs4_201601011215.tif'),
+                          os.path.join(self.tmp_dir, 'a',
+                                       'copy_ccs4.tif')])
+        self.assertEqual([action['decode'] for action in actions],
+                         [True, True, False])
+        # identical outputs are encoded once
+        self.assertEqual([action['encoded_by'] for action in actions],
+                         [first, first, actions[2]['dest_filename']])
+        self.assertEqual(actions[2]['save_arguments'], None)
+        self.assertEqual(actions[0]['rrd_filename'], os.path.join(
+            self.tmp_dir, 'rrd', 'IR_108_ccs4_xx.tif.rrd'))
+
+        # the dataset processor is not called
+        actions = plans[1][1]
+        self.assertEqual(len(actions), 1)
+        self.assertTrue(actions[0]['decode'])
+        self.assertEqual(actions[0]['dataset_processor'], 'wcm')
+        self.assertEqual(actions[0]['encoded_by'],
+                         os.path.join(self.tmp_dir, 'b', 'wcm.png'))
+
+        # no output directory or rrd file is created
+        self.assertEqual(os.listdir(self.tmp_dir), [])
+        self.assertEqual(report['messages'], 2)
+        self.assertEqual(report['outputs'], 4)
+        self.assertEqual(report['decodes'], 2)
+        self.assertTrue('rule_matching' in report['stages'])
+
+    def test_format_action(self):
+        """Test the JSON serializable planned actions"""
+        uri = os.path.join(self.tmp_dir, 'VIS006_ccs4.tif')
+        msg = Message('/test', 'file',
+                      {'uri': uri, 'product_name': 'VIS006',
+                       'area': {'name': 'ccs4'},
+                       'time': datetime(2016, 1, 1, 12)})
+        plans, _ = plan(self.config, [msg])
+        actions = [format_action(msg, action) for action in plans[0][1]]
+        dest_filename = os.path.join(self.tmp_dir, 'a',
+                                     'VIS006_ccs4_201601011215.tif')
+        self.assertEqual(json.loads(json.dumps(actions)), [
+            {'message': uri,
+             'out_box': 'a',
+             'dest_filename': dest_filename,
+             'rrd_filename': os.path.join(self.tmp_dir, 'rrd',
+                                          'VIS006_ccs4_xx.tif.rrd'),
+             'timeslot': '2016-01-01T12:15:00',
+             'decode': True,
+             'dataset_processor': None,
+             'encoded_by': dest_filename,
+             'save_arguments': actions[0]['save_arguments']}])
+        self.assertEqual(actions[0]['save_arguments']['fformat'], 'tif')
+
+
+def suite():
+    """The suite for test_replay
+    """
+    loader = unittest.TestLoader()
+    mysuite = unittest.TestSuite()
+    mysuite.addTest(loader.loadTestsFromTestCase(TestReplay))
+    mysuite.addTest(loader.loadTestsFromTestCase(TestPlan))
+
+    return mysuite
+
+if __name__ == "__main__":
+    unittest.TextTestRunner(verbosity=2).run(suite())
@@ -0,0 +1,148 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Unit testing for the asynchronous rrd sink
+"""
+
+import os
+import shutil
+import socket
+import tempfile
+import threading
+import unittest
+
+from dwd_extensions.tools.instrumentation import get_instrumentation
+from dwd_extensions.tools.rrd_utils import RrdSink
+
+
+class FakeRrdCached(threading.Thread):
+    """Stand-in for rrdcached answering BATCH requests on a unix socket.
+    CREATE commands of already known files fail.
+    """
+
+    def __init__(self, address):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.commands = []
+        self.known = set()
+        self.server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.server.bind(address)
+        self.server.listen(1)
+
+    def run(self):
+        conn, _ = self.server.accept()
+        reader = conn.makefile('r')
+        while True:
+            line = reader.readline()
+            if not line:
+                break
+            if line.strip() != 'BATCH':
+                continue
+            conn.sendall('0 Go ahead.  Send commands.\n')
+            errors = []
+            idx = 0
+            while True:
+                line = reader.readline().strip()
+                if line == '.':
+                    break
+                idx += 1
+                self.commands.append(line)
+                cmd, fname = line.split()[:2]
+                if cmd == 'CREATE':
+                    if fname in self.known:
+                        errors.append('%d RRD Error: file exists' % idx)
+                    self.known.add(fname)
+            conn.sendall('%d errors\n' % len(errors) +
+                         ''.join(err + '\n' for err in errors))
+        conn.close()
+
+
+class TestRrdSink(unittest.TestCase):
+    """Unit testing for RrdSink
+    """
+
+    def setUp(self):
+        """Setting up the testing
+        """
+        self.tmp_dir = tempfile.mkdtemp()
+        self.address = os.path.join(self.tmp_dir, 'rrdcached.sock')
+        self.daemon = FakeRrdCached(self.address)
+        self.daemon.known.add('/rrd/b.rrd')
+        self.daemon.start()
+
+    def tearDown(self):
+        """Cleaning up
+        """
+        self.daemon.server.close()
+        shutil.rmtree(self.tmp_dir)
+
+    def test_batch_to_daemon(self):
+        """Test coalescing and batching of updates sent to rrdcached"""
+        get_instrumentation().reset()
+        sink = RrdSink(flush_interval=60,
+                       daemon_address='unix:' + self.address)
+        sink.submit('/rrd/a.rrd', 900, 1800, 1000, 2000)
+        sink.submit('/rrd/a.rrd', 900, 900, 500, 1000)
+        sink.submit('/rrd/a.rrd', 900, 900, 600, 1100)
+        sink.submit('/rrd/b.rrd', 900, 900, 500, 1000)
+        self.assertTrue(sink.flush(5))
+
+        commands = self.daemon.commands
+        self.assertEqual([cmd.split()[:2] for cmd in commands],
+                         [['CREATE', '/rrd/a.rrd'],
+                          ['UPDATE', '/rrd/a.rrd'],
+                          ['CREATE', '/rrd/b.rrd'],
+                          ['UPDATE', '/rrd/b.rrd']])
+        self.assertTrue('-b 0 -O' in commands[0])
+        self.assertEqual(commands[1],
+                         'UPDATE /rrd/a.rrd 900:500:100 1800:1000:200')
+        stats = sink.stats()
+        self.assertEqual(stats['coalesced'], 1)
+        self.assertEqual(stats['written'], 3)
+        self.assertEqual(stats['errors'], 0)
+        # the batch write is timed
+        self.assertEqual(
+            get_instrumentation().stage_totals()['rrd_flush']['count'], 1)
+
+        # files are created only once
+        sink.submit('/rrd/a.rrd', 900, 2700, 2000, 3000)
+        self.assertTrue(sink.flush(5))
+        self.assertEqual(self.daemon.commands[-1],
+                         'UPDATE /rrd/a.rrd 2700:1000:300')
+        self.assertEqual(len(self.daemon.commands), 5)
+        sink.stop()
+
+    def test_unreachable_daemon(self):
+        """Test that updates are kept if rrdcached is not reachable"""
+        sink = RrdSink(flush_interval=60,
+                       daemon_address=os.path.join(self.tmp_dir, 'none'))
+        sink.submit('/rrd/a.rrd', 900, 900, 500, 1000)
+        self.assertFalse(sink.flush(0.5))
+        self.assertEqual(sink.stats()['pending'], 1)
+        sink.stop(0)
+
+
+def suite():
+    """The suite for test_rrd_sink
+    """
+    loader = unittest.TestLoader()
+    mysuite = unittest.TestSuite()
+    mysuite.addTest(loader.loadTestsFromTestCase(TestRrdSink))
+
+    return mysuite
+
+if __name__ == "__main__":
+    unittest.TextTestRunner(verbosity=2).run(suite())
@@ -0,0 +1,142 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Unit testing for the compiled rule index
+"""
+
+import copy
+import re
+import unittest
+
+from dwd_extensions.trollduction.rule_index import RuleIndex
+from dwd_extensions.trollduction.rule_index import literal_prefix
+
+RULES = [
+    {'input_pattern': 'METEOSAT_AFRIKA_EUROPA_((HRV)|(VIS006))_.*km_.*',
+     'rule_group': 'ninjo', 'out_box_ref': 'ninjo'},
+    {'input_pattern': 'METEOSAT_AFRIKA_EUROPA_NIR016_nq0003km_*.*',
+     'rule_group': 'ninjo', 'out_box_ref': 'ninjo'},
+    {'input_pattern': 'METEOSAT_AFRIKA_EUROPA_.*',
+     'rule_group': 'ninjo', 'out_box_ref': 'ninjo'},
+    {'input_pattern': 'METEOSAT_AFRIKA_EUROPA_IR108_nq0003km_.*',
+     'out_box_ref': 'browser', 'copySrcFileOnly': 'true'},
+    {'input_pattern': 'worldcomposite_ir_only',
+     'out_box_ref': 'worldcomposite_ninjo'},
+    {'input_pattern': 'Warnapp|METEOSAT_.*',
+     'out_box_ref': 'warnapp'},
+]
+
+
+def _naive_match(rules, filename):
+    res = []
+    groups = set()
+    for rule in rules:
+        if re.match(rule['input_pattern'], filename):
+            if 'rule_group' in rule:
+                if rule['rule_group'] in groups:
+                    continue
+                groups.add(rule['rule_group'])
+            res.append(rule)
+    return res
+
+
+class TestRuleIndex(unittest.TestCase):
+    """Unit testing for RuleIndex
+    """
+
+    def test_literal_prefix(self):
+        """Test literal prefix extraction"""
+        self.assertEqual(literal_prefix('METEOSAT_(A|B)_.*'), 'METEOSAT_')
+        self.assertEqual(literal_prefix('ABC_*.*'), 'ABC')
+        self.assertEqual(literal_prefix('AB{2}'), 'A')
+        self.assertEqual(literal_prefix('A|B'), '')
+        self.assertEqual(literal_prefix('(?i)abc'), '')
+        self.assertEqual(literal_prefix('[|]abc'), '')
+        self.assertEqual(literal_prefix('worldcomposite_ir_only'),
+                         'worldcomposite_ir_only')
+
+    def test_match_same_as_naive(self):
+        """Test that the index matches like the sequential rule check"""
+        index = RuleIndex(RULES)
+        for filename in [
+                'METEOSAT_AFRIKA_EUROPA_HRV_nq0001km_201701010000.tif',
+                'METEOSAT_AFRIKA_EUROPA_NIR016_nq0003km_201701010000.tif',
+                'METEOSAT_AFRIKA_EUROPA_IR108_nq0003km_201701010000.tif',
+                'METEOSAT_EUROPA_ZENTRAL_HRV_nqceur1km_201701010000.tif',
+                'Warnapp_201701010000.tif',
+                'worldcomposite_ir_only',
+                'worldcomposite',
+                '']:
+            self.assertEqual(index.match(filename),
+                             _naive_match(RULES, filename))
+
+    def test_memo(self):
+        """Test the memo of filename signatures"""
+        index = RuleIndex(RULES, signature_pattern=r'\d{12}')
+        first = index.match(
+            'METEOSAT_AFRIKA_EUROPA_IR108_nq0003km_201701010000.tif')
+        second = index.match(
+            'METEOSAT_AFRIKA_EUROPA_IR108_nq0003km_201701010015.tif')
+        self.assertEqual(first, second)
+        self.assertEqual(index.stats()['hits'], 1)
+        self.assertEqual(index.stats()['misses'], 1)
+
+        # without signature pattern nothing is memorized
+        index = RuleIndex(RULES)
+        for minute in range(3):
+            index.match('METEOSAT_AFRIKA_EUROPA_IR108_nq0003km_2017010100'
+                        '%02d.tif' % minute)
+        self.assertEqual(index.stats()['hits'], 0)
+        self.assertEqual(index.stats()['misses'], 0)
+        self.assertEqual(len(index._memo), 0)
+
+    def test_copy_src_file_only(self):
+        """Test the precomputed copySrcFileOnly flag"""
+        index = RuleIndex(RULES)
+        self.assertFalse(index.is_copy_src_file_only(RULES[0]))
+        self.assertTrue(index.is_copy_src_file_only(RULES[3]))
+        # equal rules of a reloaded config
+        rules = copy.deepcopy(RULES)
+        self.assertEqual(index.position(rules[3]), 3)
+        self.assertTrue(index.is_copy_src_file_only(rules[3]))
+        self.assertTrue(index.position({'input_pattern': 'x'}) is None)
+        self.assertTrue(index.is_copy_src_file_only(
+            {'input_pattern': 'x', 'copySrcFileOnly': 'true'}))
+
+    def test_dataset_processor(self):
+        """Test dataset processor lookup by message subject"""
+        ds_procs = [{'msg_subject_pattern': '.*WORLDCOMP/IRONLY',
+                     'output_name': 'worldcomposite_ir_only'},
+                    {'msg_subject_pattern': '.*WORLDCOMP/IRVIS',
+                     'output_name': 'worldcomposite_irvis'}]
+        index = RuleIndex(RULES, ds_procs)
+        self.assertEqual(
+            index.match_dataset_processor('/a/WORLDCOMP/IRVIS'),
+            ds_procs[1])
+        self.assertTrue(index.match_dataset_processor('/a/b') is None)
+
+
+def suite():
+    """The suite for test_rule_index
+    """
+    loader = unittest.TestLoader()
+    mysuite = unittest.TestSuite()
+    mysuite.addTest(loader.loadTestsFromTestCase(TestRuleIndex))
+
+    return mysuite
+
+if __name__ == "__main__":
+    unittest.TextTestRunner(verbosity=2).run(suite())
@@ -0,0 +1,146 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Unit testing for the message scheduler
+"""
+
+import Queue
+import unittest
+from datetime import datetime
+
+from dwd_extensions.trollduction.scheduler import MessageScheduler
+from dwd_extensions.trollduction.scheduler import SchedulingClass
+from dwd_extensions.trollduction.scheduler import to_epoch
+
+WARNAPP = SchedulingClass('warnapp', 0, 300)
+BROWSER = SchedulingClass('browser', 2)
+
+
+class TestScheduler(unittest.TestCase):
+    """Unit testing for MessageScheduler
+    """
+
+    def setUp(self):
+        """Setting up the testing
+        """
+        self.time_eos = datetime(2017, 1, 1, 12, 15)
+        self.now = to_epoch(self.time_eos) + 60
+
+    def _get_all(self, scheduler):
+        items = []
+        while scheduler.qsize():
+            items.append(scheduler.get(False))
+        return items
+
+    def test_fifo_without_classes(self):
+        """Test that messages without class keep their order"""
+        scheduler = MessageScheduler()
+        for idx in range(5):
+            scheduler.put(idx, now=self.now + idx)
+        self.assertEqual(self._get_all(scheduler), range(5))
+        self.assertRaises(Queue.Empty, scheduler.get, True, 0.01)
+
+    def test_deadline_first(self):
+        """Test that messages with deadline overtake a burst"""
+        scheduler = MessageScheduler(aging=300)
+        for idx in range(3):
+            scheduler.put('browser%d' % idx, [BROWSER], self.time_eos,
+                          now=self.now)
+        scheduler.put('warnapp', [WARNAPP], self.time_eos,
+                      now=self.now + 1)
+        self.assertEqual(self._get_all(scheduler),
+                         ['warnapp', 'browser0', 'browser1', 'browser2'])
+        self.assertEqual(sorted(scheduler.stats()), ['browser', 'warnapp'])
+
+    def test_aging(self):
+        """Test that old low priority messages are not starved"""
+        scheduler = MessageScheduler(aging=10)
+        scheduler.put('old', [BROWSER], now=self.now)
+        scheduler.put('new', [SchedulingClass()], now=self.now + 25)
+        self.assertEqual(self._get_all(scheduler), ['old', 'new'])
+
+    def test_most_urgent_class(self):
+        """Test that the most urgent class of the rules is used"""
+        scheduler = MessageScheduler(aging=300)
+        scheduler.put('other', now=self.now)
+        scheduler.put('both', [BROWSER, WARNAPP], self.time_eos,
+                      now=self.now + 1)
+        self.assertEqual(self._get_all(scheduler), ['both', 'other'])
+
+    def test_coalesce_drop(self):
+        """Test dropping superseded timeslots under overload"""
+        scheduler = MessageScheduler(aging=300)
+        browser = SchedulingClass('browser', 2, coalesce='drop',
+                                  coalesce_queue=2)
+        ninjo = SchedulingClass('ninjo', 1)
+        key = ('IR_108', 'euro')
+        for minute in (0, 15, 30):
+            time_eos = datetime(2017, 1, 1, 12, minute)
+            scheduler.put('browser%d' % minute, [browser], time_eos,
+                          now=self.now + minute, key=key)
+            scheduler.put('ninjo%d' % minute, [ninjo], time_eos,
+                          now=self.now + minute, key=('ninjo',) + key)
+            scheduler.put('both%d' % minute, [ninjo, browser], time_eos,
+                          now=self.now + minute, key=('both',) + key)
+        items = self._get_all(scheduler)
+        self.assertEqual([item for item in items
+                          if item.startswith('browser')],
+                         ['browser30'])
+        self.assertEqual(len(items), 7)
+        self.assertEqual(scheduler.coalesce_stats(),
+                         {'browser': {'drop': 2, 'defer': 0}})
+
+    def test_coalesce_below_threshold(self):
+        """Test that nothing is coalesced without overload"""
+        scheduler = MessageScheduler(aging=300)
+        browser = SchedulingClass('browser', 2, coalesce='drop',
+                                  coalesce_age=600)
+        for minute in (0, 15):
+            scheduler.put(minute, [browser], datetime(2017, 1, 1, 12, minute),
+                          now=self.now + minute, key='IR_108')
+        self.assertEqual(self._get_all(scheduler), [0, 15])
+
+    def test_coalesce_defer(self):
+        """Test deferring superseded timeslots"""
+        scheduler = MessageScheduler(aging=300)
+        browser = SchedulingClass('browser', 0, coalesce='defer')
+        for minute in (0, 15):
+            scheduler.put(minute, [browser], datetime(2017, 1, 1, 12, minute),
+                          now=self.now + minute, key='IR_108')
+        scheduler.put('other', now=self.now + 100)
+        self.assertEqual(self._get_all(scheduler), [15, 'other', 0])
+
+    def test_from_config(self):
+        """Test creation from rule and out_box config"""
+        sched_class = SchedulingClass.from_config(
+            {'priority': '1'}, {'priority_class': 'warnapp',
+                                'priority': '0', 'deadline': '300'})
+        self.assertEqual(sched_class.name, 'warnapp')
+        self.assertEqual(sched_class.priority, 1)
+        self.assertEqual(sched_class.deadline, 300)
+
+
+def suite():
+    """The suite for test_scheduler
+    """
+    loader = unittest.TestLoader()
+    mysuite = unittest.TestSuite()
+    mysuite.addTest(loader.loadTestsFromTestCase(TestScheduler))
+
+    return mysuite
+
+if __name__ == "__main__":
+    unittest.TextTestRunner(verbosity=2).run(suite())
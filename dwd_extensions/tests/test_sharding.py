@@ -0,0 +1,220 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Unit testing for the process sharded postprocessor
+"""
+
+import Queue
+import logging
+import multiprocessing
+import threading
+import time
+import unittest
+
+from dwd_extensions.trollduction.data_writer import MemoryBudget
+from dwd_extensions.trollduction.sharding import ROUTE_BY_AREA
+from dwd_extensions.trollduction.sharding import ROUTE_BY_PRODUCT
+from dwd_extensions.trollduction.sharding import ROUTE_BY_URI
+from dwd_extensions.trollduction.sharding import ShardedPostProcessor
+from dwd_extensions.trollduction.sharding import shard_index
+from dwd_extensions.trollduction.sharding import shard_key
+
+
+class _Message(object):
+
+    """Stand-in for a posttroll message
+    """
+
+    def __init__(self, data, msg_type='file', subject='/test'):
+        self.type = msg_type
+        self.subject = subject
+        self.data = data
+
+
+def _message(area, product='IR_108'):
+    return _Message({'uri': '/data/%s_%s.tif' % (product, area),
+                     'product_name': product, 'area': {'name': area}})
+
+
+def _post_processor(num_shards, route_by=ROUTE_BY_AREA, max_queued=10):
+    '''Return a ShardedPostProcessor with in-process queues instead of
+    worker processes
+    '''
+    proc = ShardedPostProcessor.__new__(ShardedPostProcessor)
+    proc.num_shards = num_shards
+    proc.route_by = route_by
+    proc.max_queued = max_queued
+    proc.workers = []
+    proc.shard_queues = [Queue.Queue() for _ in range(num_shards)]
+    proc.shard_slots = [multiprocessing.Semaphore(max_queued)
+                        for _ in range(num_shards)]
+    proc.out_queue = Queue.Queue()
+    proc.td_config = {'product_config_file': 'product_config.xml',
+                      'config_item': 'test'}
+    proc._loop = True
+    proc._metrics = {}
+    proc._metrics_lock = threading.Lock()
+    proc._config_location = None
+    proc.memory = MemoryBudget()
+    return proc
+
+
+def _queued(msg_queue):
+    items = []
+    while not msg_queue.empty():
+        items.append(msg_queue.get())
+    return items
+
+
+class _Handler(logging.Handler):
+
+    """Collects the handled log records
+    """
+
+    def __init__(self):
+        logging.Handler.__init__(self)
+        self.records = []
+
+    def emit(self, record):
+        self.records.append(record)
+
+
+class TestSharding(unittest.TestCase):
+    """Unit testing for the routing of ShardedPostProcessor
+    """
+
+    def test_shard_key(self):
+        """Test the routing keys of messages"""
+        msg = _message('ccs4')
+        self.assertEqual(shard_key(msg, ROUTE_BY_AREA), 'ccs4')
+        self.assertEqual(shard_key(msg, ROUTE_BY_PRODUCT), 'IR_108')
+        self.assertEqual(shard_key(msg, ROUTE_BY_URI),
+                         '/data/IR_108_ccs4.tif')
+        msg = _Message({'area': 'euro4', 'productname': 'VIS006'})
+        self.assertEqual(shard_key(msg, ROUTE_BY_AREA), 'euro4')
+        self.assertEqual(shard_key(msg, ROUTE_BY_PRODUCT), 'VIS006')
+        self.assertEqual(shard_key(msg, ROUTE_BY_URI), '/test')
+        self.assertRaises(ValueError, shard_key, msg, 'time')
+
+    def test_shard_index(self):
+        """Test that keys are mapped stably to all shards"""
+        keys = ['area%d' % idx for idx in range(100)]
+        indexes = [shard_index(key, 4) for key in keys]
+        self.assertEqual(indexes, [shard_index(key, 4) for key in keys])
+        self.assertEqual(sorted(set(indexes)), [0, 1, 2, 3])
+        # crc32, independent of the hash seed of the process
+        self.assertEqual(shard_index('ccs4', 1000), 1742744584 % 1000)
+
+    def test_routing(self):
+        """Test that messages of the same key go to the same shard, after
+        the product config"""
+        proc = _post_processor(3)
+        proc.send_config()
+        proc.send_config()
+        messages = [_message(area, product) for area in ('ccs4', 'euro4')
+                    for product in ('IR_108', 'VIS006', 'WV_062')]
+        for msg in messages:
+            proc.process(msg)
+        routed = {}
+        for idx, msg_queue in enumerate(proc.shard_queues):
+            items = _queued(msg_queue)
+            self.assertEqual(items[0], ('config', ('product_config.xml',
+                                                   'test')))
+            for kind, msg in items[1:]:
+                self.assertEqual(kind, 'message')
+                routed.setdefault(msg.data['area']['name'], set()).add(idx)
+        self.assertEqual(routed, {'ccs4': set([shard_index('ccs4', 3)]),
+                                  'euro4': set([shard_index('euro4', 3)])})
+
+        # a changed product config is sent to all shards
+        proc.td_config['product_config_file'] = 'other.xml'
+        proc.send_config()
+        for msg_queue in proc.shard_queues:
+            self.assertEqual(_queued(msg_queue),
+                             [('config', ('other.xml', 'test'))])
+
+    def test_scheduled_before_routing(self):
+        """Test that messages are routed only to shards with a free slot,
+        so that the others stay in the scheduler"""
+        proc = _post_processor(1, max_queued=1)
+        first = _message('ccs4')
+        proc.process(first)
+        second = _message('euro4')
+        thr = threading.Thread(target=proc.process, args=(second,))
+        thr.start()
+        time.sleep(0.2)
+        self.assertEqual(_queued(proc.shard_queues[0]),
+                         [('message', first)])
+        # the worker processed the first message
+        proc.shard_slots[0].release()
+        thr.join(5)
+        self.assertEqual(_queued(proc.shard_queues[0]),
+                         [('message', second)])
+
+        # stopped while waiting
+        thr = threading.Thread(target=proc.process, args=(first,))
+        thr.start()
+        proc._loop = False
+        thr.join(5)
+        self.assertFalse(thr.is_alive())
+        self.assertEqual(_queued(proc.shard_queues[0]), [])
+
+    def test_collect(self):
+        """Test the collection of log records and metrics"""
+        proc = _post_processor(2)
+        handler = _Handler()
+        logger = logging.getLogger('test_sharding')
+        logger.addHandler(handler)
+        try:
+            proc.out_queue.put(('log', logging.LogRecord(
+                'test_sharding', logging.WARNING, __file__, 1,
+                'from shard', None, None)))
+            proc.out_queue.put(('metrics', (0, {'processed': 1,
+                                                'errors': 0,
+                                                'busy_seconds': 1.5,
+                                                'queued': 2})))
+            proc.out_queue.put(('metrics', (1, {'processed': 3,
+                                                'errors': 1,
+                                                'busy_seconds': 0.5,
+                                                'queued': 0})))
+            proc.out_queue.put(('metrics', (0, {'processed': 2,
+                                                'errors': 0,
+                                                'busy_seconds': 2.0,
+                                                'queued': 1})))
+            proc._loop = False
+            proc._collect()
+        finally:
+            logger.removeHandler(handler)
+        self.assertEqual([rec.getMessage() for rec in handler.records],
+                         ['from shard'])
+        metrics = proc.metrics()
+        self.assertEqual(sorted(metrics['shards']), [0, 1])
+        self.assertEqual(metrics['total'], {'processed': 5, 'errors': 1,
+                                            'busy_seconds': 2.5,
+                                            'queued': 1})
+
+
+def suite():
+    """The suite for test_sharding
+    """
+    loader = unittest.TestLoader()
+    mysuite = unittest.TestSuite()
+    mysuite.addTest(loader.loadTestsFromTestCase(TestSharding))
+
+    return mysuite
+
+if __name__ == "__main__":
+    unittest.TextTestRunner(verbosity=2).run(suite())
@@ -0,0 +1,140 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Unit testing for the streaming TIFF writer
+"""
+
+import os
+import shutil
+import tempfile
+import unittest
+from datetime import datetime
+
+import numpy as np
+from PIL import Image
+from mpop.imageo.geo_image import GeoImage
+from pyresample.geometry import AreaDefinition
+
+from dwd_extensions.tools.strip_writer import BlockImage
+from dwd_extensions.tools.strip_writer import StripWriter
+from dwd_extensions.tools.strip_writer import save_blocks
+
+
+def _area(width, height):
+    return AreaDefinition('test', 'test', 'test',
+                          {'proj': 'eqc', 'ellps': 'WGS84'}, width, height,
+                          (-1000., -500., 2000., 800.))
+
+
+class TestStripWriter(unittest.TestCase):
+    """Unit testing for StripWriter and the GeoImage format
+    """
+
+    def setUp(self):
+        """Setting up the testing
+        """
+        self.tmp_dir = tempfile.mkdtemp()
+        self.fname = os.path.join(self.tmp_dir, 'test.tif')
+
+    def tearDown(self):
+        """Cleaning up
+        """
+        shutil.rmtree(self.tmp_dir)
+
+    def test_blocks(self):
+        """Test writing blocks not aligned to the strips"""
+        data = np.random.randint(0, 255, (101, 37)).astype(np.uint8)
+        save_blocks((data[start:start + 7] for start in range(0, 101, 7)),
+                    self.fname, 37, 101, rows_per_strip=16)
+        image = Image.open(self.fname)
+        self.assertEqual(image.size, (37, 101))
+        self.assertTrue((np.array(image) == data).all())
+
+    def test_incomplete(self):
+        """Test that an incomplete file is removed"""
+        writer = StripWriter(self.fname, 10, 10)
+        writer.write(np.zeros((5, 10)))
+        self.assertRaises(ValueError, writer.close)
+        self.assertFalse(os.path.exists(self.fname))
+        writer = StripWriter(self.fname, 10, 10)
+        self.assertRaises(ValueError, writer.write, np.zeros((11, 10)))
+        writer.abort()
+
+    def test_geo_image(self):
+        """Test saving a GeoImage with this module as format"""
+        data = np.ma.array(np.random.random((130, 300)),
+                           mask=np.zeros((130, 300), bool))
+        data.mask[10:20, 5:50] = True
+        expected = (data.data * 255).astype(np.uint8)
+
+        img = GeoImage((data,), _area(300, 130), datetime(2016, 1, 1),
+                       mode='L', fill_value=None)
+        img.save(self.fname, fformat='dwd_extensions.tools.strip_writer',
+                 rows_per_strip=50)
+        image = Image.open(self.fname)
+        self.assertEqual(image.mode, 'LA')
+        self.assertEqual(image.tag_v2.get(33550), (10.0, 10.0, 0.0))
+        self.assertEqual(image.tag_v2.get(33922),
+                         (0.0, 0.0, 0.0, -1000.0, 800.0, 0.0))
+        arr = np.array(image)
+        self.assertTrue((arr[..., 0] == expected).all())
+        self.assertTrue((arr[..., 1] == np.where(data.mask, 0, 255)).all())
+
+        img = GeoImage((data,), _area(300, 130), datetime(2016, 1, 1),
+                       mode='L', fill_value=(0,))
+        img.save(self.fname, fformat='dwd_extensions.tools.strip_writer',
+                 compression=0, fill_value_subst='1')
+        expected[expected == 0] = 1
+        expected[data.mask] = 0
+        self.assertTrue((np.array(Image.open(self.fname)) == expected).all())
+
+    def test_block_image(self):
+        """Test saving an image computed block by block"""
+        data = np.ma.array(np.random.random((130, 300)),
+                           mask=np.zeros((130, 300), bool))
+        data.mask[10:20, 5:50] = True
+        fformat = 'dwd_extensions.tools.strip_writer'
+
+        img = GeoImage((data,), _area(300, 130), datetime(2016, 1, 1),
+                       mode='L', fill_value=0)
+        img.save(self.fname, fformat=fformat, rows_per_strip=16)
+        expected = np.array(Image.open(self.fname))
+
+        def blocks():
+            return ([data[start:start + 7]] for start in range(0, 130, 7))
+
+        img = BlockImage(blocks, (130, 300), _area(300, 130),
+                         datetime(2016, 1, 1), mode='L', fill_value=0)
+        # the blocks are computed again for every save
+        for _ in range(2):
+            img.save(self.fname, fformat=fformat, rows_per_strip=16)
+            image = Image.open(self.fname)
+            self.assertEqual(image.mode, 'L')
+            self.assertTrue((np.array(image) == expected).all())
+        self.assertRaises(ValueError, img.save, self.fname, fformat='png')
+
+
+def suite():
+    """The suite for test_strip_writer
+    """
+    loader = unittest.TestLoader()
+    mysuite = unittest.TestSuite()
+    mysuite.addTest(loader.loadTestsFromTestCase(TestStripWriter))
+
+    return mysuite
+
+if __name__ == "__main__":
+    unittest.TextTestRunner(verbosity=2).run(suite())
@@ -0,0 +1,97 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Unit testing for the trollsift template cache
+"""
+
+import unittest
+from datetime import datetime
+
+from trollsift import Parser
+
+from dwd_extensions.tools.template_cache import TemplateCache
+from dwd_extensions.tools.template_cache import template_plan
+
+RULE = {'input_pattern': 'METEOSAT_.*',
+        'out_box_ref': 'ninjo',
+        'dest_filename': 'M_{productname}_{areaname}_{time:%Y%m%d%H%M}.tif',
+        'format': 'mpop.imageo.formats.ninjotiff',
+        'format_params': {'physic_unit': 'C',
+                          'ninjo_product_name': '{productname}'}}
+
+
+def _naive_resolve(params, ref_params):
+    resolved_params = dict()
+    for k, v in params.items():
+        if isinstance(v, (str, unicode)):
+            resolved_params[k] = Parser(v).compose(ref_params)
+        elif isinstance(v, dict):
+            resolved_params[k] = _naive_resolve(v, ref_params)
+        else:
+            resolved_params[k] = v
+    return resolved_params
+
+
+class TestTemplateCache(unittest.TestCase):
+    """Unit testing for TemplateCache
+    """
+
+    def setUp(self):
+        """Setting up the testing
+        """
+        self.params = {'productname': 'IR_108',
+                       'areaname': 'nq0003km',
+                       'time': datetime(2017, 1, 1, 12, 15),
+                       'area': {'name': 'nq0003km'},
+                       'uri': '/data/file.tif'}
+        self.params.update(RULE)
+
+    def test_template_plan(self):
+        """Test detection of keys with placeholders"""
+        self.assertEqual(template_plan(RULE),
+                         {'dest_filename': True,
+                          'format_params': {'ninjo_product_name': True}})
+
+    def test_resolve_same_as_naive(self):
+        """Test that planned resolution equals full resolution"""
+        cache = TemplateCache()
+        self.assertEqual(cache.resolve(self.params, self.params, RULE),
+                         _naive_resolve(self.params, self.params))
+        self.assertEqual(cache.resolve(self.params, self.params),
+                         _naive_resolve(self.params, self.params))
+
+    def test_parser_cache(self):
+        """Test that parsers are reused"""
+        cache = TemplateCache()
+        pattern = '{productname}_{time:%Y%m%d%H%M}.tif'
+        self.assertTrue(cache.parser(pattern) is cache.parser(pattern))
+        self.assertEqual(cache.compose(pattern, self.params),
+                         'IR_108_201701011215.tif')
+        self.assertEqual(cache.compose('plain.tif', self.params),
+                         'plain.tif')
+
+
+def suite():
+    """The suite for test_template_cache
+    """
+    loader = unittest.TestLoader()
+    mysuite = unittest.TestSuite()
+    mysuite.addTest(loader.loadTestsFromTestCase(TestTemplateCache))
+
+    return mysuite
+
+if __name__ == "__main__":
+    unittest.TextTestRunner(verbosity=2).run(suite())
@@ -0,0 +1,173 @@
+# -*- coding: utf-8 -*-
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+'''Cache of area definitions and their longitudes/latitudes
+
+mpop.projector.get_area_def parses the areas file for every call and
+AreaDefinition.get_lonlats computes the coordinates of every pixel.
+The AreaCache of this process keeps the area definitions by name until
+the areas file changes and the longitudes/latitudes of the most
+recently used areas within a byte budget (post_processing setting
+area_cache_mbytes of the postprocessor, default 512). The cached objects
+are shared and must not be modified (the lon/lat arrays are read-only).
+'''
+
+import logging
+import os
+import threading
+from collections import OrderedDict
+
+import mpop.projector
+
+LOGGER = logging.getLogger("postprocessor")
+
+DEFAULT_LONLATS_MBYTES = 512
+
+
+def area_key(area):
+    '''Return a hashable key of the AreaDefinition *area*
+    '''
+    return (area.area_id, tuple(sorted(area.proj_dict.items())),
+            area.x_size, area.y_size, tuple(area.area_extent))
+
+
+def _mtime(fname):
+    try:
+        return os.path.getmtime(fname)
+    except OSError:
+        return None
+
+
+class AreaCache(object):
+
+    """Area definitions by name and the longitudes/latitudes of the
+    areas within *max_lonlats_bytes* (least recently used are evicted).
+    """
+
+    def __init__(self, max_lonlats_bytes=DEFAULT_LONLATS_MBYTES * 2 ** 20):
+        self._lock = threading.Lock()
+        self._areas = {}
+        self._mtimes = {}
+        self._lonlats = OrderedDict()
+        self._lonlats_bytes = 0
+        self.max_lonlats_bytes = max_lonlats_bytes
+        self.counts = {'area_hits': 0, 'area_loads': 0,
+                       'lonlats_hits': 0, 'lonlats_computed': 0,
+                       'lonlats_evicted': 0}
+
+    def configure(self, max_lonlats_bytes):
+        '''Set the byte budget of the longitudes/latitudes.
+        '''
+        with self._lock:
+            self.max_lonlats_bytes = max_lonlats_bytes
+            self._evict()
+
+    def get_area_def(self, area_name):
+        '''Return the AreaDefinition *area_name* of the mpop areas file.
+        '''
+        area_file = mpop.projector.get_area_file()
+        mtime = _mtime(area_file)
+        key = (area_file, area_name)
+        with self._lock:
+            if self._mtimes.get(area_file, mtime) != mtime:
+                LOGGER.info("Areas file %s changed", area_file)
+                for old_key in self._areas.keys():
+                    if old_key[0] == area_file:
+                        del self._areas[old_key]
+            self._mtimes[area_file] = mtime
+            area = self._areas.get(key)
+            if area is not None:
+                self.counts['area_hits'] += 1
+                return area
+
+        area = mpop.projector.get_area_def(area_name)
+        with self._lock:
+            self._areas[key] = area
+            self.counts['area_loads'] += 1
+        return area
+
+    def get_lonlats(self, area):
+        '''Return the (read-only) longitudes and latitudes of *area* (an
+        AreaDefinition or the name of an area).
+        '''
+        if isinstance(area, basestring):
+            area = self.get_area_def(area)
+        key = area_key(area)
+        with self._lock:
+            lonlats = self._lonlats.pop(key, None)
+            if lonlats is not None:
+                # most recently used last
+                self._lonlats[key] = lonlats
+                self.counts['lonlats_hits'] += 1
+                return lonlats
+
+        lons, lats = area.get_lonlats()
+        for arr in (lons, lats):
+            arr.setflags(write=False)
+        nbytes = lons.nbytes + lats.nbytes
+        with self._lock:
+            self.counts['lonlats_computed'] += 1
+            if key not in self._lonlats and \
+                    nbytes <= self.max_lonlats_bytes:
+                self._lonlats[key] = (lons, lats)
+                self._lonlats_bytes += nbytes
+                self._evict()
+        return lons, lats
+
+    def _evict(self):
+        while self._lonlats_bytes > self.max_lonlats_bytes:
+            _, (lons, lats) = self._lonlats.popitem(last=False)
+            self._lonlats_bytes -= lons.nbytes + lats.nbytes
+            self.counts['lonlats_evicted'] += 1
+
+    def clear(self):
+        '''Forget all cached areas and longitudes/latitudes
+        '''
+        with self._lock:
+            self._areas.clear()
+            self._mtimes.clear()
+            self._lonlats.clear()
+            self._lonlats_bytes = 0
+
+    def stats(self):
+        '''Return the cache counters and the bytes of the cached
+        longitudes/latitudes
+        '''
+        with self._lock:
+            res = dict(self.counts)
+            res['areas'] = len(self._areas)
+            res['lonlats'] = len(self._lonlats)
+            res['lonlats_mbytes'] = self._lonlats_bytes / float(2 ** 20)
+        return res
+
+
+_AREA_CACHE = AreaCache()
+
+
+def get_area_cache():
+    '''Return the AreaCache of this process
+    '''
+    return _AREA_CACHE
+
+
+def get_area_def(area_name):
+    '''Return the AreaDefinition *area_name* (cached)
+    '''
+    return _AREA_CACHE.get_area_def(area_name)
+
+
+def get_lonlats(area):
+    '''Return the read-only longitudes and latitudes of *area* (cached)
+    '''
+    return _AREA_CACHE.get_lonlats(area)
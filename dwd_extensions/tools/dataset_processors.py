@@ -24,22 +24,66 @@
 from urlparse import urlparse
 from functools import partial
 import logging
+import math
 import numpy as np
 import scipy.ndimage as ndi
 from fnmatch import fnmatch
-from mpop.projector import get_area_def
 from pyresample.geometry import AreaDefinition
+from dwd_extensions.tools.area_cache import get_area_def
+from dwd_extensions.tools.image_io import TiffRowReader
+from dwd_extensions.tools.image_io import image_mode
 from dwd_extensions.tools.image_io import read_image
+from dwd_extensions.tools.strip_writer import BlockImage
 from datetime import datetime
 
 LOGGER = logging.getLogger(__name__)
 
+DEFAULT_BLOCK_ROWS = 512
+
 
 def create_world_composite(msg, proc_func_params):
     """
     Creates a world composite images out of an dataset message
     """
+    args = _world_composite_args(msg, proc_func_params)
+    if args is None:
+        return None
+    items, kwargs = args
+    return _create_world_composite(items, **kwargs)
+
+
+def create_world_composite_blocks(msg, proc_func_params):
+    """
+    Like create_world_composite, but returns a BlockImage: the composite
+    is computed from *block_rows* (processing function parameter,
+    default 512) rows of the images at once while it is saved, i.e. the
+    rules of the output need the format dwd_extensions.tools.strip_writer.
+    With erosion_size and smooth_width the rows around each block are
+    read as well.
+    """
+    args = _world_composite_args(msg, proc_func_params)
+    if args is None or not args[0]:
+        return None
+    items, kwargs = args
+    rows = int((proc_func_params or {}).get('block_rows',
+                                            DEFAULT_BLOCK_ROWS))
+    path, area, timeslot = items[0]
+    reader = TiffRowReader(path)
+    mode, fill_value = image_mode(reader.count)
+    return BlockImage(partial(_world_composite_blocks, items, rows=rows,
+                              **kwargs),
+                      (reader.height, reader.width), area, timeslot,
+                      mode=mode, fill_value=fill_value)
+
+
+def _world_composite_args(msg, proc_func_params):
+    """
+    Return the items (path, area and gatherer time of the images, in
+    composition order) and the keyword arguments of
+    _create_world_composite for a dataset message, None if not possible
+    """
     items = []
+    area = get_area_def(msg.data['area']['name'])
     for elem in msg.data['dataset']:
         url = urlparse(elem['uri'])
         if url.netloc != '':
@@ -47,7 +91,6 @@ def create_world_composite(msg, proc_func_params):
                          format(elem['uri']))
             return None
 
-        area = get_area_def(msg.data['area']['name'])
         t_gatherer = msg.data['gatherer_time']
         if not isinstance(t_gatherer, datetime):
             try:
@@ -80,9 +123,9 @@ def create_world_composite(msg, proc_func_params):
         if 'smooth_width' in proc_func_params:
             smooth_width = float(proc_func_params['smooth_width'])
 
-    return _create_world_composite(items, lon_limits=lon_limits,
-                                   erosion_size=erosion_size,
-                                   smooth_width=smooth_width)
+    return items, {'lon_limits': lon_limits,
+                   'erosion_size': erosion_size,
+                   'smooth_width': smooth_width}
 
 
 def _match_order_index(order_list, item):
@@ -108,52 +151,99 @@ def _create_world_composite(items, lon_limits=None,
         if img is None:
             img = next_img
         else:
-            # scaled_smooth_sigma = smooth_sigma * (float(img.width) / 1000.0)
-
-            img_mask = reduce(np.ma.mask_or,
-                              [chn.mask for chn in img.channels])
-            next_img_mask = reduce(np.ma.mask_or,
-                                   [chn.mask for chn in next_img.channels])
-
-            # Mask overlapping areas away
-            if lon_limits:
-                for sat in lon_limits:
-                    if sat in path:
-                        mask_limits = calc_pixel_mask_limits(area,
-                                                             lon_limits[sat])
-                        for lim in mask_limits:
-                            next_img_mask[:, lim[0]:lim[1]] = 1
-                        break
-
-            alpha = np.ones(next_img_mask.shape, dtype='float')
-            alpha[next_img_mask] = 0.0
-
-            if erosion_size is not None and smooth_width is not None:
-                scaled_erosion_size = erosion_size * (float(img.width) /
-                                                      1000.0)
-                scaled_smooth_width = smooth_width * (float(img.width) /
-                                                      1000.0)
-
-                # smooth_alpha = ndi.gaussian_filter(
-                #     ndi.grey_erosion(alpha, size=(scaled_erosion_size,
-                #                                   scaled_erosion_size)),
-                #        scaled_smooth_sigma)
-                smooth_alpha = ndi.uniform_filter(
-                    ndi.grey_erosion(alpha, size=(scaled_erosion_size,
-                                                  scaled_erosion_size)),
-                    scaled_smooth_width)
-                smooth_alpha[img_mask] = alpha[img_mask]
+            _blend(img.channels, next_img.channels, path, area, lon_limits,
+                   erosion_size, smooth_width)
+
+    return img
+
+
+def _world_composite_blocks(items, lon_limits=None, erosion_size=20,
+                            smooth_width=20, rows=DEFAULT_BLOCK_ROWS,
+                            readers=None):
+    """
+    Generate the channels of the world composite of *items* in blocks of
+    *rows* rows, the images are read by *readers* (default: a
+    TiffRowReader per item)
+    """
+    if readers is None:
+        readers = [TiffRowReader(path) for path, _, _ in items]
+    height = readers[0].height
+    width = readers[0].width
+    # rows reached by the erosion and smoothing of the alpha channels
+    halo = 0
+    if erosion_size is not None and smooth_width is not None:
+        scale = float(width) / 1000.0
+        halo = (int(math.ceil(erosion_size * scale)) +
+                int(math.ceil(smooth_width * scale))) // 2 + 1
+
+    sources = []
+    for (path, area, _), reader in zip(items, readers):
+        if not isinstance(area, AreaDefinition):
+            area = get_area_def(area)
+        sources.append((path, area, reader))
+
+    for start in xrange(0, height, rows):
+        first = max(0, start - halo)
+        channels = None
+        for path, area, reader in sources:
+            next_channels = reader.read(first, start + rows + halo - first)
+            if channels is None:
+                channels = next_channels
             else:
-                smooth_alpha = alpha
+                _blend(channels, next_channels, path, area, lon_limits,
+                       erosion_size, smooth_width)
+        yield [chn[start - first:start - first + rows] for chn in channels]
 
-            for i in range(0, min(len(img.channels), len(next_img.channels))):
-                chdata = next_img.channels[i].data * smooth_alpha + \
-                    img.channels[i].data * (1 - smooth_alpha)
-                chmask = np.logical_and(img_mask, next_img_mask)
-                img.channels[i] = \
-                    np.ma.masked_where(chmask, chdata)
 
-    return img
+def _blend(channels, next_channels, path, area, lon_limits=None,
+           erosion_size=20, smooth_width=20):
+    """
+    Blend the channels of the image *path* over *channels* (modified in
+    place), channels of full rows of the image are expected
+    """
+    width = channels[0].shape[1]
+    # scaled_smooth_sigma = smooth_sigma * (float(width) / 1000.0)
+
+    img_mask = reduce(np.ma.mask_or,
+                      [chn.mask for chn in channels])
+    next_img_mask = reduce(np.ma.mask_or,
+                           [chn.mask for chn in next_channels])
+
+    # Mask overlapping areas away
+    if lon_limits:
+        for sat in lon_limits:
+            if sat in path:
+                mask_limits = calc_pixel_mask_limits(area,
+                                                     lon_limits[sat])
+                for lim in mask_limits:
+                    next_img_mask[:, lim[0]:lim[1]] = 1
+                break
+
+    alpha = np.ones(next_img_mask.shape, dtype='float')
+    alpha[next_img_mask] = 0.0
+
+    if erosion_size is not None and smooth_width is not None:
+        scaled_erosion_size = erosion_size * (float(width) / 1000.0)
+        scaled_smooth_width = smooth_width * (float(width) / 1000.0)
+
+        # smooth_alpha = ndi.gaussian_filter(
+        #     ndi.grey_erosion(alpha, size=(scaled_erosion_size,
+        #                                   scaled_erosion_size)),
+        #        scaled_smooth_sigma)
+        smooth_alpha = ndi.uniform_filter(
+            ndi.grey_erosion(alpha, size=(scaled_erosion_size,
+                                          scaled_erosion_size)),
+            scaled_smooth_width)
+        smooth_alpha[img_mask] = alpha[img_mask]
+    else:
+        smooth_alpha = alpha
+
+    for i in range(0, min(len(channels), len(next_channels))):
+        chdata = next_channels[i].data * smooth_alpha + \
+            channels[i].data * (1 - smooth_alpha)
+        chmask = np.logical_and(img_mask, next_img_mask)
+        channels[i] = \
+            np.ma.masked_where(chmask, chdata)
 
 
 def calc_pixel_mask_limits(adef, lon_limits):
@@ -0,0 +1,144 @@
+# -*- coding: utf-8 -*-
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+'''Coarser images derived from a decoded image
+
+An area of the same projection whose pixels are made of an integer
+number of pixels of the parent area (and aligned with them) is derived
+from an image of the parent area by block averaging or decimation
+instead of being produced by a processing chain of its own.
+
+A postprocessor rule with <derive_from> (the parent area) and
+<derived_area> applies to the images of the parent area only and writes
+the derived area, built by <derive_method> average (default) or
+decimate, e.g. a 30 km world composite derived from the 3 km one.
+'''
+
+import logging
+
+import numpy as np
+import mpop.imageo.geo_image as geo_image
+
+from dwd_extensions.mpop.quantized_image import QuantizedImage
+
+LOGGER = logging.getLogger("postprocessor")
+
+DERIVE_AVERAGE = 'average'
+DERIVE_DECIMATE = 'decimate'
+DERIVE_METHODS = (DERIVE_AVERAGE, DERIVE_DECIMATE)
+
+# tolerance of the grid alignment in parent pixels
+_TOLERANCE = 1e-3
+
+
+def _integer(value, what):
+    rounded = int(round(value))
+    if abs(value - rounded) > _TOLERANCE:
+        raise ValueError("%s is not an integer (%f)" % (what, value))
+    return rounded
+
+
+def grid_ratio(parent, area):
+    '''Return the first row and column of *area* in the grid of *parent*
+    (AreaDefinitions) and the number of parent rows and columns per
+    pixel of *area*. Raises ValueError if *area* cannot be derived from
+    *parent*.
+    '''
+    if parent.proj_dict != area.proj_dict:
+        raise ValueError("projection of %s differs from %s" %
+                         (area.area_id, parent.area_id))
+    row_ratio = _integer(area.pixel_size_y / parent.pixel_size_y,
+                         "row ratio")
+    col_ratio = _integer(area.pixel_size_x / parent.pixel_size_x,
+                         "column ratio")
+    row = _integer((parent.area_extent[3] - area.area_extent[3]) /
+                   parent.pixel_size_y, "first row")
+    col = _integer((area.area_extent[0] - parent.area_extent[0]) /
+                   parent.pixel_size_x, "first column")
+    if row_ratio < 1 or col_ratio < 1 or row < 0 or col < 0 or \
+            row + area.y_size * row_ratio > parent.y_size or \
+            col + area.x_size * col_ratio > parent.x_size:
+        raise ValueError("%s is not within %s at a coarser resolution" %
+                         (area.area_id, parent.area_id))
+    return row, col, row_ratio, col_ratio
+
+
+def block_average(data, row_ratio, col_ratio):
+    '''Return the mean of the unmasked pixels of the blocks of
+    *row_ratio* x *col_ratio* pixels of the masked array *data* (masked
+    if all pixels of the block are). Integer data is rounded.
+    '''
+    src = np.ma.getdata(data)
+    valid = ~np.ma.getmaskarray(data)
+    rows = src.shape[0] // row_ratio
+    cols = src.shape[1] // col_ratio
+    total = np.zeros((rows, cols))
+    count = np.zeros((rows, cols), np.intp)
+    # strided views keep the temporaries at the size of the result
+    for i in range(row_ratio):
+        for j in range(col_ratio):
+            part = src[i:rows * row_ratio:row_ratio,
+                       j:cols * col_ratio:col_ratio]
+            part_valid = valid[i:rows * row_ratio:row_ratio,
+                               j:cols * col_ratio:col_ratio]
+            total += np.where(part_valid, part, 0)
+            count += part_valid
+    mean = total / np.maximum(count, 1)
+    if src.dtype.kind in 'ui':
+        mean = (mean + 0.5).astype(src.dtype)
+    return np.ma.array(mean, mask=count == 0)
+
+
+def decimate(data, row_ratio, col_ratio):
+    '''Return the center pixels of the blocks of *row_ratio* x
+    *col_ratio* pixels of the masked array *data*.
+    '''
+    rows = data.shape[0] // row_ratio
+    cols = data.shape[1] // col_ratio
+    part = data[row_ratio // 2:rows * row_ratio:row_ratio,
+                col_ratio // 2:cols * col_ratio:col_ratio]
+    return np.ma.array(np.ma.getdata(part).copy(),
+                       mask=np.ma.getmaskarray(part).copy())
+
+
+def derive_image(img, area, method=DERIVE_AVERAGE):
+    '''Return the image of *area* derived from *img* (GeoImage or
+    QuantizedImage of a parent area, see grid_ratio) by block averaging
+    or decimation (*method*). Palette images are always decimated.
+    '''
+    if method not in DERIVE_METHODS:
+        raise ValueError("Unknown derive method '%s'" % method)
+    row, col, row_ratio, col_ratio = grid_ratio(img.area, area)
+    if img.mode in ('P', 'PA'):
+        method = DERIVE_DECIMATE
+    reduce_func = block_average if method == DERIVE_AVERAGE else decimate
+    channels = [
+        reduce_func(chn[row:row + area.y_size * row_ratio,
+                        col:col + area.x_size * col_ratio],
+                    row_ratio, col_ratio)
+        for chn in img.channels]
+    LOGGER.debug("Derived %s from %s (%d x %d pixels, %s)", area.area_id,
+                 img.area.area_id, row_ratio, col_ratio, method)
+
+    if isinstance(img, QuantizedImage):
+        derived = QuantizedImage(channels, area, img.time_slot,
+                                 mode=img.mode, fill_value=img.fill_value)
+    else:
+        derived = geo_image.GeoImage(channels, area, img.time_slot,
+                                     mode=img.mode,
+                                     fill_value=img.fill_value,
+                                     palette=img.palette)
+    derived.tags.update(img.tags)
+    derived.gdal_options.update(img.gdal_options)
+    return derived
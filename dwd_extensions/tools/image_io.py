@@ -6,13 +6,19 @@ Created on 07.04.2016
 import mpop.imageo.geo_image as geo_image
 import numpy as np
 import logging
+import os
+
+from dwd_extensions.mpop.quantized_image import QuantizedImage
 
 LOGGER = logging.getLogger("postprocessor")
 
+OVERVIEWS_AUTO = 'auto'
+
 
-def read_tiff_with_gdal(filename):
+def read_tiff_with_gdal(filename, quantized=False):
     """ read (geo)tiff via gdal
         unfortunatly it does not work after ninjotiff module was loaded
+        8 bit bands are returned as they are if *quantized*
     """
     # saver = __
     # import__('mpop.imageo.formats.ninjotiff', globals(), locals(), ['save'])
@@ -61,25 +67,63 @@ def read_tiff_with_gdal(filename):
                     (type(data), str(data.shape), data.dtype,
                      data.min(), data.mean(), data.max()))
 
-        arr = np.array(data)  # @UndefinedVariable
-        # @UndefinedVariable
-        if band.DataType == gdal.GDT_UInt32:
-            dtype = np.uint32  # @UndefinedVariable
-        elif band.DataType == gdal.GDT_UInt16:
-            dtype = np.uint16  # @UndefinedVariable
-        else:
-            dtype = np.uint8  # @UndefinedVariable
-        b = np.iinfo(dtype).max  # @UndefinedVariable
+        channels.append(_band_channel(gdal, band, data, quantized))
 
-        mask = None
-        nodata_val = band.GetNoDataValue()
-        if nodata_val is not None:
-            mask = arr == nodata_val
+    return channels
 
-        channels.append(
-            np.ma.array(arr[:, :] / float(b), mask=mask))  # @UndefinedVariable
 
-    return channels
+def _band_channel(gdal, band, data, quantized=False):
+    """ return the *data* read from the gdal *band* as channel (masked
+        where no data, scaled to 0..1 unless 8 bit and *quantized*)
+    """
+    arr = np.array(data)  # @UndefinedVariable
+    # @UndefinedVariable
+    if band.DataType == gdal.GDT_UInt32:
+        dtype = np.uint32  # @UndefinedVariable
+    elif band.DataType == gdal.GDT_UInt16:
+        dtype = np.uint16  # @UndefinedVariable
+    else:
+        dtype = np.uint8  # @UndefinedVariable
+    b = np.iinfo(dtype).max  # @UndefinedVariable
+
+    mask = None
+    nodata_val = band.GetNoDataValue()
+    if nodata_val is not None:
+        mask = arr == nodata_val
+
+    if quantized and dtype == np.uint8:
+        return np.ma.array(arr, mask=mask)
+    return np.ma.array(arr[:, :] / float(b),
+                       mask=mask)  # @UndefinedVariable
+
+
+class TiffRowReader(object):
+
+    """ reads the bands of the (geo)tiff *filename* via gdal in blocks
+        of rows, as channels like read_tiff_with_gdal
+    """
+
+    def __init__(self, filename, quantized=False):
+        from osgeo import gdal
+        self._gdal = gdal
+        self._dst = gdal.Open(filename, gdal.GA_ReadOnly)
+        self.filename = filename
+        self.quantized = quantized
+        self.width = self._dst.RasterXSize
+        self.height = self._dst.RasterYSize
+        self.count = self._dst.RasterCount
+
+    def read(self, start, rows):
+        """ return the channels of (at most) *rows* rows from row *start*
+        """
+        rows = min(rows, self.height - start)
+        channels = []
+        for i in xrange(1, self.count + 1):
+            band = self._dst.GetRasterBand(i)
+            data = band.ReadAsArray(0, start, self.width, rows)
+            channels.append(_band_channel(self._gdal, band, data,
+                                          self.quantized))
+        return channels
 
 
 def read_tiff_with_pil(filename):
@@ -104,23 +148,120 @@ def read_tiff_with_pil(filename):
     return channels
 
 
-def read_image(filename, area, timeslot):
-    channels = read_tiff_with_gdal(filename)
-    # channels = read_tiff_with_pil(filename)
+def image_nbytes(geo_img):
+    """ return the number of bytes used by the channel data (and masks)
+        of *geo_img* (none for an image computed block by block)
+    """
+    nbytes = 0
+    for chn in getattr(geo_img, 'channels', ()):
+        nbytes += chn.nbytes
+        mask = np.ma.getmask(chn)
+        if mask is not np.ma.nomask:
+            nbytes += mask.nbytes
+    return nbytes
+
+
+def geotiff_options(save_params):
+    """ return the GTiff creation options corresponding to the
+        keyword arguments *save_params* of GeoImage.save
+    """
+    options = ["%s=%s" % (key.upper(), value) for key, value in
+               (save_params.get('gdal_options') or {}).iteritems()]
+    compression = int(save_params.get('compression') or 0)
+    if compression:
+        options += ["COMPRESS=DEFLATE", "ZLEVEL=%d" % compression]
+    blocksize = int(save_params.get('blocksize') or 0)
+    if blocksize:
+        options += ["TILED=YES", "BLOCKXSIZE=%d" % blocksize,
+                    "BLOCKYSIZE=%d" % blocksize]
+    return options
+
+
+def overview_levels(width, height, blocksize=256):
+    """ return the reduction factors of the overviews of an image
+        with *width* x *height* pixels, the smallest overview fits into
+        one block of *blocksize*
+    """
+    levels = []
+    factor = 2
+    while max(width, height) * 2 > blocksize * factor:
+        levels.append(factor)
+        factor *= 2
+    return levels
+
+
+def add_overviews(filename, levels=None, resampling='average',
+                  cloud_optimized=False, creation_options=None):
+    """ add internal overviews with the reduction factors *levels*
+        (default: down to the size of one tile) to the GeoTIFF
+        *filename*. A *cloud_optimized* file is rewritten (with the
+        *creation_options* of the original file) so that the overviews
+        precede the full resolution image.
+    """
+    from osgeo import gdal
+
+    dst = gdal.Open(filename, gdal.GA_Update)
+    band = dst.GetRasterBand(1)
+    if levels is None:
+        blocksize = band.GetBlockSize()[0]
+        if blocksize >= dst.RasterXSize:
+            # striped
+            blocksize = 256
+        levels = overview_levels(dst.RasterXSize, dst.RasterYSize,
+                                 blocksize)
+    if band.GetRasterColorTable() is not None:
+        # palette indices must not be averaged
+        resampling = 'nearest'
+    if levels:
+        dst.BuildOverviews(resampling.upper(), list(levels))
 
-    if len(channels) == 1:
-        mode = "L"
-        fill_value = (0)
-    elif len(channels) == 4:
+    tmp_fname = None
+    if cloud_optimized:
+        options = list(creation_options or [])
+        if "TILED=YES" not in options:
+            options.append("TILED=YES")
+        options.append("COPY_SRC_OVERVIEWS=YES")
+        tmp_fname = os.path.join(os.path.dirname(filename),
+                                 '.cog.' + os.path.basename(filename))
+        cog = gdal.GetDriverByName("GTiff").CreateCopy(tmp_fname, dst,
+                                                       options=options)
+        # flush to disk
+        cog = None
+    dst = None
+    if tmp_fname is not None:
+        os.rename(tmp_fname, filename)
+    LOGGER.debug('added overviews %s to %s', levels, filename)
+
+
+def image_mode(num_channels):
+    """ return the mode and fill value of an image read from a file with
+        *num_channels* bands
+    """
+    if num_channels == 1:
+        return "L", (0)
+    elif num_channels == 4:
         # channels = channels[:-1]
         # mode = "RGB"
         # fill_value = (0, 0, 0)
+        return "RGBA", (0, 0, 0, 0)
+    return "RGB", (0, 0, 0)
 
-        mode = "RGBA"
-        fill_value = (0, 0, 0, 0)
-    else:
-        mode = "RGB"
-        fill_value = (0, 0, 0)
+
+def read_image(filename, area, timeslot, quantized=False):
+    """ read *filename* as GeoImage, 8 bit images as QuantizedImage
+        if *quantized*
+    """
+    channels = read_tiff_with_gdal(filename, quantized)
+    # channels = read_tiff_with_pil(filename)
+
+    mode, fill_value = image_mode(len(channels))
+
+    if all(chn.dtype == np.uint8 for chn in channels):
+        return QuantizedImage(tuple(channels),
+                              area,
+                              timeslot,
+                              fill_value=fill_value,
+                              mode=mode)
 
     geo_img = geo_image.GeoImage(tuple(channels),
                                  area,
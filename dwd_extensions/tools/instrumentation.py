@@ -0,0 +1,208 @@
+# -*- coding: utf-8 -*-
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+'''Latency instrumentation of the postprocessor
+
+The durations of the processing stages (rule matching, parameter
+resolution, reading, saving, renaming, rrd update...) are kept per
+stage, product and out_box in histograms with logarithmic buckets.
+Optionally every measurement is appended to a JSON lines file (setting
+instrumentation_file of the post_processing section).
+'''
+
+import bisect
+import json
+import logging
+import threading
+import time
+from contextlib import contextmanager
+
+LOGGER = logging.getLogger("postprocessor")
+
+
+class Histogram(object):
+
+    """Histogram of durations in seconds, the bucket bounds double from
+    1 ms to about 17 minutes.
+    """
+
+    BOUNDS = tuple(0.001 * 2 ** idx for idx in range(21))
+
+    def __init__(self):
+        self.counts = [0] * (len(self.BOUNDS) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.min = None
+        self.max = None
+
+    def add(self, value):
+        '''Add a duration
+        '''
+        self.counts[bisect.bisect_left(self.BOUNDS, value)] += 1
+        self.count += 1
+        self.total += value
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+
+    def percentile(self, pct):
+        '''Estimate the *pct* percentile (upper bound of its bucket)
+        '''
+        if self.count == 0:
+            return None
+        rank = pct / 100.0 * self.count
+        cum = 0
+        for idx, num in enumerate(self.counts):
+            cum += num
+            if cum >= rank and num > 0:
+                if idx < len(self.BOUNDS):
+                    return min(self.BOUNDS[idx], self.max)
+                return self.max
+        return self.max
+
+    def to_dict(self):
+        '''Return the summary of the histogram
+        '''
+        return {'count': self.count,
+                'sum': self.total,
+                'min': self.min,
+                'max': self.max,
+                'mean': self.total / self.count if self.count else None,
+                'p50': self.percentile(50),
+                'p90': self.percentile(90),
+                'p99': self.percentile(99)}
+
+
+class Instrumentation(object):
+
+    """Records the durations of processing stages per product and
+    out_box.
+    """
+
+    def __init__(self, jsonl_fname=None):
+        self._lock = threading.Lock()
+        self._histograms = {}
+        self._sink = None
+        self._captured = None
+        self.jsonl_fname = None
+        self.set_sink(jsonl_fname)
+
+    def set_sink(self, jsonl_fname=None):
+        '''Append every measurement to the JSON lines file
+        *jsonl_fname* (None to disable).
+        '''
+        with self._lock:
+            if jsonl_fname == self.jsonl_fname:
+                return
+            if self._sink is not None:
+                self._sink.close()
+                self._sink = None
+            if jsonl_fname:
+                # line buffered
+                self._sink = open(jsonl_fname, 'a', 1)
+            self.jsonl_fname = jsonl_fname
+
+    def record(self, stage, seconds, product=None, out_box=None):
+        '''Record the duration of *stage*
+        '''
+        key = (stage, product, out_box)
+        with self._lock:
+            if self._captured is not None:
+                self._captured.append((stage, seconds, product, out_box))
+                return
+            try:
+                hist = self._histograms[key]
+            except KeyError:
+                hist = self._histograms[key] = Histogram()
+            hist.add(seconds)
+            if self._sink is not None:
+                try:
+                    self._sink.write(json.dumps(
+                        {'time': time.time(), 'stage': stage,
+                         'seconds': seconds, 'product': product,
+                         'out_box': out_box}) + '\n')
+                except (IOError, ValueError) as err:
+                    LOGGER.error("Could not write to %s (%s)",
+                                 self.jsonl_fname, err)
+
+    @contextmanager
+    def timer(self, stage, product=None, out_box=None):
+        '''Context manager recording the duration of its block
+        '''
+        t_start = time.time()
+        try:
+            yield
+        finally:
+            self.record(stage, time.time() - t_start, product, out_box)
+
+    @contextmanager
+    def capture(self):
+        '''Context manager collecting the measurements of its block in
+        the yielded list of record arguments instead of recording them
+        (e.g. in a worker process, to be recorded by the parent).
+        '''
+        with self._lock:
+            self._captured = captured = []
+        try:
+            yield captured
+        finally:
+            with self._lock:
+                self._captured = None
+
+    def dump(self):
+        '''Return the histogram summaries as list of dicts with stage,
+        product and out_box
+        '''
+        with self._lock:
+            items = [(key, hist.to_dict())
+                     for key, hist in self._histograms.iteritems()]
+        res = []
+        for (stage, product, out_box), summary in sorted(items):
+            summary.update({'stage': stage, 'product': product,
+                            'out_box': out_box})
+            res.append(summary)
+        return res
+
+    def stage_totals(self):
+        '''Return the summaries per stage (all products and out_boxes)
+        '''
+        with self._lock:
+            totals = {}
+            for (stage, _, _), hist in self._histograms.iteritems():
+                total = totals.setdefault(stage, Histogram())
+                for idx, num in enumerate(hist.counts):
+                    total.counts[idx] += num
+                total.count += hist.count
+                total.total += hist.total
+                total.min = hist.min if total.min is None else \
+                    min(total.min, hist.min)
+                total.max = max(total.max, hist.max)
+        return dict((stage, hist.to_dict())
+                    for stage, hist in totals.iteritems())
+
+    def reset(self):
+        '''Forget all measurements
+        '''
+        with self._lock:
+            self._histograms.clear()
+
+
+_INSTRUMENTATION = Instrumentation()
+
+
+def get_instrumentation():
+    '''Return the Instrumentation of this process
+    '''
+    return _INSTRUMENTATION
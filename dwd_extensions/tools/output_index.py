@@ -0,0 +1,194 @@
+# -*- coding: utf-8 -*-
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+'''Index of the written output files
+
+Every output file is recorded with a key of its content (source file
+size and mtime, area and save arguments) and its own size and mtime.
+A repeated message (e.g. re-sent after a restart of trollstalker) is
+recognized if the destination still exists unchanged with the same key
+(nothing to do) or another unchanged output with the same key exists
+(the destination is hardlinked to it instead of encoded again).
+
+The postprocessor keeps the index in the sqlite file (or SQLAlchemy
+URL) of the post_processing setting output_index, records older than
+output_index_keep_days (default 7) are removed.
+'''
+
+import hashlib
+import logging
+import os
+import threading
+from datetime import datetime, timedelta
+
+from sqlalchemy import Column, String, Integer, Float, DateTime
+from sqlalchemy import create_engine
+from sqlalchemy.ext.declarative import declarative_base
+from sqlalchemy.orm import sessionmaker
+
+from dwd_extensions.tools.publish import freeze
+
+LOGGER = logging.getLogger("postprocessor")
+
+Base = declarative_base()
+
+INDEX_MISS = 'miss'
+INDEX_HIT = 'hit'
+INDEX_LINK = 'link'
+
+
+class OutputRecord(Base):
+    '''represents a written output file '''
+    __tablename__ = 'output_record'
+    dest_fname = Column(String, primary_key=True)
+    key = Column(String, index=True)
+    size = Column(Integer)
+    mtime = Column(Float)
+    timestamp = Column(DateTime, index=True)
+
+    def __repr__(self):
+        return "<OutputRecord("\
+            "dest_fname='{}'"\
+            ", key='{}'"\
+            ", timestamp='{}'"\
+            ")>".format(
+                self.dest_fname,
+                self.key,
+                self.timestamp)
+
+
+def output_key(src_fname, *parts):
+    '''Return the content key of an output created from *src_fname*
+    (identified by its path, size and mtime) and *parts* (e.g. area
+    name and save arguments)
+    '''
+    stat = os.stat(src_fname)
+    signature = (os.path.abspath(src_fname), stat.st_size, stat.st_mtime,
+                 freeze(parts))
+    return hashlib.sha1(repr(signature)).hexdigest()
+
+
+def _unchanged(record):
+    try:
+        stat = os.stat(record.dest_fname)
+    except OSError:
+        return False
+    return stat.st_size == record.size and stat.st_mtime == record.mtime
+
+
+class OutputIndex(object):
+
+    """Index of the output files in the (sqlite) *database*, safe to
+    use from several threads.
+    """
+
+    def __init__(self, database):
+        if ':///' not in database:
+            database = 'sqlite:///%s' % database
+        self.database = database
+        self.engine = create_engine(
+            database, echo=False,
+            connect_args={'check_same_thread': False, 'timeout': 30}
+            if database.startswith('sqlite') else {})
+        Base.metadata.create_all(self.engine)
+        self.Session = sessionmaker(bind=self.engine)
+        self.session = self.Session()
+        self._lock = threading.Lock()
+        self.counts = {INDEX_MISS: 0, INDEX_HIT: 0, INDEX_LINK: 0}
+
+    def lookup(self, dest_fname, key):
+        '''Check if *dest_fname* with content *key* was already written.
+        Returns (INDEX_HIT, *dest_fname*) if it is unchanged,
+        (INDEX_LINK, fname) if the unchanged output fname has the same
+        content, (INDEX_MISS, None) otherwise.
+        '''
+        with self._lock:
+            try:
+                res = (INDEX_MISS, None)
+                record = self.session.query(OutputRecord).get(dest_fname)
+                if record is not None and record.key == key and \
+                        _unchanged(record):
+                    res = (INDEX_HIT, dest_fname)
+                else:
+                    for record in self.session.query(OutputRecord).filter(
+                            OutputRecord.key == key):
+                        if record.dest_fname != dest_fname and \
+                                _unchanged(record):
+                            res = (INDEX_LINK, record.dest_fname)
+                            break
+                self.session.rollback()
+            except Exception as err:
+                self.session.rollback()
+                LOGGER.error("Output index lookup failed (%s)", err)
+                res = (INDEX_MISS, None)
+            self.counts[res[0]] += 1
+        return res
+
+    def record(self, outputs, since=None):
+        '''Record the written *outputs* (list of destination file name
+        and content key). Files not changed since the epoch time *since*
+        (i.e. not written by the current job) are not recorded.
+        '''
+        now = datetime.utcnow()
+        with self._lock:
+            try:
+                for dest_fname, key in outputs:
+                    try:
+                        stat = os.stat(dest_fname)
+                    except OSError:
+                        continue
+                    # (with a margin for coarse file timestamps)
+                    if since is not None and stat.st_ctime < since - 1:
+                        LOGGER.debug("%s not written, not indexed",
+                                     dest_fname)
+                        continue
+                    self.session.merge(OutputRecord(
+                        dest_fname=dest_fname, key=key, size=stat.st_size,
+                        mtime=stat.st_mtime, timestamp=now))
+                self.session.commit()
+            except Exception as err:
+                self.session.rollback()
+                LOGGER.error("Could not update the output index (%s)", err)
+
+    def delete_older_than(self, days):
+        ''' delete all records written more than *days* ago '''
+        with self._lock:
+            try:
+                self.session.query(OutputRecord).filter(
+                    OutputRecord.timestamp <
+                    datetime.utcnow() - timedelta(days=days)).delete()
+                self.session.commit()
+            except Exception as err:
+                self.session.rollback()
+                LOGGER.error("Could not clean the output index (%s)", err)
+
+    def record_count(self):
+        ''' return count of records in the index '''
+        with self._lock:
+            res = self.session.query(OutputRecord).count()
+            self.session.rollback()
+        return res
+
+    def stats(self):
+        '''Return the hit, link and miss counters
+        '''
+        with self._lock:
+            return dict(self.counts)
+
+    def close(self):
+        '''Close the database session
+        '''
+        with self._lock:
+            self.session.close()
+            self.engine.dispose()
@@ -0,0 +1,197 @@
+# -*- coding: utf-8 -*-
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+'''Publishing of output files
+
+Files are published under a temporary name with prefix "." and renamed
+when complete, so that 3rd party software (i.e. AFD) does not read
+incomplete files. An already encoded file is published to further
+destinations as hardlink (or as copy staged in the destination
+directory if the file is on another filesystem).
+
+The durability is selected by an fsync policy:
+
+- none: no fsync,
+- file: fsync the file before it is renamed,
+- dir: fsync the file and the directory after the rename,
+- batch: fsync the file, the caller syncs the directories of a batch of
+  files with sync_dirs (e.g. once per out_box and message).
+
+The postprocessor takes the policy from the post_processing setting
+fsync (default none), out_boxes may override it with <fsync>.
+'''
+
+import logging
+import os
+import shutil
+import tempfile
+
+from dwd_extensions.tools.instrumentation import get_instrumentation
+
+LOGGER = logging.getLogger("postprocessor")
+INSTRUMENTATION = get_instrumentation()
+
+FSYNC_NONE = 'none'
+FSYNC_FILE = 'file'
+FSYNC_DIR = 'dir'
+FSYNC_BATCH = 'batch'
+FSYNC_POLICIES = (FSYNC_NONE, FSYNC_FILE, FSYNC_DIR, FSYNC_BATCH)
+
+COPY_BUFSIZE = 1024 * 1024
+
+PUBLISH_LINK = 'link'
+PUBLISH_COPY = 'copy'
+
+
+def tmp_filename(dest_fname):
+    '''Return the temporary name used while writing *dest_fname*
+    '''
+    return os.path.join(os.path.dirname(dest_fname),
+                        '.' + os.path.basename(dest_fname))
+
+
+def freeze(value):
+    '''Return a hashable representation of *value* (nested dicts, lists
+    and sets are converted to sorted tuples).
+    '''
+    if isinstance(value, dict):
+        return tuple(sorted((key, freeze(val))
+                            for key, val in value.iteritems()))
+    elif isinstance(value, (list, tuple)):
+        return tuple(freeze(val) for val in value)
+    elif isinstance(value, (set, frozenset)):
+        return tuple(sorted(freeze(val) for val in value))
+    try:
+        hash(value)
+    except TypeError:
+        return repr(value)
+    return value
+
+
+def save_args_key(save_args, dest_fname):
+    '''Key identifying the encoded content of a file saved with
+    *save_args* to *dest_fname*: files with the same key are identical.
+    '''
+    if 'ninjotiff' in (save_args.get('fformat') or ''):
+        # ninjotiff writes the file name (without path if
+        # omit_filename_path is set) into the NTD_FileName tag
+        if save_args.get('omit_filename_path', False):
+            return (freeze(save_args), os.path.basename(dest_fname))
+        return (freeze(save_args), dest_fname)
+    return (freeze(save_args), os.path.splitext(dest_fname)[1])
+
+
+def copy_file(src_fname, dest_fname):
+    '''Copy data and permission bits of *src_fname* to *dest_fname*
+    (with larger blocks than shutil.copy).
+    '''
+    with open(src_fname, 'rb') as fsrc:
+        with open(dest_fname, 'wb') as fdst:
+            shutil.copyfileobj(fsrc, fdst, COPY_BUFSIZE)
+    shutil.copymode(src_fname, dest_fname)
+
+
+def _fsync(fname):
+    fd = os.open(fname, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def sync_dirs(dirnames, out_box=None):
+    '''Fsync the directories *dirnames* (policy "batch")
+    '''
+    for dirname in sorted(set(dirnames)):
+        try:
+            with INSTRUMENTATION.timer('fsync_dir', out_box=out_box):
+                _fsync(dirname or '.')
+        except OSError as err:
+            LOGGER.error("Could not fsync %s (%s)", dirname, err)
+
+
+def commit_file(tmp_fname, dest_fname, fsync=FSYNC_NONE, product=None,
+                out_box=None):
+    '''Rename the complete file *tmp_fname* (in the directory of
+    *dest_fname*) to *dest_fname* according to the *fsync* policy.
+    '''
+    if fsync not in FSYNC_POLICIES:
+        raise ValueError("unknown fsync policy '%s'" % fsync)
+    if fsync != FSYNC_NONE:
+        with INSTRUMENTATION.timer('fsync', product, out_box):
+            _fsync(tmp_fname)
+    with INSTRUMENTATION.timer('rename', product, out_box):
+        os.rename(tmp_fname, dest_fname)
+    if fsync == FSYNC_DIR:
+        with INSTRUMENTATION.timer('fsync_dir', product, out_box):
+            _fsync(os.path.dirname(dest_fname) or '.')
+
+
+def write_file(dest_fname, data, fsync=FSYNC_FILE, mode=None):
+    '''Atomically replace *dest_fname* by a file containing *data* (and
+    permission bits *mode*)
+    '''
+    dest_dir = os.path.dirname(dest_fname)
+    fd, tmp_fname = tempfile.mkstemp(
+        dir=dest_dir or '.', prefix='.' + os.path.basename(dest_fname))
+    try:
+        with os.fdopen(fd, 'w') as fid:
+            fid.write(data)
+        if mode is not None:
+            os.chmod(tmp_fname, mode)
+        commit_file(tmp_fname, dest_fname, fsync)
+    except BaseException:
+        if os.path.exists(tmp_fname):
+            os.remove(tmp_fname)
+        raise
+
+
+def same_device(fname, dirname):
+    '''Check if *fname* and the directory *dirname* are on the same
+    filesystem (i.e. *fname* can be linked or renamed into *dirname*)
+    '''
+    try:
+        return os.stat(fname).st_dev == os.stat(dirname or '.').st_dev
+    except OSError:
+        return False
+
+
+def publish_file(src_fname, dest_fname, link=True, fsync=FSYNC_NONE,
+                 product=None, out_box=None):
+    '''Publish the complete file *src_fname* as *dest_fname* (with the
+    *fsync* policy). Returns True if a hardlink was created, False if
+    the file was copied.
+    '''
+    dest_dir = os.path.dirname(dest_fname)
+    if dest_dir and not os.path.exists(dest_dir):
+        os.makedirs(dest_dir)
+    tmp_fname = tmp_filename(dest_fname)
+    if os.path.lexists(tmp_fname):
+        os.remove(tmp_fname)
+    linked = False
+    if link and not same_device(src_fname, dest_dir):
+        LOGGER.debug("%s is on another filesystem than %s, copying",
+                     src_fname, dest_dir)
+    elif link:
+        try:
+            os.link(src_fname, tmp_fname)
+            linked = True
+        except (OSError, AttributeError) as err:
+            LOGGER.debug("Cannot link %s to %s (%s), copying",
+                         src_fname, dest_fname, err)
+    if not linked:
+        with INSTRUMENTATION.timer('copy', product, out_box):
+            copy_file(src_fname, tmp_fname)
+    commit_file(tmp_fname, dest_fname, fsync, product, out_box)
+    return linked
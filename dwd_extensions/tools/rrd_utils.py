@@ -23,17 +23,27 @@
 
 '''
 
+import atexit
 import logging
+import os
 import random
+import socket
+import threading
+import time
 import pytz
+from collections import OrderedDict
+from contextlib import contextmanager
 from datetime import datetime, timedelta
 
+from dwd_extensions.tools.instrumentation import get_instrumentation
+
 try:
     import rrdtool as rrd
 except ImportError:
     rrd = None
 
 LOGGER = logging.getLogger("postprocessor")
+INSTRUMENTATION = get_instrumentation()
 HOUR = 60 * 60
 DAY = HOUR * 24
 MONTH = DAY * 31
@@ -57,6 +67,20 @@ def _rra(cf, interval, timespan, step_size):
         return rrd_param
 
 
+def _rrd_definitions(rrd_steps):
+    return [
+        'DS:epi2product:GAUGE:{}:U:U'.format(rrd_steps),
+        'DS:timeslot2product:GAUGE:{}:U:U'.format(rrd_steps),
+        # keep step_size max for 4 months
+        _rra('MAX', rrd_steps, 4 * MONTH, rrd_steps),
+        # hourly average over 12 months days
+        _rra('AVERAGE', HOUR, 12 * MONTH, rrd_steps),
+        # hourly maximum over 12 months days
+        _rra('MAX', HOUR, 12 * MONTH, rrd_steps),
+        # hourly minumum over 12 months days
+        _rra('MIN', HOUR, 12 * MONTH, rrd_steps)]
+
+
 def create_rrd_file(rrd_fname, timeslot_sec, rrd_steps):
     if rrd:
         rrd.create(
@@ -65,33 +89,362 @@ def create_rrd_file(rrd_fname, timeslot_sec, rrd_steps):
             # step size 900s=15min
             # each step represents one time slot
             '--step', str(rrd_steps),
-            ['DS:epi2product:GAUGE:{}:U:U'.format(
-                rrd_steps),
-             'DS:timeslot2product:GAUGE:{}:U:U'.format(
-                rrd_steps)],
-            # keep step_size max for 4 months
-            _rra('MAX', rrd_steps, 4 * MONTH, rrd_steps),
-            # hourly average over 12 months days
-            _rra('AVERAGE', HOUR, 12 * MONTH, rrd_steps),
-            # hourly maximum over 12 months days
-            _rra('MAX', HOUR, 12 * MONTH, rrd_steps),
-            # hourly minumum over 12 months days
-            _rra('MIN', HOUR, 12 * MONTH, rrd_steps))
+            *_rrd_definitions(rrd_steps))
     else:
         LOGGER.info("rrd update skipped, rrdtool not available")
 
 
+def rrd_update_value(timeslot_sec, t_epi, t_product):
+    '''Return the rrd update statement of a product
+    '''
+    return str(timeslot_sec) + \
+        ':' + str(int(t_product - t_epi)) + \
+        ':' + str(int(t_product - timeslot_sec))
+
+
 def update_rrd_file(rrd_fname, timeslot_sec, t_epi, t_product):
     if rrd:
-        update_stmt = str(timeslot_sec) + \
-            ':' + str(int(t_product - t_epi)) + \
-            ':' + str(int(t_product - timeslot_sec))
+        update_stmt = rrd_update_value(timeslot_sec, t_epi, t_product)
         LOGGER.debug("rrd update %s %s" % (rrd_fname, update_stmt))
         rrd.update(rrd_fname, update_stmt)
     else:
         LOGGER.info("rrd update skipped, rrdtool not available")
 
 
+def _log_update_error(rrd_fname, err):
+    if 'minimum one second step' in str(err):
+        LOGGER.info("rrd file %s already contains timeslot. (%s)",
+                    rrd_fname, err)
+        return False
+    LOGGER.error("Could not update rrd file %s. (%s)", rrd_fname, err)
+    return True
+
+
+RRDCACHED_PORT = 42217
+
+
+def _connect(address):
+    '''Connect to the rrdcached at *address* ("unix:/path", "/path",
+    "host" or "host:port")
+    '''
+    if address.startswith('unix:'):
+        address = address[5:]
+    if address.startswith('/'):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.connect(address)
+    else:
+        host, _, port = address.partition(':')
+        sock = socket.create_connection((host, int(port or RRDCACHED_PORT)))
+    return sock
+
+
+class RrdSink(object):
+
+    """Collects rrd updates (rrd file, timeslot, epi and product time)
+    and writes them in a background thread, so that publishing a
+    product never waits for rrd I/O.
+
+    Updates of the same rrd file and timeslot are coalesced (the first
+    one is kept, like rrdtool does), the updates of one file are written
+    in one call. With *daemon_address* the updates are sent as one
+    BATCH to an rrdcached, otherwise the files are written with rrdtool.
+    At most *max_pending* updates are kept, further ones replace the
+    oldest. The duration of each batch write is recorded as stage
+    rrd_flush.
+    """
+
+    def __init__(self, flush_interval=2.0, max_pending=100000,
+                 daemon_address=None):
+        self._cond = threading.Condition()
+        self._pending = OrderedDict()
+        self._created = set()
+        self._thread = None
+        self._sock = None
+        self._loop = True
+        self._flush_requested = False
+        self._flushing = False
+        self._captured = None
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+        self.daemon_address = daemon_address
+        self.counters = {'submitted': 0, 'coalesced': 0, 'dropped': 0,
+                         'written': 0, 'errors': 0}
+
+    def configure(self, flush_interval=2.0, max_pending=100000,
+                  daemon_address=None):
+        '''Change the settings, takes effect with the next batch.
+        '''
+        with self._cond:
+            self.flush_interval = flush_interval
+            self.max_pending = max_pending
+            if daemon_address != self.daemon_address:
+                self._disconnect()
+                self._created.clear()
+            self.daemon_address = daemon_address
+
+    def submit(self, rrd_fname, rrd_steps, timeslot_sec, t_epi, t_product):
+        '''Queue an update, never blocks.
+        '''
+        key = (rrd_fname, timeslot_sec)
+        with self._cond:
+            if self._captured is not None:
+                self._captured.append((rrd_fname, rrd_steps, timeslot_sec,
+                                       t_epi, t_product))
+                return
+            self.counters['submitted'] += 1
+            if key in self._pending:
+                self.counters['coalesced'] += 1
+                return
+            if self.max_pending and len(self._pending) >= self.max_pending:
+                self._pending.popitem(last=False)
+                self.counters['dropped'] += 1
+            self._pending[key] = (rrd_steps, t_epi, t_product)
+            if self._thread is None or not self._thread.is_alive():
+                self._loop = True
+                self._thread = threading.Thread(target=self.run)
+                self._thread.daemon = True
+                self._thread.start()
+
+    @contextmanager
+    def capture(self):
+        '''Context manager collecting the updates submitted in its block
+        in the yielded list of submit arguments instead of queueing them
+        (e.g. in a worker process, see submit_rrd_updates).
+        '''
+        with self._cond:
+            self._captured = captured = []
+        try:
+            yield captured
+        finally:
+            with self._cond:
+                self._captured = None
+
+    def stats(self):
+        '''Return the counters and the number of pending updates
+        '''
+        with self._cond:
+            stats = dict(self.counters)
+            stats['pending'] = len(self._pending)
+        return stats
+
+    def run(self):
+        '''Write the pending updates every *flush_interval* seconds.
+        '''
+        while True:
+            with self._cond:
+                if self._loop and not self._flush_requested:
+                    self._cond.wait(self.flush_interval)
+                self._flush_requested = False
+                batch = self._take()
+                stopping = not self._loop
+                if not batch and stopping:
+                    return
+                self._flushing = True
+            try:
+                if batch:
+                    with INSTRUMENTATION.timer('rrd_flush'):
+                        self._write(batch)
+            except BaseException:
+                LOGGER.exception("Unexpected error")
+            finally:
+                with self._cond:
+                    self._flushing = False
+                    self._cond.notify_all()
+            if stopping:
+                return
+
+    def flush(self, timeout=None):
+        '''Write the pending updates now, returns False if they were
+        not written within *timeout* seconds.
+        '''
+        with self._cond:
+            if self._thread is None or not self._thread.is_alive():
+                return not self._pending
+            self._flush_requested = True
+            self._cond.notify_all()
+            start = time.time()
+            while self._pending or self._flushing or \
+                    self._flush_requested:
+                if timeout is not None and \
+                        time.time() - start > timeout:
+                    return False
+                self._cond.wait(0.1)
+        return True
+
+    def stop(self, timeout=10):
+        '''Write the pending updates and stop the sink thread.
+        '''
+        self.flush(timeout)
+        with self._cond:
+            self._loop = False
+            self._cond.notify_all()
+            self._disconnect()
+
+    def _take(self):
+        # called with self._cond acquired
+        batch = OrderedDict()
+        for (rrd_fname, timeslot_sec), value in self._pending.iteritems():
+            batch.setdefault(rrd_fname, []).append((timeslot_sec,) + value)
+        self._pending.clear()
+        for events in batch.itervalues():
+            events.sort()
+        return batch
+
+    def _requeue(self, batch):
+        with self._cond:
+            for rrd_fname, events in batch.iteritems():
+                for timeslot_sec, rrd_steps, t_epi, t_product in events:
+                    self._pending.setdefault((rrd_fname, timeslot_sec),
+                                             (rrd_steps, t_epi, t_product))
+
+    def _count(self, key, num=1):
+        with self._cond:
+            self.counters[key] += num
+
+    def _write(self, batch):
+        if self.daemon_address:
+            self._write_daemon(batch)
+        elif rrd is None:
+            LOGGER.info("rrd update skipped, rrdtool not available")
+        else:
+            self._write_direct(batch)
+
+    def _write_direct(self, batch):
+        for rrd_fname, events in batch.iteritems():
+            stmts = [rrd_update_value(timeslot_sec, t_epi, t_product)
+                     for timeslot_sec, _, t_epi, t_product in events]
+            try:
+                if not os.path.exists(rrd_fname):
+                    create_rrd_file(rrd_fname, events[0][0], events[0][1])
+                LOGGER.debug("rrd update %s %s", rrd_fname, stmts)
+                rrd.update(rrd_fname, *stmts)
+                self._count('written', len(stmts))
+                continue
+            except Exception as err:
+                if len(stmts) == 1:
+                    if _log_update_error(rrd_fname, err):
+                        self._count('errors')
+                    continue
+            # e.g. one timeslot was already written, retry one by one
+            for stmt in stmts:
+                try:
+                    rrd.update(rrd_fname, stmt)
+                    self._count('written')
+                except Exception as err:
+                    if _log_update_error(rrd_fname, err):
+                        self._count('errors')
+
+    def _disconnect(self):
+        if self._sock is not None:
+            try:
+                self._sock.close()
+            except socket.error:
+                pass
+            self._sock = None
+
+    def _write_daemon(self, batch):
+        commands = []
+        for rrd_fname, events in batch.iteritems():
+            if rrd_fname not in self._created:
+                rrd_steps = events[0][1]
+                commands.append(' '.join(
+                    ['CREATE', rrd_fname,
+                     '-s', str(rrd_steps),
+                     '-b', str(events[0][0] - rrd_steps),
+                     '-O'] + _rrd_definitions(rrd_steps)))
+            commands.append(' '.join(
+                ['UPDATE', rrd_fname] +
+                [rrd_update_value(timeslot_sec, t_epi, t_product)
+                 for timeslot_sec, _, t_epi, t_product in events]))
+        try:
+            if self._sock is None:
+                self._sock = _connect(self.daemon_address)
+                self._reader = self._sock.makefile('r')
+            self._sock.sendall('BATCH\n')
+            self._reader.readline()
+            self._sock.sendall('\n'.join(commands) + '\n.\n')
+            num_errors = int(self._reader.readline().split()[0])
+            errors = [self._reader.readline().strip()
+                      for _ in range(num_errors)]
+        except (socket.error, IOError, ValueError, IndexError) as err:
+            LOGGER.error("Could not send rrd updates to %s (%s)",
+                         self.daemon_address, err)
+            self._disconnect()
+            self._requeue(batch)
+            return
+
+        failed = {}
+        for error in errors:
+            cmd_idx, _, msg = error.partition(' ')
+            try:
+                command = commands[int(cmd_idx) - 1]
+            except (ValueError, IndexError):
+                command = ''
+            failed[command] = msg
+        for command in commands:
+            cmd, rrd_fname, args = command.split(' ', 2)
+            if cmd == 'CREATE':
+                # -O: existing files are not overwritten (reported as error)
+                self._created.add(rrd_fname)
+                if command in failed and 'exist' not in failed[command]:
+                    LOGGER.error("Could not create rrd file %s. (%s)",
+                                 rrd_fname, failed[command])
+            elif command in failed:
+                if _log_update_error(rrd_fname, failed[command]):
+                    self._count('errors')
+            else:
+                self._count('written', len(args.split()))
+
+
+_SINK = {'sink': None, 'enabled': True}
+_SINK_LOCK = threading.Lock()
+
+
+def configure_rrd_sink(enabled=True, **kwargs):
+    '''Enable or disable the asynchronous rrd updates of this process,
+    keyword arguments are passed to RrdSink.configure. The postprocessor
+    uses the post_processing settings rrd_async (default true),
+    rrd_flush_interval (seconds, default 2) and rrdcached_address
+    (unix:/path or host:port, default none = rrdtool).
+    '''
+    with _SINK_LOCK:
+        _SINK['enabled'] = enabled
+        if _SINK['sink'] is None:
+            _SINK['sink'] = RrdSink(**kwargs)
+            atexit.register(_SINK['sink'].stop)
+        else:
+            _SINK['sink'].configure(**kwargs)
+        sink = _SINK['sink']
+    if not enabled:
+        sink.flush()
+    return sink
+
+
+def get_rrd_sink():
+    '''Return the RrdSink of this process (None if disabled)
+    '''
+    if _SINK['sink'] is None:
+        configure_rrd_sink()
+    if not _SINK['enabled']:
+        return None
+    return _SINK['sink']
+
+
+def submit_rrd_updates(updates):
+    '''Hand the rrd updates captured by RrdSink.capture (e.g. in a worker
+    process) to the rrd sink of this process, they are written at once
+    if asynchronous updates are disabled.
+    '''
+    if not updates:
+        return
+    get_rrd_sink()
+    sink = _SINK['sink']
+    for update in updates:
+        sink.submit(*update)
+    if not _SINK['enabled']:
+        sink.flush()
+
+
 def create_sample_rrd(filename, timeslots, rrd_steps):
     create_rrd_file(filename,
                     to_unix_seconds(timeslots[0]),
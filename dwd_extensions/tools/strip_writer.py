@@ -0,0 +1,380 @@
+# -*- coding: utf-8 -*-
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+'''Streaming (Geo)TIFF writer
+
+The image is consumed in blocks of rows (e.g. from a generator computing
+the product block by block), every complete strip is compressed and
+written at once. Only one strip and the current block are held in
+memory, the directory of the file is written at the end.
+
+Used as image format of a rule (<format>dwd_extensions.tools.
+strip_writer</format>) a GeoImage is converted to 8 (or 16) bit block by
+block instead of as a whole (format_params rows_per_strip, default 64,
+and nbits). The georeference is written as model pixel
+scale and tiepoint (like ninjotiff), projection keys are not written.
+
+A dataset processor may return a BlockImage instead of a GeoImage (e.g.
+dwd_extensions.tools.dataset_processors|create_world_composite_blocks):
+its blocks are computed while the rules with this module as format save
+it, so that neither the product nor its 8 bit copy is held as a whole.
+'''
+
+import logging
+import os
+import struct
+import zlib
+
+import numpy as np
+
+from mpop.imageo.formats import writer_options as write_opts
+
+LOGGER = logging.getLogger("postprocessor")
+
+# tag types
+_SHORT = 3
+_LONG = 4
+_ASCII = 2
+_DOUBLE = 12
+_TYPE_FORMATS = {_SHORT: 'H', _LONG: 'I', _ASCII: 's', _DOUBLE: 'd'}
+
+_COMPRESSION_NONE = 1
+_COMPRESSION_DEFLATE = 8
+_PHOTOMETRIC_MINISBLACK = 1
+_PHOTOMETRIC_RGB = 2
+_EXTRASAMPLE_UNASSOCALPHA = 2
+_SAMPLEFORMAT_UINT = 1
+_SAMPLEFORMAT_IEEEFP = 3
+
+_MAX_OFFSET = 2 ** 32 - 1
+
+DEFAULT_ROWS_PER_STRIP = 64
+
+
+class StripWriter(object):
+
+    """Writes a TIFF of *width* x *height* pixels with *bands* samples
+    of *dtype* to *fname* from blocks of rows (see write). The strips of
+    *rows_per_strip* rows are deflate compressed with level
+    *compression* (0 = uncompressed). With *alpha* the last band is an
+    alpha channel. *geotransform* (GDAL order) adds the georeference,
+    *nodata* the GDAL no data value.
+    """
+
+    def __init__(self, fname, width, height, bands=1, dtype=np.uint8,
+                 compression=6, rows_per_strip=DEFAULT_ROWS_PER_STRIP,
+                 alpha=False, geotransform=None, nodata=None):
+        self.fname = fname
+        self.width = int(width)
+        self.height = int(height)
+        self.bands = int(bands)
+        self.dtype = np.dtype(dtype)
+        self.compression = int(compression or 0)
+        self.rows_per_strip = max(1, min(int(rows_per_strip), self.height))
+        self.alpha = alpha
+        self.geotransform = geotransform
+        self.nodata = nodata
+        self.rows_written = 0
+        self._strip_offsets = []
+        self._strip_nbytes = []
+        self._pending = []
+        self._pending_rows = 0
+        self._fid = open(fname, 'wb')
+        # header, the offset of the directory is set by close
+        self._fid.write(struct.pack('<2sHI', 'II', 42, 0))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+    def write(self, block):
+        '''Append the rows of *block* (rows x width, or rows x width x
+        bands for several bands).
+        '''
+        block = np.asarray(block, dtype=self.dtype)
+        if block.ndim == 2:
+            block = block[:, :, np.newaxis]
+        if block.shape[1:] != (self.width, self.bands):
+            raise ValueError("block of shape %s does not fit %d x %d" %
+                             (block.shape, self.width, self.bands))
+        if self.rows_written + self._pending_rows + block.shape[0] > \
+                self.height:
+            raise ValueError("more than %d rows written" % self.height)
+        start = 0
+        while start < block.shape[0]:
+            rows = min(block.shape[0] - start,
+                       self.rows_per_strip - self._pending_rows)
+            self._pending.append(block[start:start + rows])
+            self._pending_rows += rows
+            start += rows
+            if self._pending_rows == self.rows_per_strip:
+                self._write_strip()
+
+    def _write_strip(self):
+        if not self._pending:
+            return
+        data = np.concatenate(self._pending).astype(
+            self.dtype.newbyteorder('<'), copy=False).tostring()
+        if self.compression:
+            data = zlib.compress(data, self.compression)
+        offset = self._fid.tell()
+        if offset + len(data) > _MAX_OFFSET:
+            raise ValueError("%s exceeds the size of a classic TIFF" %
+                             self.fname)
+        self._fid.write(data)
+        self._strip_offsets.append(offset)
+        self._strip_nbytes.append(len(data))
+        self.rows_written += self._pending_rows
+        self._pending = []
+        self._pending_rows = 0
+
+    def _tags(self):
+        bits = self.dtype.itemsize * 8
+        sample_format = _SAMPLEFORMAT_IEEEFP if self.dtype.kind == 'f' \
+            else _SAMPLEFORMAT_UINT
+        color_bands = self.bands - 1 if self.alpha else self.bands
+        tags = [
+            (256, _LONG, [self.width]),
+            (257, _LONG, [self.height]),
+            (258, _SHORT, [bits] * self.bands),
+            (259, _SHORT, [_COMPRESSION_DEFLATE if self.compression
+                           else _COMPRESSION_NONE]),
+            (262, _SHORT, [_PHOTOMETRIC_RGB if color_bands >= 3
+                           else _PHOTOMETRIC_MINISBLACK]),
+            (273, _LONG, self._strip_offsets),
+            (277, _SHORT, [self.bands]),
+            (278, _LONG, [self.rows_per_strip]),
+            (279, _LONG, self._strip_nbytes),
+            (284, _SHORT, [1]),
+            (305, _ASCII, 'dwd_extensions strip_writer\0'),
+            (339, _SHORT, [sample_format] * self.bands)]
+        if self.alpha or color_bands not in (1, 3):
+            extra = self.bands - (3 if color_bands >= 3 else 1)
+            tags.append((338, _SHORT,
+                         [0] * (extra - 1) + [_EXTRASAMPLE_UNASSOCALPHA
+                                              if self.alpha else 0]))
+        if self.geotransform is not None:
+            x_ul, x_res, _, y_ul, _, y_res = self.geotransform
+            tags.append((33550, _DOUBLE, [x_res, abs(y_res), 0.0]))
+            tags.append((33922, _DOUBLE, [0.0, 0.0, 0.0, x_ul, y_ul, 0.0]))
+        if self.nodata is not None:
+            tags.append((42113, _ASCII, '%s\0' % self.nodata))
+        return sorted(tags)
+
+    def close(self):
+        '''Write the remaining rows and the directory of the file.
+        '''
+        self._write_strip()
+        if self.rows_written != self.height:
+            self.abort()
+            raise ValueError("%d of %d rows written to %s" %
+                             (self.rows_written, self.height, self.fname))
+        fid = self._fid
+        if fid.tell() % 2:
+            fid.write('\0')
+        tags = self._tags()
+        ifd_offset = fid.tell()
+        # values of more than 4 bytes follow the directory
+        data_offset = ifd_offset + 2 + 12 * len(tags) + 4
+        entries = []
+        extra = []
+        for code, tag_type, values in tags:
+            if tag_type == _ASCII:
+                data = values
+            else:
+                data = struct.pack('<%d%s' % (len(values),
+                                              _TYPE_FORMATS[tag_type]),
+                                   *values)
+            if len(data) <= 4:
+                entries.append(struct.pack('<HHI4s', code, tag_type,
+                                           len(values), data.ljust(4, '\0')))
+            else:
+                entries.append(struct.pack('<HHII', code, tag_type,
+                                           len(values), data_offset))
+                extra.append(data)
+                data_offset += len(data) + len(data) % 2
+                if len(data) % 2:
+                    extra.append('\0')
+        fid.write(struct.pack('<H', len(tags)))
+        fid.write(''.join(entries))
+        fid.write(struct.pack('<I', 0))
+        fid.write(''.join(extra))
+        fid.seek(4)
+        fid.write(struct.pack('<I', ifd_offset))
+        fid.close()
+
+    def abort(self):
+        '''Close and remove the incomplete file.
+        '''
+        if not self._fid.closed:
+            self._fid.close()
+        if os.path.exists(self.fname):
+            os.remove(self.fname)
+
+
+class BlockImage(object):
+
+    """Image of *shape* (height, width) computed block by block while
+    it is saved. *blocks* is called (without arguments) for every save
+    and returns an iterable of row blocks, each a list of channels
+    (masked arrays of rows x width with values from 0 to 1, like the
+    channels of a GeoImage). Only this module can save it.
+    """
+
+    def __init__(self, blocks, shape, area, time_slot=None, mode='L',
+                 fill_value=None):
+        self.blocks = blocks
+        self.shape = tuple(shape)
+        self.area = area
+        self.time_slot = time_slot
+        self.mode = mode
+        self.fill_value = fill_value
+
+    def save(self, filename, compression=6, fformat=None,
+             writer_options=None, **kwargs):
+        '''Save the image with this module as format (see save)
+        '''
+        if fformat not in (None, __name__):
+            raise ValueError("%s is computed block by block, it can only "
+                             "be saved as %s, not as %s" %
+                             (filename, __name__, fformat))
+        writer_options = dict(writer_options or {})
+        if compression is not None:
+            writer_options.setdefault(write_opts.WR_OPT_COMPRESSION,
+                                      compression)
+        save(self, filename, writer_options=writer_options, **kwargs)
+
+
+def save_blocks(blocks, fname, width, height, **kwargs):
+    '''Write the row *blocks* (any iterable, e.g. a generator computing
+    the product block by block) to *fname*, the keyword arguments are
+    passed to StripWriter.
+    '''
+    with StripWriter(fname, width, height, **kwargs) as writer:
+        for block in blocks:
+            writer.write(block)
+
+
+def area_geotransform(area):
+    '''Return the GDAL geotransform of the AreaDefinition *area*
+    '''
+    x_ll, _, _, y_ur = area.area_extent
+    return (x_ll, area.pixel_size_x, 0, y_ur, 0, -area.pixel_size_y)
+
+
+def _image_size(geo_img):
+    '''Return the height, width and number of channels of *geo_img*
+    '''
+    if isinstance(geo_img, BlockImage):
+        return geo_img.shape + (len(geo_img.mode),)
+    return geo_img.channels[0].shape + (len(geo_img.channels),)
+
+
+def _fill_values(geo_img):
+    '''Return the fill values of the channels of *geo_img* (None if
+    masked pixels are transparent)
+    '''
+    fill_value = geo_img.fill_value
+    if fill_value is None or isinstance(fill_value, (tuple, list)):
+        return fill_value
+    # e.g. (0) of a single channel image
+    return (fill_value,) * _image_size(geo_img)[2]
+
+
+def channel_blocks(geo_img, rows=DEFAULT_ROWS_PER_STRIP):
+    '''Generate the channels of *geo_img* in blocks of rows, *rows* rows
+    each unless the image is a BlockImage.
+    '''
+    if isinstance(geo_img, BlockImage):
+        for block in geo_img.blocks():
+            yield block
+        return
+    height = geo_img.channels[0].shape[0]
+    for start in xrange(0, height, rows):
+        yield [chn[start:start + rows] for chn in geo_img.channels]
+
+
+def image_blocks(geo_img, dtype=np.uint8, rows=DEFAULT_ROWS_PER_STRIP,
+                 fill_value_subst=None):
+    '''Generate the channels of *geo_img* (scaled to the range of
+    *dtype*) in blocks of *rows* rows (see channel_blocks), masked pixels
+    get the fill value of the image or are transparent in an additional
+    alpha channel. Data equal to the fill value is replaced by
+    *fill_value_subst*. Channels of 8 bit (QuantizedImage) are scaled to
+    *dtype* as they are.
+    '''
+    maxval = np.iinfo(dtype).max
+    fill_value = _fill_values(geo_img)
+    for parts in channel_blocks(geo_img, rows):
+        bands = []
+        mask = None
+        for idx, part in enumerate(parts):
+            if part.dtype == np.uint8:
+                data = part.data.astype(dtype) * (maxval // 255)
+            else:
+                data = (np.ma.getdata(part).clip(0, 1) *
+                        maxval).astype(dtype)
+            chn_mask = np.ma.getmaskarray(part)
+            if fill_value is not None:
+                fill = int(fill_value[idx] * maxval)
+                if fill_value_subst is not None:
+                    data[data == fill] = int(fill_value_subst)
+                data[chn_mask] = fill
+            else:
+                mask = chn_mask if mask is None else mask & chn_mask
+            bands.append(data)
+        if fill_value is None:
+            bands.append(np.where(mask, 0, maxval).astype(dtype))
+        yield np.dstack(bands)
+
+
+def save(geo_img, filename, writer_options=None,
+         rows_per_strip=DEFAULT_ROWS_PER_STRIP, **kwargs):
+    '''Save the GeoImage (or BlockImage) *geo_img* to *filename* block by
+    block (entry point of GeoImage.save for this module as format). The
+    writer options (nbits, compression, fill_value_subst) can be given as
+    keyword arguments as well.
+    '''
+    options = dict(kwargs)
+    options.update(writer_options or {})
+    writer_options = options
+    if geo_img.mode in ('P', 'PA'):
+        geo_img.convert('RGBA' if geo_img.mode == 'PA' else 'RGB')
+    nbits = int(writer_options.get(write_opts.WR_OPT_NBITS) or 8)
+    dtype = np.uint16 if nbits > 8 else np.uint8
+    compression = writer_options.get(write_opts.WR_OPT_COMPRESSION, 6)
+    height, width, num_channels = _image_size(geo_img)
+    fill_value = _fill_values(geo_img)
+    alpha = fill_value is None or geo_img.mode in ('LA', 'RGBA')
+    bands = num_channels + (1 if fill_value is None else 0)
+    nodata = None
+    if fill_value is not None and len(set(fill_value)) == 1 and not alpha:
+        nodata = int(fill_value[0] * np.iinfo(dtype).max)
+    geotransform = area_geotransform(geo_img.area) \
+        if getattr(geo_img.area, 'area_extent', None) is not None else None
+
+    rows_per_strip = int(rows_per_strip)
+    blocks = image_blocks(
+        geo_img, dtype, rows_per_strip,
+        writer_options.get(write_opts.WR_OPT_FILL_VALUE_SUBST))
+    save_blocks(blocks, filename, width, height, bands=bands, dtype=dtype,
+                compression=compression, rows_per_strip=rows_per_strip,
+                alpha=alpha, geotransform=geotransform, nodata=nodata)
+    LOGGER.debug("%s written in strips of %d rows", filename,
+                 rows_per_strip)
@@ -0,0 +1,140 @@
+# -*- coding: utf-8 -*-
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+'''Cache of compiled trollsift templates
+
+Composing a string without any {} placeholder returns the string
+itself, so only values containing placeholders have to be resolved.
+For config dicts (like postprocessor rules) the keys containing
+placeholders are determined once and reused for every message.
+'''
+
+import threading
+
+from trollsift import Parser
+
+
+def has_placeholders(value):
+    '''Check if the string *value* contains trollsift placeholders
+    '''
+    return '{' in value
+
+
+def template_plan(mapping):
+    '''Return the keys of *mapping* with values to be resolved: a dict
+    with True for template strings and a nested plan for dict values
+    containing templates. Keys not in the plan are left unchanged.
+    '''
+    plan = {}
+    for key, value in mapping.iteritems():
+        if isinstance(value, basestring):
+            if has_placeholders(value):
+                plan[key] = True
+        elif isinstance(value, dict):
+            sub_plan = template_plan(value)
+            if sub_plan:
+                plan[key] = sub_plan
+    return plan
+
+
+class TemplateCache(object):
+
+    """Caches trollsift Parser objects per pattern string and the
+    template plans of config dicts.
+    """
+
+    def __init__(self, max_parsers=4096):
+        self._parsers = {}
+        self._plans = {}
+        self._max_parsers = max_parsers
+        self._lock = threading.Lock()
+
+    def parser(self, pattern):
+        '''Return the (cached) Parser for *pattern*
+        '''
+        try:
+            return self._parsers[pattern]
+        except KeyError:
+            par = Parser(pattern)
+            with self._lock:
+                if len(self._parsers) >= self._max_parsers:
+                    self._parsers.clear()
+                self._parsers[pattern] = par
+            return par
+
+    def compose(self, pattern, params):
+        '''Compose *pattern* with *params*
+        '''
+        if not has_placeholders(pattern):
+            return pattern
+        return self.parser(pattern).compose(params)
+
+    def plan(self, mapping):
+        '''Return the (cached) template plan of the config dict *mapping*.
+        *mapping* must not be modified after the first call.
+        '''
+        try:
+            return self._plans[id(mapping)][1]
+        except KeyError:
+            plan = template_plan(mapping)
+            with self._lock:
+                # keep a reference so that the id is not reused
+                self._plans[id(mapping)] = (mapping, plan)
+            return plan
+
+    def clear_plans(self):
+        '''Forget all template plans (e.g. after a config reload)
+        '''
+        with self._lock:
+            self._plans.clear()
+
+    def resolve(self, params, ref_params, config=None):
+        '''Resolve all string values of *params* (recursively for dict
+        values) with *ref_params*. Values taken unchanged from the
+        config dict *config* are resolved according to its plan.
+        '''
+        plan = self.plan(config) if config is not None else None
+        resolved_params = dict()
+        for key, value in params.iteritems():
+            if plan is not None and config.get(key, None) is value:
+                sub_plan = plan.get(key)
+                if sub_plan is None:
+                    resolved_params[key] = value
+                elif sub_plan is True:
+                    resolved_params[key] = self.compose(value, ref_params)
+                else:
+                    resolved_params[key] = self._resolve_planned(
+                        value, sub_plan, ref_params)
+            else:
+                resolved_params[key] = self._resolve_value(value,
+                                                           ref_params)
+        return resolved_params
+
+    def _resolve_planned(self, params, plan, ref_params):
+        resolved_params = dict(params)
+        for key, sub_plan in plan.iteritems():
+            if sub_plan is True:
+                resolved_params[key] = self.compose(params[key], ref_params)
+            else:
+                resolved_params[key] = self._resolve_planned(
+                    params[key], sub_plan, ref_params)
+        return resolved_params
+
+    def _resolve_value(self, value, ref_params):
+        if isinstance(value, basestring):
+            return self.compose(value, ref_params)
+        elif isinstance(value, dict):
+            return dict((key, self._resolve_value(val, ref_params))
+                        for key, val in value.iteritems())
+        return value
@@ -10,7 +10,7 @@ import os
 import logging
 import numpy as np
 from mpop.channel import Channel
-from mpop.projector import get_area_def
+from dwd_extensions.tools.area_cache import get_lonlats
 from dwd_extensions.tools.config_watcher import ConfigWatcher
 
 LOGGER = logging.getLogger(__name__)
@@ -342,8 +342,7 @@ def get_view_zen_angles(sat_name, tle_filename, area_def_name,
         LOGGER.warning("Could not load pyorbital modules")
         return
 
-    area_def = get_area_def(area_def_name)
-    lons, lats = area_def.get_lonlats()
+    lons, lats = get_lonlats(area_def_name)
     orbital_obj = Orbital(sat_name, tle_filename)
     elevation = orbital_obj.get_observer_look(time_slot, lons, lats, 0)[1]
     view_zen_data = np.subtract(90, np.ma.masked_outside(elevation, 0, 90))
@@ -357,15 +356,15 @@ def get_geostationary_view_zen_angles(sublon, area_def_name):
     Stores the result in the given *cache* parameter.
     """
 
-    area_def = get_area_def(area_def_name)
-    lons, lats = area_def.get_lonlats()
+    lons, lats = get_lonlats(area_def_name)
 
     TWOPI = 6.28318
     R = 6371.
     H = 35680.
     DEGRAD = 360. / TWOPI
 
-    zlon = np.ma.masked_array(lons)
+    # (the cached longitudes are read-only)
+    zlon = np.ma.masked_array(lons, copy=True)
     zlon[zlon < 0] += 360.
 
     zsublon = sublon
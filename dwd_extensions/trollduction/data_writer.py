@@ -0,0 +1,752 @@
+# -*- coding: utf-8 -*-
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+'''Pool of writer threads used by the postprocessor
+
+Write jobs for the same destination file are executed in the order they
+were queued, the number of jobs running concurrently for one out_box
+can be limited. A job may wait for other jobs (e.g. publishing a file
+encoded by a job of another out_box) while keeping its place in the
+order of its destination file. Optionally the jobs are executed in a
+pool of worker processes (the job function has to be picklable then,
+i.e. a module level function). Jobs holding images are queued with
+*in_process* and run in the writer threads, so that only file names
+are sent to the workers. The measurements and rrd updates of a worker
+are recorded and submitted by the parent process.
+
+The postprocessor configures the pool with the post_processing settings
+writer_threads (default 1) and writer_processes (default 0), out_boxes
+may limit their concurrent writes with <max_concurrent_writes>.
+
+Out_boxes may be assigned to writer lanes (e.g. one per out_box or per
+filesystem), each with its own threads, bandwidth limit and timeout, so
+that a degraded target (e.g. a hanging NFS export) only delays the
+writes of its own lane.
+'''
+
+import logging
+import multiprocessing
+import os
+import pickle
+import threading
+import time
+from collections import deque
+
+from dwd_extensions.tools.instrumentation import get_instrumentation
+from dwd_extensions.tools.rrd_utils import get_rrd_sink
+from dwd_extensions.tools.rrd_utils import submit_rrd_updates
+
+LOGGER = logging.getLogger("postprocessor")
+INSTRUMENTATION = get_instrumentation()
+
+DEFAULT_LANE = 'default'
+
+LANE_BY_NONE = 'none'
+LANE_BY_OUT_BOX = 'out_box'
+LANE_BY_FILESYSTEM = 'filesystem'
+
+MBYTE = float(2 ** 20)
+
+
+class WriteJob(object):
+
+    """A single job of the DataWriter.
+    """
+
+    def __init__(self, out_box, dest_fname, fun, args, kwargs,
+                 tracker=None, droppable=True, in_process=False):
+        self.out_box = out_box
+        self.dest_fname = dest_fname
+        self.fun = fun
+        self.args = args
+        self.kwargs = kwargs
+        self.tracker = tracker
+        # False if the job must run even if it waited longer than the
+        # timeout of its lane (e.g. it cleans up after an earlier job)
+        self.droppable = droppable
+        # True if the job must not be sent to a worker process (e.g. its
+        # arguments are too large to be pickled)
+        self.in_process = in_process
+        # set when the job is ready to run, i.e. queued in its lane
+        self.t_queued = None
+        self.lane = None
+        self.done = False
+        # jobs started when this one is done and number of unfinished
+        # jobs this one waits for
+        self.dependents = []
+        self.num_after = 0
+        self.parked = False
+
+
+class MessageTracker(object):
+
+    """Tracks the write jobs queued for one message.
+
+    *callback* is called with the tracker when all jobs are done and
+    *seal* was called (i.e. no more jobs will be added).
+    """
+
+    def __init__(self, name, callback=None):
+        self.name = name
+        self.callback = callback
+        self.t_start = time.time()
+        self.t_done = None
+        self.nbytes = 0
+        # bytes of decoded images held until all jobs are done
+        self.image_nbytes = 0
+        # directories to fsync when all jobs are done
+        self.sync_dirs = set()
+        # False if the data of the message was incomplete or corrupted
+        self.data_ok = True
+        # number of jobs registered so far
+        self.num_jobs = 0
+        self._pending = 0
+        self._sealed = False
+        self._lock = threading.Lock()
+        self._done = threading.Event()
+
+    def add_job(self):
+        '''Register a queued job.
+        '''
+        with self._lock:
+            self._pending += 1
+            self.num_jobs += 1
+
+    def job_done(self):
+        '''Register a finished job.
+        '''
+        with self._lock:
+            self._pending -= 1
+            finished = self._sealed and self._pending == 0
+        if finished:
+            self._finish()
+
+    def seal(self):
+        '''Mark that all jobs of the message are queued.
+        '''
+        with self._lock:
+            self._sealed = True
+            finished = self._pending == 0
+        if finished:
+            self._finish()
+
+    def _finish(self):
+        self.t_done = time.time()
+        try:
+            if self.callback is not None:
+                self.callback(self)
+        finally:
+            self._done.set()
+
+    def duration(self):
+        '''Seconds from creation until all jobs were done (or now).
+        '''
+        return (self.t_done or time.time()) - self.t_start
+
+    def wait(self, timeout=None):
+        '''Block until all jobs are done.
+        '''
+        if timeout is None:
+            # wait in steps to stay responsive to signals
+            while not self._done.is_set():
+                self._done.wait(1)
+        else:
+            self._done.wait(timeout)
+        return self._done.is_set()
+
+
+class InFlightLimiter(object):
+
+    """Limits the number of messages (and image bytes) processed but not
+    yet completely written. A limit of 0 or None means unlimited.
+    """
+
+    def __init__(self, max_messages=None, max_bytes=None):
+        self._cond = threading.Condition()
+        self.messages = 0
+        self.nbytes = 0
+        self.max_messages = max_messages
+        self.max_bytes = max_bytes
+
+    def configure(self, max_messages=None, max_bytes=None):
+        '''Set the limits.
+        '''
+        with self._cond:
+            self.max_messages = max_messages
+            self.max_bytes = max_bytes
+            self._cond.notify_all()
+
+    def begin(self):
+        '''Block until another message may be processed.
+        '''
+        with self._cond:
+            while self.max_messages and self.messages >= self.max_messages:
+                self._cond.wait(1)
+            self.messages += 1
+
+    def add_bytes(self, nbytes, own_nbytes=0):
+        '''Account *nbytes* for the current message (which already holds
+        *own_nbytes*), blocks while the byte limit is exceeded and other
+        messages hold bytes. A message alone may exceed the limit.
+        '''
+        with self._cond:
+            while self.max_bytes and self.nbytes - own_nbytes > 0 and \
+                    self.nbytes + nbytes > self.max_bytes:
+                self._cond.wait(1)
+            self.nbytes += nbytes
+
+    def finish(self, nbytes=0):
+        '''Release a message and its *nbytes*.
+        '''
+        with self._cond:
+            self.messages -= 1
+            self.nbytes -= nbytes
+            self._cond.notify_all()
+
+
+class _Value(object):
+
+    """Single process stand-in for a multiprocessing.Value.
+    """
+
+    def __init__(self, value):
+        self.value = value
+
+
+class MemoryBudget(object):
+
+    """Accounts the bytes of the decoded images in flight (from decoding
+    until all their outputs are written) against *max_bytes* (0 or None
+    means unlimited). A *shared* budget is accounted across all processes
+    forked after its creation (e.g. the shard workers).
+    """
+
+    def __init__(self, max_bytes=None, shared=False):
+        if shared:
+            self._cond = multiprocessing.Condition()
+            value = lambda val: multiprocessing.RawValue('d', val)
+        else:
+            self._cond = threading.Condition()
+            value = _Value
+        self.shared = shared
+        self._max_bytes = value(max_bytes or 0)
+        self._used = value(0)
+        self._peak = value(0)
+        self._waits = value(0)
+        self._wait_seconds = value(0)
+
+    def configure(self, max_bytes=None):
+        '''Set the budget.
+        '''
+        with self._cond:
+            self._max_bytes.value = max_bytes or 0
+            self._cond.notify_all()
+
+    def admit(self, expected_bytes=0):
+        '''Block while the budget is exhausted, i.e. until no image is in
+        flight or *expected_bytes* more fit into the budget. Returns the
+        seconds waited.
+        '''
+        t_start = time.time()
+        waited = 0
+        with self._cond:
+            while self._max_bytes.value and self._used.value > 0 and \
+                    self._used.value + expected_bytes > self._max_bytes.value:
+                self._cond.wait(1)
+                waited = time.time() - t_start
+            if waited:
+                self._waits.value += 1
+                self._wait_seconds.value += waited
+        return waited
+
+    def acquire(self, nbytes):
+        '''Account the *nbytes* of a decoded image.
+        '''
+        with self._cond:
+            self._used.value += nbytes
+            self._peak.value = max(self._peak.value, self._used.value)
+
+    def release(self, nbytes):
+        '''Release the *nbytes* of images no longer in flight.
+        '''
+        if not nbytes:
+            return
+        with self._cond:
+            self._used.value -= nbytes
+            self._cond.notify_all()
+
+    def used(self):
+        '''Return the bytes currently in flight
+        '''
+        return self._used.value
+
+    def stats(self):
+        '''Return the budget, the current and peak usage (MB) and the
+        number and duration of waits
+        '''
+        with self._cond:
+            return {'budget_mbytes': self._max_bytes.value / MBYTE,
+                    'used_mbytes': self._used.value / MBYTE,
+                    'peak_mbytes': self._peak.value / MBYTE,
+                    'waits': int(self._waits.value),
+                    'wait_seconds': self._wait_seconds.value}
+
+
+def _is_picklable(fun):
+    try:
+        pickle.dumps(fun)
+        return True
+    except Exception:
+        return False
+
+
+def _run_in_worker(fun, args, kwargs):
+    '''Run a job in a worker process, returns the measurements and rrd
+    updates made by the job (to be recorded by the parent process)
+    '''
+    sink = get_rrd_sink()
+    updates = []
+    with INSTRUMENTATION.capture() as records:
+        try:
+            if sink is None:
+                fun(*args, **kwargs)
+            else:
+                with sink.capture() as updates:
+                    fun(*args, **kwargs)
+        except BaseException:
+            LOGGER.exception("Unexpected error")
+    return records, updates
+
+
+def _file_size(fname):
+    try:
+        return os.path.getsize(fname)
+    except (OSError, TypeError):
+        return 0
+
+
+def mount_point(dirname):
+    '''Return the mount point of the filesystem holding *dirname* (or
+    its nearest existing parent directory)
+    '''
+    path = os.path.abspath(dirname or '.')
+    while not os.path.exists(path) and os.path.dirname(path) != path:
+        path = os.path.dirname(path)
+    dev = os.stat(path).st_dev
+    while os.path.dirname(path) != path:
+        parent = os.path.dirname(path)
+        if os.stat(parent).st_dev != dev:
+            break
+        path = parent
+    return path
+
+
+def lane_config(out_boxes, settings):
+    '''Return the writer lanes (dict of lane name and settings) and the
+    lane of each out_box configured in the post_processing *settings*
+    and the *out_boxes*:
+
+    - an out_box with <writer_lane> uses the lane of that name,
+    - otherwise writer_lanes selects one lane per out_box ("out_box"),
+      per filesystem of the output_dir ("filesystem") or the shared
+      default lane ("none", default).
+
+    The lane settings are taken from the (first) out_box of the lane
+    defining <lane_threads> (default 1), <lane_mbytes_per_second> and
+    <lane_timeout>, the default lane uses writer_threads,
+    writer_mbytes_per_second and writer_timeout.
+    '''
+    lane_by = settings.get('writer_lanes', LANE_BY_NONE)
+    if lane_by not in (LANE_BY_NONE, LANE_BY_OUT_BOX, LANE_BY_FILESYSTEM):
+        LOGGER.error("Unknown writer_lanes '%s', using '%s'",
+                     lane_by, LANE_BY_NONE)
+        lane_by = LANE_BY_NONE
+    lanes = {DEFAULT_LANE: {
+        'num_threads': settings.get('writer_threads', 1),
+        'mbytes_per_second': settings.get('writer_mbytes_per_second'),
+        'timeout': settings.get('writer_timeout')}}
+    out_box_lanes = {}
+    for name in sorted(out_boxes):
+        box = out_boxes[name]
+        lane = box.get('writer_lane')
+        if not lane and lane_by == LANE_BY_OUT_BOX:
+            lane = name
+        elif not lane and lane_by == LANE_BY_FILESYSTEM:
+            try:
+                lane = mount_point(box.get('output_dir'))
+            except OSError as err:
+                LOGGER.warning("Cannot find the filesystem of out_box %s "
+                               "(%s)", name, err)
+        if not lane or lane == DEFAULT_LANE:
+            continue
+        out_box_lanes[name] = lane
+        lane_settings = lanes.setdefault(lane, {})
+        for key, lane_key in (('lane_threads', 'num_threads'),
+                              ('lane_mbytes_per_second',
+                               'mbytes_per_second'),
+                              ('lane_timeout', 'timeout')):
+            if key in box:
+                lane_settings.setdefault(lane_key, box[key])
+    return lanes, out_box_lanes
+
+
+class WriterLane(object):
+
+    """Queue of write jobs with its own writer threads (e.g. for one
+    out_box or filesystem), so that a slow target does not delay the
+    writes of other lanes. The written bytes per second of the lane are
+    limited to *mbytes_per_second*, droppable jobs waiting longer than
+    *timeout* seconds in the lane are dropped (the time spent waiting
+    for other jobs or an out_box limit does not count).
+    """
+
+    def __init__(self, name, lock, num_threads=1, mbytes_per_second=None,
+                 timeout=None):
+        self.name = name
+        self.cond = threading.Condition(lock)
+        self.ready = deque()
+        self.threads = []
+        self.num_threads = 1
+        self.bytes_per_second = None
+        self.timeout = None
+        self.next_start = 0.0
+        self.active = 0
+        self.done = 0
+        self.dropped = 0
+        self.slow = 0
+        self.nbytes = 0
+        self.max_queued = 0
+        self.configure(num_threads, mbytes_per_second, timeout)
+
+    def configure(self, num_threads=1, mbytes_per_second=None,
+                  timeout=None):
+        '''Set the number of threads, the bandwidth limit and the timeout
+        (None or 0: unlimited).
+        '''
+        self.num_threads = max(1, int(num_threads))
+        self.bytes_per_second = float(mbytes_per_second) * MBYTE \
+            if mbytes_per_second else None
+        self.timeout = float(timeout) if timeout else None
+
+    def stats(self):
+        '''Return the queue depth and counters of the lane
+        '''
+        return {'threads': self.num_threads,
+                'queued': len(self.ready),
+                'max_queued': self.max_queued,
+                'active': self.active,
+                'done': self.done,
+                'dropped': self.dropped,
+                'slow': self.slow,
+                'mbytes': self.nbytes / MBYTE}
+
+
+class DataWriter(object):
+
+    """Writes data to disk.
+
+    This is separate from the DataProcessor since it IO takes time and we don't
+    want to block processing. The jobs are executed by *num_threads*
+    writer threads (in *num_processes* worker processes if > 0).
+    *out_box_limits* maps out_box names to the maximum number of
+    concurrent jobs for that out_box. Out_boxes mapped to a lane by
+    *out_box_lanes* are written by the threads of that lane, *lanes*
+    maps the lane names to the WriterLane settings.
+    """
+
+    def __init__(self, num_threads=1, num_processes=0, out_box_limits=None,
+                 lanes=None, out_box_lanes=None):
+        self._lock = threading.Lock()
+        self._cond = threading.Condition(self._lock)
+        self._lanes = {DEFAULT_LANE: WriterLane(DEFAULT_LANE, self._lock)}
+        self._active_dests = set()
+        self._dest_waiting = {}
+        self._box_active = {}
+        self._box_waiting = {}
+        self._unfinished = 0
+        self._loop = True
+        self._started = False
+        self._num_processes = 0
+        self._proc_pool = None
+        self.out_box_limits = {}
+        self.out_box_lanes = {}
+        self.configure(num_threads, num_processes, out_box_limits, lanes,
+                       out_box_lanes)
+
+    def configure(self, num_threads=1, num_processes=0, out_box_limits=None,
+                  lanes=None, out_box_lanes=None):
+        '''Set the number of writer threads and processes, the per
+        out_box limits and the writer lanes. Can be called while the
+        writer is running.
+        '''
+        lanes = dict(lanes or {})
+        default = dict(lanes.pop(DEFAULT_LANE, {}))
+        default['num_threads'] = num_threads
+        num_processes = max(0, int(num_processes))
+        with self._lock:
+            self.out_box_limits = dict(out_box_limits or {})
+            self.out_box_lanes = dict((out_box, lane) for out_box, lane in
+                                      (out_box_lanes or {}).iteritems()
+                                      if lane in lanes)
+            self._lanes[DEFAULT_LANE].configure(**default)
+            for name, lane_settings in lanes.iteritems():
+                if name in self._lanes:
+                    self._lanes[name].configure(**lane_settings)
+                else:
+                    self._lanes[name] = WriterLane(name, self._lock,
+                                                   **lane_settings)
+            for name in self._lanes.keys():
+                if name != DEFAULT_LANE and name not in lanes:
+                    # its threads exit, the queued jobs move to the
+                    # new lanes of their out_boxes
+                    lane = self._lanes.pop(name)
+                    lane.num_threads = 0
+                    while lane.ready:
+                        self._enqueue(lane.ready.popleft())
+                    lane.cond.notify_all()
+            if num_processes != self._num_processes:
+                old_pool = self._proc_pool
+                self._proc_pool = None
+                if num_processes > 0:
+                    self._proc_pool = multiprocessing.Pool(num_processes)
+                self._num_processes = num_processes
+                if old_pool is not None:
+                    old_pool.close()
+            self._release_waiting_boxes()
+            for lane in self._lanes.itervalues():
+                lane.cond.notify_all()
+        if self._started:
+            self._start_threads()
+
+    def start(self):
+        '''Start the writer threads.
+        '''
+        self._started = True
+        self._start_threads()
+
+    def _start_threads(self):
+        with self._lock:
+            lanes = self._lanes.values()
+        for lane in lanes:
+            lane.threads = [thr for thr in lane.threads if thr.is_alive()]
+            while len(lane.threads) < lane.num_threads:
+                thr = threading.Thread(target=self.run,
+                                       args=(len(lane.threads), lane))
+                thr.daemon = True
+                lane.threads.append(thr)
+                thr.start()
+
+    def run(self, thread_idx=0, lane=None):
+        """Run a writer thread of *lane* (default: the default lane).
+        """
+        if lane is None:
+            lane = self._lanes[DEFAULT_LANE]
+        while True:
+            with self._lock:
+                while True:
+                    if not self._loop or thread_idx >= lane.num_threads:
+                        return
+                    delay = lane.next_start - time.time()
+                    if lane.ready and delay <= 0:
+                        break
+                    # bandwidth limit: wait until the lane may write again,
+                    # otherwise until a job is queued (every change of
+                    # the lane notifies its condition)
+                    lane.cond.wait(delay if lane.ready else None)
+                job = lane.ready.popleft()
+                lane.active += 1
+                proc_pool = self._proc_pool
+            t_start = time.time()
+            waited = t_start - job.t_queued
+            INSTRUMENTATION.record('writer_queue', waited,
+                                   out_box=job.out_box)
+            if job.droppable and lane.timeout is not None and \
+                    waited > lane.timeout:
+                LOGGER.error("Dropping write of %s, waited %.1f s in writer "
+                             "lane %s", job.dest_fname, waited, lane.name)
+                self._job_done(job, dropped=True)
+                continue
+            try:
+                if proc_pool is not None and not job.in_process and \
+                        _is_picklable(job.fun):
+                    records, updates = proc_pool.apply(
+                        _run_in_worker, (job.fun, job.args, job.kwargs))
+                    for record in records:
+                        INSTRUMENTATION.record(*record)
+                    submit_rrd_updates(updates)
+                else:
+                    job.fun(*job.args, **job.kwargs)
+            except BaseException:
+                LOGGER.exception("Unexpected error")
+            finally:
+                self._job_done(job, t_start, _file_size(job.dest_fname))
+                job = None
+
+    def write(self, fun, *args, **kwargs):
+        '''Write to queue.
+        '''
+        self.write_to(None, None, fun, *args, **kwargs)
+
+    def write_to(self, out_box, dest_fname, fun, *args, **kwargs):
+        '''Queue a job writing *dest_fname* to *out_box*, returns the
+        WriteJob. The keyword arguments *tracker* (a MessageTracker) and
+        *after* (WriteJobs to be done before this one starts, whether
+        they succeeded or not), *droppable* (False: never dropped by
+        the lane timeout) and *in_process* (True: never run in a worker
+        process) are not passed to *fun*.
+        '''
+        tracker = kwargs.pop('tracker', None)
+        after = kwargs.pop('after', ())
+        droppable = kwargs.pop('droppable', True)
+        in_process = kwargs.pop('in_process', False)
+        job = WriteJob(out_box, dest_fname, fun, args, kwargs, tracker,
+                       droppable, in_process)
+        if tracker is not None:
+            tracker.add_job()
+        with self._lock:
+            for prev in after:
+                if not prev.done:
+                    prev.dependents.append(job)
+                    job.num_after += 1
+            self._unfinished += 1
+            self._dispatch(job)
+        return job
+
+    def _dispatch(self, job):
+        # called with self._lock acquired
+        if job.dest_fname is not None:
+            if job.dest_fname in self._active_dests:
+                self._dest_waiting.setdefault(job.dest_fname,
+                                              deque()).append(job)
+                return
+            self._active_dests.add(job.dest_fname)
+
+        if job.num_after:
+            # keeps its destination until the jobs it waits for are done
+            job.parked = True
+            return
+        self._dispatch_to_box(job)
+
+    def _dispatch_to_box(self, job):
+        # called with self._lock acquired
+        limit = self.out_box_limits.get(job.out_box)
+        if limit is not None and \
+                self._box_active.get(job.out_box, 0) >= limit:
+            self._box_waiting.setdefault(job.out_box, deque()).append(job)
+            return
+        self._box_active[job.out_box] = \
+            self._box_active.get(job.out_box, 0) + 1
+        self._enqueue(job)
+
+    def _enqueue(self, job):
+        # called with self._lock acquired
+        lane = self._lanes.get(self.out_box_lanes.get(job.out_box),
+                               self._lanes[DEFAULT_LANE])
+        job.lane = lane
+        job.t_queued = time.time()
+        lane.ready.append(job)
+        lane.max_queued = max(lane.max_queued, len(lane.ready))
+        lane.cond.notify()
+
+    def _release_waiting_boxes(self):
+        # called with self._lock acquired
+        for out_box, waiting in self._box_waiting.items():
+            limit = self.out_box_limits.get(out_box)
+            while waiting and (limit is None or
+                               self._box_active.get(out_box, 0) < limit):
+                self._box_active[out_box] = \
+                    self._box_active.get(out_box, 0) + 1
+                self._enqueue(waiting.popleft())
+
+    def _job_done(self, job, t_start=None, nbytes=0, dropped=False):
+        with self._lock:
+            lane = job.lane
+            lane.active -= 1
+            if dropped:
+                lane.dropped += 1
+            else:
+                lane.done += 1
+                lane.nbytes += nbytes
+                if lane.bytes_per_second is not None:
+                    lane.next_start = max(lane.next_start, t_start) + \
+                        nbytes / lane.bytes_per_second
+                duration = time.time() - t_start
+                if lane.timeout is not None and duration > lane.timeout:
+                    lane.slow += 1
+                    LOGGER.warning("Writing %s to writer lane %s took "
+                                   "%.1f s", job.dest_fname, lane.name,
+                                   duration)
+
+            self._box_active[job.out_box] -= 1
+            self._release_waiting_boxes()
+
+            job.done = True
+            for dependent in job.dependents:
+                dependent.num_after -= 1
+                if dependent.num_after == 0 and dependent.parked:
+                    dependent.parked = False
+                    self._dispatch_to_box(dependent)
+            job.dependents = []
+
+            if job.dest_fname is not None:
+                self._active_dests.discard(job.dest_fname)
+                waiting = self._dest_waiting.get(job.dest_fname)
+                if waiting:
+                    self._dispatch(waiting.popleft())
+                    if not waiting:
+                        del self._dest_waiting[job.dest_fname]
+
+            self._unfinished -= 1
+            if self._unfinished == 0:
+                self._cond.notify_all()
+
+        if job.tracker is not None:
+            try:
+                job.tracker.job_done()
+            except BaseException:
+                LOGGER.exception("Unexpected error")
+
+    def stats(self):
+        '''Return the queue depth and counters per writer lane, jobs
+        held back by an out_box limit are counted as "waiting".
+        '''
+        with self._lock:
+            res = dict((name, lane.stats())
+                       for name, lane in self._lanes.iteritems())
+            for summary in res.itervalues():
+                summary['waiting'] = 0
+            for out_box, waiting in self._box_waiting.iteritems():
+                name = self.out_box_lanes.get(out_box, DEFAULT_LANE)
+                res[name]['waiting'] += len(waiting)
+        return res
+
+    def join(self):
+        '''Block until all queued jobs are done.
+        '''
+        with self._lock:
+            while self._unfinished > 0:
+                self._cond.wait(1)
+
+    def stop(self):
+        '''Stop the data writer.
+        '''
+        LOGGER.info("stopping data writer")
+        with self._lock:
+            self._loop = False
+            self._cond.notify_all()
+            for lane in self._lanes.itervalues():
+                lane.cond.notify_all()
+            if self._proc_pool is not None:
+                self._proc_pool.close()
+                self._proc_pool = None
@@ -0,0 +1,216 @@
+# -*- coding: utf-8 -*-
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+'''Event loop of the postprocessor
+
+All events (received messages, config changes, finished processing,
+timers) are handled one after the other in the thread running the
+EventLoop. Other threads post their events to the loop, which wakes up
+immediately (self-pipe) instead of polling with timeouts. Blocking or
+CPU heavy work is submitted to an Executor, its result is posted back
+to the loop.
+'''
+
+import Queue
+import errno
+import fcntl
+import heapq
+import itertools
+import logging
+import os
+import select
+import sys
+import threading
+import time
+from collections import deque
+
+LOGGER = logging.getLogger("postprocessor")
+
+
+class EventLoop(object):
+
+    """Single threaded dispatcher of posted events and timers.
+    """
+
+    def __init__(self):
+        self._events = deque()
+        self._timers = []
+        self._seq = itertools.count()
+        self._stopping = False
+        self.thread = None
+        # guards the wakeup pipe against close
+        self._lock = threading.Lock()
+        self._rfd, self._wfd = os.pipe()
+        for fd in (self._rfd, self._wfd):
+            flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+            fcntl.fcntl(fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+
+    def post(self, handler, *args):
+        '''Call *handler* with *args* in the loop (thread safe).
+        '''
+        # deque.append is atomic
+        self._events.append((handler, args))
+        self._wakeup()
+
+    def _wakeup(self):
+        with self._lock:
+            if self._wfd is None:
+                # closed
+                return
+            try:
+                os.write(self._wfd, 'x')
+            except OSError as err:
+                # pipe full: the loop wakes up anyway, closed read end:
+                # the loop is gone
+                if err.errno not in (errno.EAGAIN, errno.EBADF,
+                                     errno.EPIPE):
+                    raise
+
+    def call_later(self, delay, handler, *args):
+        '''Call *handler* with *args* in the loop after *delay* seconds.
+        Returns the timer (see cancel). Only to be called in the loop.
+        '''
+        return self._add_timer(time.time() + delay, None, handler, args)
+
+    def call_every(self, interval, handler, *args):
+        '''Call *handler* with *args* in the loop every *interval*
+        seconds. Returns the timer (see cancel). Only to be called in the
+        loop.
+        '''
+        return self._add_timer(time.time() + interval, interval, handler,
+                               args)
+
+    def _add_timer(self, when, interval, handler, args):
+        timer = [when, next(self._seq), interval, handler, args]
+        heapq.heappush(self._timers, timer)
+        return timer
+
+    @staticmethod
+    def cancel(timer):
+        '''Cancel *timer*
+        '''
+        timer[3] = None
+
+    def stop(self):
+        '''Make the loop return after the current event (thread safe).
+        '''
+        self._stopping = True
+        self._wakeup()
+
+    def run(self):
+        '''Handle events and timers until stop is called.
+        '''
+        self.thread = threading.current_thread()
+        self._stopping = False
+        while not self._stopping:
+            timeout = None
+            if self._timers:
+                timeout = max(0, self._timers[0][0] - time.time())
+            try:
+                select.select([self._rfd], [], [], timeout)
+            except select.error as err:
+                if err.args[0] != errno.EINTR:
+                    raise
+            self._drain()
+            while self._events and not self._stopping:
+                handler, args = self._events.popleft()
+                self._call(handler, args)
+            now = time.time()
+            while self._timers and self._timers[0][0] <= now and \
+                    not self._stopping:
+                timer = heapq.heappop(self._timers)
+                when, _, interval, handler, args = timer
+                if handler is None:
+                    continue
+                if interval is not None:
+                    timer[0] = max(when + interval, now)
+                    heapq.heappush(self._timers, timer)
+                self._call(handler, args)
+
+    def _drain(self):
+        try:
+            while os.read(self._rfd, 4096):
+                pass
+        except OSError as err:
+            if err.errno != errno.EAGAIN:
+                raise
+
+    @staticmethod
+    def _call(handler, args):
+        try:
+            handler(*args)
+        except (KeyboardInterrupt, SystemExit):
+            raise
+        except BaseException:
+            LOGGER.exception("Unexpected error")
+
+    def close(self):
+        '''Close the wakeup pipe, events posted afterwards are not
+        handled anymore.
+        '''
+        with self._lock:
+            fds = (self._rfd, self._wfd)
+            self._rfd = self._wfd = None
+        for fd in fds:
+            if fd is not None:
+                os.close(fd)
+
+
+class Executor(object):
+
+    """Runs blocking or CPU heavy functions in *num_threads* threads, the
+    results are handled by callbacks in the event *loop*.
+    """
+
+    def __init__(self, loop, num_threads=1, name='executor'):
+        self.loop = loop
+        self._queue = Queue.Queue()
+        self._threads = []
+        for idx in range(max(1, int(num_threads))):
+            thr = threading.Thread(target=self._work,
+                                   name='%s-%d' % (name, idx))
+            thr.daemon = True
+            thr.start()
+            self._threads.append(thr)
+
+    def submit(self, fun, args=(), callback=None):
+        '''Call *fun* with *args* in an executor thread, *callback* is
+        called in the loop with the result and the exception (or None).
+        '''
+        self._queue.put((fun, args, callback))
+
+    def _work(self):
+        while True:
+            job = self._queue.get()
+            if job is None:
+                return
+            fun, args, callback = job
+            result = error = None
+            try:
+                result = fun(*args)
+            except BaseException:
+                LOGGER.exception("Unexpected error")
+                error = sys.exc_info()[1]
+            if callback is not None:
+                self.loop.post(callback, result, error)
+
+    def shutdown(self, wait=False):
+        '''Stop the threads after the submitted jobs, optionally waits
+        for them.
+        '''
+        for _ in self._threads:
+            self._queue.put(None)
+        if wait:
+            for thr in self._threads:
+                thr.join()
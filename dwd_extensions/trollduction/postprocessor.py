@@ -26,326 +26,631 @@
 '''
 
 import Queue
+import copy
 import logging
-import shutil
-from threading import Thread
 from urlparse import urlparse
 import datetime as dt
 import os
 import re
 import time
+from collections import OrderedDict
+from threading import Thread
 
 try:
     import rrdtool as rrd
 except ImportError:
     rrd = None
 
-from mpop.projector import get_area_def
-from trollsift import Parser, parse
+from trollsift import parse
 from trollduction.listener import ListenerContainer
 import trollduction.helper_functions as helper_functions
 
-from dwd_extensions.layout import LayoutHandler
+from dwd_extensions.tools.area_cache import get_area_cache
+from dwd_extensions.tools.area_cache import get_area_def
 from dwd_extensions.tools.config_watcher import ConfigWatcher
+from dwd_extensions.tools.downsample import DERIVE_AVERAGE
+from dwd_extensions.tools.downsample import derive_image
+from dwd_extensions.tools.image_io import OVERVIEWS_AUTO
+from dwd_extensions.tools.image_io import add_overviews
+from dwd_extensions.tools.image_io import geotiff_options
+from dwd_extensions.tools.image_io import image_nbytes
+from dwd_extensions.tools.instrumentation import get_instrumentation
 from dwd_extensions.tools.image_io import read_image
+from dwd_extensions.tools.output_index import INDEX_HIT
+from dwd_extensions.tools.output_index import INDEX_LINK
+from dwd_extensions.tools.output_index import OutputIndex
+from dwd_extensions.tools.output_index import output_key
+from dwd_extensions.tools.publish import FSYNC_BATCH
+from dwd_extensions.tools.publish import FSYNC_NONE
+from dwd_extensions.tools.publish import FSYNC_POLICIES
+from dwd_extensions.tools.publish import PUBLISH_COPY
+from dwd_extensions.tools.publish import PUBLISH_LINK
+from dwd_extensions.tools.publish import commit_file
+from dwd_extensions.tools.publish import publish_file
+from dwd_extensions.tools.publish import save_args_key
+from dwd_extensions.tools.publish import sync_dirs
+from dwd_extensions.tools.publish import tmp_filename
 from dwd_extensions.tools.rrd_utils import to_unix_seconds
 from dwd_extensions.tools.rrd_utils import create_rrd_file
 from dwd_extensions.tools.rrd_utils import update_rrd_file
+from dwd_extensions.tools.rrd_utils import configure_rrd_sink
+from dwd_extensions.tools.rrd_utils import get_rrd_sink
+from dwd_extensions.tools.strip_writer import BlockImage
+from dwd_extensions.tools.template_cache import TemplateCache
+from dwd_extensions.trollduction.data_writer import DataWriter
+from dwd_extensions.trollduction.data_writer import InFlightLimiter
+from dwd_extensions.trollduction.data_writer import MemoryBudget
+from dwd_extensions.trollduction.data_writer import MessageTracker
+from dwd_extensions.trollduction.data_writer import lane_config
+from dwd_extensions.trollduction.event_loop import EventLoop
+from dwd_extensions.trollduction.event_loop import Executor
+from dwd_extensions.trollduction.product_config import CONFIG_OUT_BOXES
+from dwd_extensions.trollduction.product_config import CONFIG_RULES
+from dwd_extensions.trollduction.product_config import CONFIG_SETTINGS
+from dwd_extensions.trollduction.product_config import ProductConfig
+from dwd_extensions.trollduction.product_config import ProductConfigCache
+from dwd_extensions.trollduction.product_config import config_changes
+from dwd_extensions.trollduction.rule_index import is_true
+from dwd_extensions.trollduction.scheduler import MessageScheduler
+from dwd_extensions.trollduction.scheduler import SchedulingClass
 
 LOGGER = logging.getLogger("postprocessor")
+INSTRUMENTATION = get_instrumentation()
+
+# seconds after which the receiving thread checks for a restarted listener
+RECEIVE_TIMEOUT = 1
 
 
 class DataProcessor(object):
 
-    """Process the data.
+    """Process the data. The decoded images in flight are accounted in
+    *memory_budget* (a MemoryBudget, e.g. shared by several processes).
     """
 
-    def __init__(self):
+    def __init__(self, memory_budget=None):
         self.product_config = None
-        self._data_ok = True
+        self._runtime_config = None
         self.rrd_dir = 'rrd'
         self.writer = DataWriter()
         self.writer.start()
+        self.in_flight = InFlightLimiter()
+        self.memory = memory_budget if memory_budget is not None \
+            else MemoryBudget()
+        # size of the last image per product and area
+        self._image_nbytes = {}
+        self.pipelined = False
+        self.encode_once = True
+        self.quantized_images = False
+        self.fsync = FSYNC_NONE
+        self.fsync_policies = {}
+        self.timeslot_duration = dt.timedelta(minutes=15)
         self.layout_handler = None
+        self.rule_index = None
+        self.templates = TemplateCache()
+        self.output_index = None
+        self.output_index_db = None
+        self.output_index_keep_days = 7
+
+    def set_config(self, product_config, config_dir=None):
+        product_config = self._set_rules_config(product_config, config_dir)
+        if product_config is self._runtime_config:
+            return
+        # only the changed parts are applied
+        changes = config_changes(self._runtime_config, product_config)
+        self._runtime_config = product_config
+        self.layout_handler = product_config.layout_handler
+
+        settings = product_config.settings
+        if CONFIG_OUT_BOXES in changes or CONFIG_SETTINGS in changes:
+            lanes, out_box_lanes = lane_config(self.out_boxes, settings)
+            self.writer.configure(
+                num_threads=settings.get('writer_threads', 1),
+                num_processes=settings.get('writer_processes', 0),
+                out_box_limits=dict(
+                    (name, int(box['max_concurrent_writes']))
+                    for name, box in self.out_boxes.iteritems()
+                    if 'max_concurrent_writes' in box),
+                lanes=lanes, out_box_lanes=out_box_lanes)
+        if CONFIG_SETTINGS not in changes:
+            return
+
+        # pipelined mode (pipeline_max_messages > 0, default 0): do not
+        # wait for the writer before processing the next message, but
+        # limit the messages and the image size (pipeline_max_mbytes,
+        # default 0 = unlimited) in flight
+        max_messages = int(settings.get('pipeline_max_messages', 0))
+        max_mbytes = float(settings.get('pipeline_max_mbytes', 0))
+        self.pipelined = max_messages > 0
+        self.in_flight.configure(max_messages=max_messages,
+                                 max_bytes=int(max_mbytes * 2 ** 20))
+
+        # no further messages are started while the decoded images in
+        # flight (of all shards) exceed the memory budget (default 0 =
+        # unlimited)
+        self.memory.configure(
+            int(float(settings.get('memory_budget_mbytes', 0)) * 2 ** 20))
+
+        INSTRUMENTATION.set_sink(settings.get('instrumentation_file'))
+
+        # longitudes/latitudes of the areas kept in memory
+        get_area_cache().configure(int(float(
+            settings.get('area_cache_mbytes', 512)) * 2 ** 20))
+
+        # index of the written outputs to recognize repeated messages
+        output_index_db = settings.get('output_index') or None
+        if output_index_db != self.output_index_db:
+            if self.output_index is not None:
+                self.output_index.close()
+                self.output_index = None
+            if output_index_db is not None:
+                self.output_index = OutputIndex(output_index_db)
+            self.output_index_db = output_index_db
+        self.output_index_keep_days = float(
+            settings.get('output_index_keep_days', 7))
+        self.housekeeping()
+
+        # rrd updates are written asynchronously (optionally by rrdcached)
+        configure_rrd_sink(
+            enabled=is_true(settings.get('rrd_async', 'true')),
+            flush_interval=float(settings.get('rrd_flush_interval', 2)),
+            daemon_address=settings.get('rrdcached_address') or None)
+
+    def housekeeping(self):
+        '''Remove outdated entries of the caches (called when the
+        settings change and periodically by the PostProcessor).
+        '''
+        if self.output_index is not None:
+            self.output_index.delete_older_than(self.output_index_keep_days)
 
-    def set_config(self, product_config):
+    def _set_rules_config(self, product_config, config_dir=None):
+        '''Set the rules and out_boxes of *product_config* (without any
+        I/O), returns the ProductConfig.
+        '''
+        if not isinstance(product_config, ProductConfig):
+            product_config = ProductConfig(product_config, config_dir)
+        if product_config is self.product_config:
+            return product_config
+
+        changes = config_changes(self.product_config, product_config)
+        if changes:
+            LOGGER.info("Applying changed product config: %s",
+                        ', '.join(sorted(changes)))
         self.product_config = product_config
-        self.out_boxes = dict()
-        self.rules = []
-        self.dataset_processors = []
-
-        for key, values in product_config['post_processing'].iteritems():
-            if key == 'rrd_dir':
-                self.rrd_dir = values
-            else:
-                for value in values:
-                    if key == 'out_box':
-                        self.out_boxes[value['name']] = value
-                    elif key == 'rule':
-                        # in case of only one rule is defined
-                        if (isinstance(value, str)):
-                            self.rules.append(values)
-                        else:
-                            self.rules.append(value)
-                    elif key == 'dataset_processor':
-                        # in case of only one dataset_processors is defined
-                        if (isinstance(value, str)):
-                            self.dataset_processors.append(values)
-                        else:
-                            self.dataset_processors.append(value)
+        self.out_boxes = product_config.out_boxes
+        self.rules = product_config.rules
+        self.dataset_processors = product_config.dataset_processors
+        self.rrd_dir = product_config.rrd_dir
+        self.rule_index = product_config.rule_index
+        if CONFIG_RULES in changes or CONFIG_OUT_BOXES in changes:
+            self.templates.clear_plans()
+        self.encode_once = is_true(
+            product_config.settings.get('encode_once', 'true'))
+        self.quantized_images = is_true(
+            product_config.settings.get('quantized_images', 'false'))
+        self.fsync = _fsync_policy(
+            product_config.settings.get('fsync', FSYNC_NONE))
+        self.fsync_policies = dict(
+            (name, _fsync_policy(box['fsync']))
+            for name, box in self.out_boxes.iteritems() if 'fsync' in box)
+        self.timeslot_duration = timeslot_duration(product_config.settings)
+        return product_config
 
     def save_img(self, geo_img, src_fname, dest_fname,
                  rrd_fname, rrd_steps, timeslot, params):
-        save_params = self.get_save_arguments(params)
-        dest_dir = os.path.dirname(dest_fname)
-        # first write to file with prefix "." (to ensure that
-        # 3rd party software do not read incomplete files (i.e. AFD)
-        tmp_fname = os.path.join(dest_dir,
-                                 '.' + os.path.basename(dest_fname))
-        if geo_img is None and src_fname is not None:
-            LOGGER.info("Copying file only from %s to %s",
-                        src_fname, dest_fname)
-            if not os.path.exists(dest_dir):
-                os.makedirs(dest_dir)
-            shutil.copy(src_fname, tmp_fname)
-        else:
-            geo_img.save(tmp_fname, **save_params)
-        # rename after writing is complete
-        os.rename(tmp_fname, dest_fname)
-
-        # writing performance data to rrd file
-        if rrd is not None:
-            if os.path.exists(dest_fname):
-                timeslot_sec = to_unix_seconds(timeslot)
-                if not os.path.exists(rrd_fname):
-                    create_rrd_file(rrd_fname, timeslot_sec, rrd_steps)
-
-                skip = False
-                try:
-                    if isinstance(params['source_uri'], basestring):
-                        t_epi = os.path.getmtime(params['source_uri'])
-                    else:
-                        t_epi = max([os.path.getmtime(entry)
-                                     for entry in params['source_uri']])
-                except Exception as e:
-                    LOGGER.error(
-                        "Could not read modification time of {0} ({1})".format(
-                            params['source_uri'], e))
-                    skip = True
-                try:
-                    t_product = os.path.getmtime(dest_fname)
-                except Exception as e:
-                    LOGGER.error(
-                        "Could not read modification time of {0} ({1})".format(
-                            dest_fname, e))
-                    skip = True
-
-                if skip is False:
-                    try:
-                        update_rrd_file(rrd_fname, timeslot_sec, t_epi,
-                                        t_product)
-
-                    except Exception as e:
-                        if 'minimum one second step' in str(e):
-                            LOGGER.info(
-                                "rrd file already "
-                                "contains timeslot. ({0})".format(e))
-                        else:
-                            LOGGER.error(
-                                "Could not update rrd file. ({0})".format(e))
-        else:
-            LOGGER.info("skipping rrd update (no rrdtool found)")
+        save_img(geo_img, src_fname, dest_fname,
+                 rrd_fname, rrd_steps, timeslot, params)
+
+    def run(self, product_config, msg, config_dir=None):
+        """Process the data. *product_config* is a prebuilt ProductConfig
+        (a raw config dict is accepted as well).
 
-    def run(self, product_config, msg, config_dir):
-        """Process the data
+        In pipelined mode the call returns as soon as all outputs are
+        queued for writing (blocking before if too much work is in
+        flight), otherwise after all outputs are written.
         """
-        LOGGER.info('New data available: type = %s', msg.type)
+        self.set_config(product_config, config_dir)
+        waited = self.memory.admit(
+            self._image_nbytes.get(_image_key(msg), 0))
+        if waited:
+            INSTRUMENTATION.record('memory_wait', waited)
+        self.in_flight.begin()
+        tracker = MessageTracker(
+            None, callback=lambda trk: self._message_done(msg, trk))
+        queued = False
+        try:
+            queued = self._run(msg, tracker)
+        finally:
+            if queued or tracker.num_jobs:
+                # jobs queued before an error still hold the image, it is
+                # released when they are done
+                tracker.seal()
+            else:
+                self.in_flight.finish(tracker.nbytes)
+                self.memory.release(tracker.image_nbytes)
+
+        if queued and not self.pipelined:
+            LOGGER.debug("Waiting for the files to be saved")
+            tracker.wait()
+
+    def _message_done(self, msg, tracker):
+        if tracker.sync_dirs:
+            sync_dirs(tracker.sync_dirs)
+        self.in_flight.finish(tracker.nbytes)
+        self.memory.release(tracker.image_nbytes)
+        INSTRUMENTATION.record(
+            'message', tracker.duration(),
+            msg.data.get('product_name', msg.data.get('productname')))
+        if tracker.data_ok:
+            LOGGER.debug("All files saved")
 
-        self._data_ok = True
-        self.set_config(product_config)
-        self.layout_handler = LayoutHandler(product_config, config_dir)
+            LOGGER.info(
+                'File %s processed in %.1f s', tracker.name,
+                tracker.duration())
 
-        if msg.type in ['dataset']:
-            geo_img = None
-            for ds_proc in self.dataset_processors:
-                if re.match(ds_proc['msg_subject_pattern'], msg.subject):
-                    vps = ds_proc.get('var_parse', [])
-                    if not isinstance(vps, list):
-                        vps = [vps]
-                    for vp in vps:
-                        new_vals = parse(vp['parse_pattern'],
-                                         msg.data[vp['msg_key']])
-                        msg.data.update(new_vals)
-
-                    proc_func_params = ds_proc.get(
-                        'processing_function_params', None)
-
-                    module_name, function_name = \
-                        ds_proc['processing_function'].split('|')
-                    func = get_custom_function(module_name, function_name)
-                    geo_img = func(msg, proc_func_params)
-                    in_filename_base = ds_proc['output_name']
-                    in_filename = None
-                    break
-            if geo_img is None:
-                LOGGER.warning("no image created by dataset_processpor")
-        else:
-            geo_img = None
+        if not tracker.data_ok:
+            LOGGER.warning("File %s not processed due to "
+                           "incomplete/missing/corrupted data." %
+                           msg.data['product_filename'])
 
-            LOGGER.info('uri: %s', msg.data['uri'])
+    def _account_image(self, msg, tracker, nbytes):
+        '''Account the *nbytes* of the decoded image of *msg* until all
+        its outputs are written
+        '''
+        self.memory.acquire(nbytes)
+        tracker.image_nbytes += nbytes
+        self._image_nbytes[_image_key(msg)] = nbytes
 
-            p = urlparse(msg.data['uri'])
-            if p.netloc != '':
-                LOGGER.error('uri not supported: {0}'.format(msg.data['uri']))
-                return
+    def _add_bytes(self, tracker, nbytes):
+        '''Account *nbytes* in flight for the message of *tracker* (only
+        bytes of other messages are waited for)
+        '''
+        self.in_flight.add_bytes(nbytes, tracker.nbytes)
+        tracker.nbytes += nbytes
 
-            in_filename = p.path
-            in_filename_base = os.path.basename(in_filename)
+    def _match_rules(self, msg, in_filename_base, product):
+        '''Return the rules matching *in_filename_base*, rules deriving an
+        area (derive_from) only for messages of their parent area
+        '''
+        with INSTRUMENTATION.timer('rule_matching', product):
+            return match_rules(self.rule_index, msg, in_filename_base)
 
-        rules_to_apply = []
-        rules_to_apply_groups = set()
-        copy_src_file_only = True
-        # find matching rules
-        for rule in self.rules:
-            pattern = rule['input_pattern']
-            if re.match(pattern, in_filename_base):
-                # if fnmatch(in_filename_base, pattern):
-                if 'rule_group' in rule:
-                    rg = rule['rule_group']
-                    if rg in rules_to_apply_groups:
-                        continue
-                    else:
-                        rules_to_apply_groups.add(rg)
+    def _derived_image(self, geo_img, rule, derived, tracker, product):
+        '''Return the image of the derived_area of *rule* derived from
+        *geo_img* (None if not possible), images already derived for the
+        message are kept in *derived*
+        '''
+        key = (rule['derived_area'], rule.get('derive_method',
+                                              DERIVE_AVERAGE))
+        if key not in derived:
+            derived[key] = None
+            if isinstance(geo_img, BlockImage):
+                LOGGER.error("Cannot derive %s from an image computed "
+                             "block by block", key[0])
+                return None
+            try:
+                with INSTRUMENTATION.timer('derive_image', product):
+                    derived[key] = derive_image(
+                        geo_img, get_area_def(key[0]), key[1])
+            except ValueError as err:
+                LOGGER.error("Cannot derive %s from %s: %s", key[0],
+                             geo_img.area.area_id, err)
+            else:
+                nbytes = image_nbytes(derived[key])
+                self.memory.acquire(nbytes)
+                tracker.image_nbytes += nbytes
+                self._add_bytes(tracker, nbytes)
+        return derived[key]
+
+    def _resolve_source(self, msg):
+        '''Return the input file name (None for datasets), the name used
+        for rule matching and the matching dataset processor of *msg*,
+        None if the message cannot be processed. Parsed dataset
+        variables are added to the message data.
+        '''
+        if msg.type in ['dataset']:
+            ds_proc = self.rule_index.match_dataset_processor(msg.subject)
+            if ds_proc is None:
+                return None
+            vps = ds_proc.get('var_parse', [])
+            if not isinstance(vps, list):
+                vps = [vps]
+            for vp in vps:
+                new_vals = parse(vp['parse_pattern'],
+                                 msg.data[vp['msg_key']])
+                msg.data.update(new_vals)
+            return None, ds_proc['output_name'], ds_proc
+
+        LOGGER.info('uri: %s', msg.data['uri'])
+
+        p = urlparse(msg.data['uri'])
+        if p.netloc != '':
+            LOGGER.error('uri not supported: {0}'.format(msg.data['uri']))
+            return None
+
+        return p.path, os.path.basename(p.path), None
+
+    def _plan_output(self, msg, rule, in_filename, product):
+        '''Return the output action of *rule* for *msg* (a dict with the
+        destination, rrd file, timeslot, parameters and save arguments)
+        '''
+        with INSTRUMENTATION.timer('resolve_parameters', product,
+                                   rule['out_box_ref']):
+            params = self.merge_and_resolve_parameters(msg, rule)
+
+        time_name = rule.get('time_name', 'time_eos')
+        timeslot = params.get(time_name)
+        if not isinstance(timeslot, dt.date):
+            timeslot = dt.datetime.strptime(timeslot, "%Y%m%d%H%M%S")
+
+        box_out_dir = self.out_boxes[rule['out_box_ref']]['output_dir']
+        fname_pattern = rule['dest_filename']
+        fname = self.create_filename(fname_pattern, box_out_dir, params)
+
+        base_rrd_fname = rule.get('rrd_filename',
+                                  os.path.basename(fname_pattern) + ".rrd")
+        rrd_fname = self.create_filename(re.sub(r"\{[^\}]*:\%[^\}]*\}",
+                                                "xx",
+                                                base_rrd_fname),
+                                         self.rrd_dir,
+                                         params)
+
+        # copy input file only?
+        copy_src_file_only = self.rule_index.is_copy_src_file_only(rule)
+        return {'rule': rule,
+                'out_box': rule['out_box_ref'],
+                'src_filename': in_filename,
+                'dest_filename': fname,
+                'rrd_filename': rrd_fname,
+                'rrd_steps': int(rule.get('rrd_steps', '900')),
+                'timeslot': timeslot,
+                'params': params,
+                'copy_src_file_only': copy_src_file_only,
+                'save_arguments': None if copy_src_file_only
+                else get_save_arguments(params),
+                'fsync': self.fsync_policies.get(rule['out_box_ref'],
+                                                 self.fsync)}
+
+    def _encode_key(self, action, idx):
+        '''Outputs with the same key are encoded once (rules with
+        identical save arguments), further destinations are hardlinked
+        (or copied). Setting encode_once=false encodes every output.
+        '''
+        if action['save_arguments'] is not None and self.encode_once:
+            return (save_args_key(action['save_arguments'],
+                                  action['dest_filename']),
+                    action['params']['areaname'], action['fsync'])
+        return idx
+
+    def plan(self, product_config, msg, config_dir=None):
+        """Return the actions processing *msg* with *product_config*
+        would perform, without reading or writing any file: a list with
+        a dict per matching rule (see _plan_output), "decode" tells if
+        the image has to be read (or created by the dataset processor
+        "dataset_processor"), "encoded_by" is the destination encoded
+        once for identical outputs (hardlinked to this one).
+        """
+        self._set_rules_config(product_config, config_dir)
+        msg = copy.copy(msg)
+        msg.data = dict(msg.data)
+        source = self._resolve_source(msg)
+        if source is None:
+            return []
+        in_filename, in_filename_base, ds_proc = source
+
+        product = msg.data.get('product_name', msg.data.get('productname'))
+        rules_to_apply = self._match_rules(msg, in_filename_base, product)
+
+        actions = []
+        encoded_by = {}
+        for idx, rule in enumerate(rules_to_apply):
+            action = self._plan_output(msg, rule, in_filename, product)
+            action['decode'] = not action['copy_src_file_only']
+            action['dataset_processor'] = ds_proc['output_name'] \
+                if ds_proc is not None else None
+            action['encoded_by'] = encoded_by.setdefault(
+                self._encode_key(action, idx), action['dest_filename'])
+            actions.append(action)
+        return actions
+
+    def _run(self, msg, tracker):
+        """Process the data, the write jobs are registered in *tracker*.
+        Returns True if write jobs were queued.
+        """
+        LOGGER.info('New data available: type = %s', msg.type)
 
-                LOGGER.info("Rule match (%s)" % rule)
-                rules_to_apply.append(rule)
+        tracker.data_ok = True
+
+        source = self._resolve_source(msg)
+        if source is None and msg.type in ['dataset']:
+            LOGGER.warning("no image created by dataset_processpor")
+            return False
+        elif source is None:
+            return False
+        in_filename, in_filename_base, ds_proc = source
+
+        geo_img = None
+        if ds_proc is not None:
+            proc_func_params = ds_proc.get(
+                'processing_function_params', None)
+
+            module_name, function_name = \
+                ds_proc['processing_function'].split('|')
+            func = get_custom_function(module_name, function_name)
+            with INSTRUMENTATION.timer('dataset_processor',
+                                       ds_proc['output_name']):
+                geo_img = func(msg, proc_func_params)
+            if geo_img is None:
+                LOGGER.warning("no image created by dataset_processpor")
 
-                if rule.get('copySrcFileOnly', 'false').lower() not in ["true",
-                                                                        "yes",
-                                                                        "1"]:
-                    copy_src_file_only = False
+        product = msg.data.get('product_name', msg.data.get('productname'))
+
+        # find matching rules
+        rules_to_apply = self._match_rules(msg, in_filename_base, product)
+        for rule in rules_to_apply:
+            LOGGER.info("Rule match (%s)" % rule)
+        copy_src_file_only = all(
+            self.rule_index.is_copy_src_file_only(rule)
+            for rule in rules_to_apply)
 
         if len(rules_to_apply) > 0:
             t1a = time.time()
+            tracker.name = in_filename
+            if geo_img is not None:
+                nbytes = image_nbytes(geo_img)
+                self._account_image(msg, tracker, nbytes)
+            elif copy_src_file_only and in_filename and \
+                    os.path.isfile(in_filename):
+                nbytes = os.path.getsize(in_filename)
+            else:
+                nbytes = 0
+            self._add_bytes(tracker, nbytes)
 
-            # load image
-            area = get_area_def(msg.data['area']['name'])
+            if not os.path.exists(self.rrd_dir):
+                os.makedirs(self.rrd_dir)
 
             # and apply each rule
-            for rule in rules_to_apply:
-
-                params = self.merge_and_resolve_parameters(msg,
-                                                           rule)
-
-                time_name = rule.get('time_name', 'time_eos')
-                timeslot = params.get(time_name)
-                if not isinstance(timeslot, dt.date):
-                    timeslot = dt.datetime.strptime(timeslot,
-                                                    "%Y%m%d%H%M%S")
-
-                # load image only when necessary
-                if geo_img is None:
-                    if not copy_src_file_only:
-                        geo_img = read_image(in_filename, area,
-                                             timeslot)
-
-                box_out_dir = self.out_boxes[rule['out_box_ref']]['output_dir']
-                fname_pattern = rule['dest_filename']
-                fname = self.create_filename(fname_pattern,
-                                             box_out_dir,
-                                             params)
-
-                if not os.path.exists(self.rrd_dir):
-                    os.makedirs(self.rrd_dir)
-
-                base_rrd_fname = rule.get('rrd_filename',
-                                          os.path.basename(fname_pattern) +
-                                          ".rrd")
-
-                rrd_fname = self.create_filename(re.sub(r"\{[^\}]*:\%[^\}]*\}",
-                                                        "xx",
-                                                        base_rrd_fname),
-                                                 self.rrd_dir,
-                                                 params)
-
-                rrd_steps = int(rule.get('rrd_steps', '900'))
+            outputs = OrderedDict()
+            derived = {}
+            for idx, rule in enumerate(rules_to_apply):
+                action = self._plan_output(msg, rule, in_filename, product)
+                out_box = action['out_box']
+                fname = action['dest_filename']
+                fsync = action['fsync']
+                params = action['params']
 
                 # todo:  layouting etc
 #                 try:
 #                     self.layout_handler.layout(geo_img, area)
 #                 except ValueError as e:
 #                     LOGGER.error("Layouting failed: " + str(e))
-                if rule.get('copySrcFileOnly', 'false').lower() in ["true",
-                                                                    "yes",
-                                                                    "1"]:
+                if fsync == FSYNC_BATCH:
+                    tracker.sync_dirs.add(os.path.dirname(fname))
+
+                # repeated messages: skip or link outputs already written
+                index_key = None
+                if self.output_index is not None and in_filename is not None:
+                    if action['copy_src_file_only']:
+                        index_key = output_key(in_filename, PUBLISH_COPY)
+                    else:
+                        index_key = output_key(
+                            in_filename, params['areaname'],
+                            save_args_key(action['save_arguments'], fname))
+                    status, existing = self.output_index.lookup(fname,
+                                                                index_key)
+                    if status == INDEX_HIT:
+                        LOGGER.info("%s is up to date, skipped", fname)
+                        continue
+                    elif status == INDEX_LINK:
+                        LOGGER.info("Publishing identical %s as %s",
+                                    existing, fname)
+                        self.writer.write_to(out_box, fname,
+                                             publish_file, existing, fname,
+                                             fsync=fsync, product=product,
+                                             out_box=out_box,
+                                             tracker=tracker)
+                        self.writer.write_to(out_box, fname,
+                                             self.output_index.record,
+                                             [(fname, index_key)], t1a,
+                                             tracker=tracker)
+                        continue
+
+                # load image only when necessary
+                if geo_img is None:
+                    if not copy_src_file_only:
+                        area = get_area_def(msg.data['area']['name'])
+                        with INSTRUMENTATION.timer('read_image', product):
+                            geo_img = read_image(
+                                in_filename, area, action['timeslot'],
+                                quantized=self.quantized_images)
+                        nbytes = image_nbytes(geo_img)
+                        self._account_image(msg, tracker, nbytes)
+                        self._add_bytes(tracker, nbytes)
+
+                if action['copy_src_file_only']:
                     # copy inputput file only
                     rule_geo_img = None
+                elif 'derived_area' in rule:
+                    rule_geo_img = self._derived_image(geo_img, rule, derived,
+                                                       tracker, product)
+                    if rule_geo_img is None:
+                        continue
                 else:
                     rule_geo_img = geo_img
 
-                self.writer.write(self.save_img,
-                                  rule_geo_img,
-                                  in_filename,
-                                  fname,
-                                  rrd_fname,
-                                  rrd_steps,
-                                  timeslot,
-                                  params)
+                # rules with identical save arguments are encoded once
+                if rule_geo_img is not None:
+                    key = self._encode_key(action, idx)
+                else:
+                    key = idx
+                outputs.setdefault(key, []).append(
+                    (out_box, rule_geo_img, fsync,
+                     (fname, action['rrd_filename'], action['rrd_steps'],
+                      action['timeslot'], params),
+                     index_key))
+
+            for group in outputs.itervalues():
+                out_box, rule_geo_img, fsync, dest, _ = group[0]
+                if len(group) == 1:
+                    self.writer.write_to(out_box,
+                                         dest[0],
+                                         save_img,
+                                         rule_geo_img,
+                                         in_filename,
+                                         *dest,
+                                         fsync=fsync,
+                                         tracker=tracker,
+                                         in_process=rule_geo_img is not None)
+                else:
+                    self._queue_encoded(rule_geo_img, group, tracker)
+                for item in group:
+                    if item[4] is not None:
+                        # after the save job (same destination)
+                        self.writer.write_to(item[0], item[3][0],
+                                             self.output_index.record,
+                                             [(item[3][0], item[4])], t1a,
+                                             tracker=tracker)
 
             LOGGER.info('pr %.1f s', (time.time() - t1a))
+            return True
 
-            # Wait for the writer to finish
-            if self._data_ok:
-                LOGGER.debug("Waiting for the files to be saved")
-            self.writer.prod_queue.join()
-            if self._data_ok:
-                LOGGER.debug("All files saved")
-
-                LOGGER.info(
-                    'File %s processed in %.1f s', in_filename,
-                    time.time() - t1a)
-
-            if not self._data_ok:
-                LOGGER.warning("File %s not processed due to "
-                               "incomplete/missing/corrupted data." %
-                               msg.data['product_filename'])
         else:
             LOGGER.info(
                 "no matching rule found for %s" % in_filename)
+            return False
+
+    def _queue_encoded(self, geo_img, group, tracker):
+        '''Queue the jobs encoding *geo_img* once for the outputs of
+        *group* (identical save arguments): the image is encoded for the
+        first destination, then each further destination is published by
+        a job of its own out_box and destination file, the first
+        destination is committed when they are done. Publishing and
+        committing are never dropped by a lane timeout, the temporary file
+        would be left behind otherwise.
+        '''
+        out_box, _, fsync, dest, _ = group[0]
+        LOGGER.debug("Encoding %s once for %d destinations",
+                     dest[0], len(group))
+        encoded = self.writer.write_to(out_box, dest[0], save_encoded,
+                                       geo_img, dest[0], dest[4],
+                                       tracker=tracker, in_process=True)
+        published = [
+            self.writer.write_to(item[0], item[3][0], publish_encoded,
+                                 tmp_filename(dest[0]), *item[3],
+                                 fsync=item[2], tracker=tracker,
+                                 after=[encoded], droppable=False)
+            for item in group[1:]]
+        self.writer.write_to(out_box, dest[0], commit_encoded, *dest,
+                             fsync=fsync, tracker=tracker, after=published,
+                             droppable=False)
 
     def get_save_arguments(self, rule):
-        save_kwords = {}
-
-        # check if a certain format is specified
-        if 'format' in rule:
-            save_kwords['fformat'] = rule['format']
-
-        if 'format_params' in rule:
-            save_kwords.update(rule['format_params'])
-
-        # set some defaults
-        if 'compression' not in save_kwords:
-            save_kwords['compression'] = 6
-
-        if 'blocksize' not in save_kwords:
-            save_kwords['blocksize'] = 0
-
-        if 'ninjotiff' in save_kwords['fformat']:
-            if 'inv_def_temperature_cmap' not in save_kwords:
-                save_kwords['inv_def_temperature_cmap'] = False
-
-            if 'omit_filename_path' not in save_kwords:
-                save_kwords['omit_filename_path'] = True
-
-        return save_kwords
+        return get_save_arguments(rule)
 
     def create_filename(self, fname_pattern, dir_pattern, params=None):
         '''Parse filename for saving.
         '''
         fname = os.path.join(dir_pattern, fname_pattern)
-        par = Parser(fname)
-        fname = par.compose(params)
-        return fname
+        return self.templates.compose(fname, params)
 
     def merge_and_resolve_parameters(self, msg, rule):
         ''' creates parameters dictionary based on data received via posttroll
@@ -370,16 +675,20 @@ class DataProcessor(object):
         params['productname'] = product_name
         params['product_name'] = product_name
 
+        if 'derived_area' in params:
+            # output of an area derived from the image of the message
+            params['area'] = dict(params['area'],
+                                  name=params['derived_area'])
         params['areaname'] = params['area']['name']
 
         if 'time' in params:
             t = params['time']
-            t_eos = t + dt.timedelta(minutes=15)  # @UndefinedVariable
+            t_eos = t + self.timeslot_duration
             params['time_eos'] = t_eos
         else:
             print "no time key"
 
-        return self._resolve(params, params)
+        return self.templates.resolve(params, params, rule)
 #         resolved_params = dict()
 #         for k, v in params.items():
 #             # take only string parameters
@@ -392,18 +701,323 @@ class DataProcessor(object):
 #         return resolved_params
 
     def _resolve(self, params, ref_params):
-        resolved_params = dict()
-        for k, v in params.items():
-            # take only string parameters
-            if isinstance(v, (str, unicode)):
-                par = Parser(v)
-                resolved_params[k] = par.compose(ref_params)
-            elif isinstance(v, dict):
-                resolved_params[k] = self._resolve(v, ref_params)
-            else:
-                resolved_params[k] = v
+        return self.templates.resolve(params, ref_params)
+
+
+def save_img(geo_img, src_fname, dest_fname,
+             rrd_fname, rrd_steps, timeslot, params, fsync=FSYNC_NONE):
+    """Save *geo_img* (or copy *src_fname* if no image is given) to
+    *dest_fname* with the *fsync* policy and update the rrd file. Module
+    level function so that it can be executed by writer processes.
+    """
+    product = params.get('product_name')
+    out_box = params.get('out_box_ref')
+    if geo_img is None and src_fname is not None:
+        # hardlink (falling back to copy) unless the rule demands a copy
+        # with <copy_mode>copy</copy_mode>
+        link = params.get('copy_mode', PUBLISH_LINK) == PUBLISH_LINK
+        with INSTRUMENTATION.timer('publish', product, out_box):
+            linked = publish_file(src_fname, dest_fname, link=link,
+                                  fsync=fsync, product=product,
+                                  out_box=out_box)
+        LOGGER.info("%s source file %s to %s",
+                    "Linked" if linked else "Copied", src_fname, dest_fname)
+        # a hardlink has the modification time of the source file
+        update_rrd(dest_fname, rrd_fname, rrd_steps, timeslot, params,
+                   t_product=time.time() if linked else None)
+        return
+
+    save_params = get_save_arguments(params)
+    # first write to file with prefix "." (to ensure that
+    # 3rd party software do not read incomplete files (i.e. AFD)
+    tmp_fname = tmp_filename(dest_fname)
+    with INSTRUMENTATION.timer('save', product, out_box):
+        encode_image(geo_img, tmp_fname, save_params)
+    # rename after writing is complete
+    commit_file(tmp_fname, dest_fname, fsync, product, out_box)
+
+    update_rrd(dest_fname, rrd_fname, rrd_steps, timeslot, params)
+
+
+def save_encoded(geo_img, dest_fname, params):
+    """Save *geo_img* to the temporary file of *dest_fname* to be
+    published to further destinations (publish_encoded) before it is
+    committed (commit_encoded). Nothing is left if saving fails.
+    """
+    tmp_fname = tmp_filename(dest_fname)
+    try:
+        with INSTRUMENTATION.timer('save', params.get('product_name'),
+                                   params.get('out_box_ref')):
+            encode_image(geo_img, tmp_fname, get_save_arguments(params))
+    except BaseException:
+        if os.path.exists(tmp_fname):
+            os.remove(tmp_fname)
+        raise
+
+
+def publish_encoded(encoded_fname, dest_fname, rrd_fname, rrd_steps,
+                    timeslot, params, fsync=FSYNC_NONE):
+    """Publish the file *encoded_fname* saved by save_encoded to the
+    further destination *dest_fname* (hardlinked, copied if not possible)
+    and update the rrd file. The temporary file is used, so that it
+    cannot be taken away by a consumer of the first destination.
+    """
+    if not os.path.exists(encoded_fname):
+        LOGGER.error("%s not published, %s was not saved", dest_fname,
+                     encoded_fname)
+        return
+    product = params.get('product_name')
+    out_box = params.get('out_box_ref')
+    with INSTRUMENTATION.timer('publish', product, out_box):
+        linked = publish_file(encoded_fname, dest_fname, fsync=fsync,
+                              product=product, out_box=out_box)
+    LOGGER.info("%s %s to %s", "Linked" if linked else "Copied",
+                encoded_fname, dest_fname)
+    update_rrd(dest_fname, rrd_fname, rrd_steps, timeslot, params)
+
+
+def commit_encoded(dest_fname, rrd_fname, rrd_steps, timeslot, params,
+                   fsync=FSYNC_NONE):
+    """Rename the file saved by save_encoded to *dest_fname* after it
+    was published to the further destinations and update the rrd file.
+    """
+    tmp_fname = tmp_filename(dest_fname)
+    if not os.path.exists(tmp_fname):
+        LOGGER.error("%s was not saved", dest_fname)
+        return
+    try:
+        commit_file(tmp_fname, dest_fname, fsync,
+                    params.get('product_name'), params.get('out_box_ref'))
+    finally:
+        if os.path.exists(tmp_fname):
+            os.remove(tmp_fname)
+    update_rrd(dest_fname, rrd_fname, rrd_steps, timeslot, params)
+
+
+def update_rrd(dest_fname, rrd_fname, rrd_steps, timeslot, params,
+               t_product=None):
+    """Write performance data of *dest_fname* to the rrd file. The
+    product time *t_product* defaults to the modification time of
+    *dest_fname*. The update is handed over to the rrd sink unless
+    asynchronous rrd updates are disabled.
+    """
+    with INSTRUMENTATION.timer('rrd_update', params.get('product_name'),
+                               params.get('out_box_ref')):
+        _update_rrd(dest_fname, rrd_fname, rrd_steps, timeslot, params,
+                    t_product)
+
+
+def _update_rrd(dest_fname, rrd_fname, rrd_steps, timeslot, params,
+                t_product):
+    rrd_sink = get_rrd_sink()
+    if rrd is None and (rrd_sink is None or not rrd_sink.daemon_address):
+        LOGGER.info("skipping rrd update (no rrdtool found)")
+        return
+    if not os.path.exists(dest_fname):
+        return
+
+    timeslot_sec = to_unix_seconds(timeslot)
+    skip = False
+    try:
+        if isinstance(params['source_uri'], basestring):
+            t_epi = os.path.getmtime(params['source_uri'])
+        else:
+            t_epi = max([os.path.getmtime(entry)
+                         for entry in params['source_uri']])
+    except Exception as e:
+        LOGGER.error(
+            "Could not read modification time of {0} ({1})".format(
+                params['source_uri'], e))
+        skip = True
+    try:
+        if t_product is None:
+            t_product = os.path.getmtime(dest_fname)
+    except Exception as e:
+        LOGGER.error(
+            "Could not read modification time of {0} ({1})".format(
+                dest_fname, e))
+        skip = True
+
+    if skip is False:
+        if rrd_sink is not None:
+            rrd_sink.submit(rrd_fname, rrd_steps, timeslot_sec, t_epi,
+                            t_product)
+            return
+        try:
+            if not os.path.exists(rrd_fname):
+                create_rrd_file(rrd_fname, timeslot_sec, rrd_steps)
+            update_rrd_file(rrd_fname, timeslot_sec, t_epi,
+                            t_product)
 
-        return resolved_params
+        except Exception as e:
+            if 'minimum one second step' in str(e):
+                LOGGER.info(
+                    "rrd file already "
+                    "contains timeslot. ({0})".format(e))
+            else:
+                LOGGER.error(
+                    "Could not update rrd file. ({0})".format(e))
+
+
+def _image_key(msg):
+    '''Return the product and area of *msg* (images of the same key have
+    the same size)
+    '''
+    area = msg.data.get('area')
+    return (msg.data.get('product_name', msg.data.get('productname')),
+            area.get('name') if isinstance(area, dict) else area)
+
+
+def match_rules(rule_index, msg, in_filename_base):
+    '''Return the rules of *rule_index* matching *in_filename_base* (the
+    input filename or the output name of a dataset processor), rules
+    deriving an area (derive_from) only for messages of their parent area
+    '''
+    rules = rule_index.match(in_filename_base)
+    area = msg.data.get('area')
+    area_name = area.get('name') if isinstance(area, dict) else area
+    return [rule for rule in rules
+            if rule.get('derive_from', area_name) == area_name]
+
+
+def timeslot_duration(settings):
+    '''Return the duration of a timeslot (setting timeslot_minutes,
+    default 15), time_eos is the time of the message plus the duration
+    '''
+    return dt.timedelta(minutes=float(settings.get('timeslot_minutes', 15)))
+
+
+def rule_timeslot(rule, data, duration):
+    '''Return the timeslot of the outputs of *rule* for the message
+    *data*: the value of its time_name (by default time_eos, the end of
+    the timeslot of *duration*), None if unknown
+    '''
+    time_name = rule.get('time_name', 'time_eos')
+    if time_name == 'time_eos':
+        timeslot = data.get('time')
+        if isinstance(timeslot, dt.datetime):
+            return timeslot + duration
+        return None
+    timeslot = data.get(time_name)
+    if isinstance(timeslot, basestring):
+        try:
+            timeslot = dt.datetime.strptime(timeslot, "%Y%m%d%H%M%S")
+        except ValueError:
+            return None
+    return timeslot if isinstance(timeslot, dt.datetime) else None
+
+
+def _fsync_policy(policy):
+    if policy not in FSYNC_POLICIES:
+        LOGGER.error("Unknown fsync policy '%s', using '%s'",
+                     policy, FSYNC_NONE)
+        return FSYNC_NONE
+    return policy
+
+
+def get_save_arguments(rule):
+    """Return the keyword arguments for encode_image() of *rule*.
+
+    Tiled output is selected with the format_params tile_size (tiles of
+    tile_size x tile_size pixels, default 0 = striped), overviews
+    (internal overviews, 'auto' = down to one tile or reduction factors
+    like 2,4,8) with overview_resampling (default average), predictor
+    (2 = horizontal differencing) and cloud_optimized (tiled with the
+    overviews in front of the image, default tile_size 256). ninjotiff
+    outputs are always tiled (tile_size, default 512) with reduced
+    resolution images, overviews and predictor do not apply. The
+    variants are compared by bin/benchmark_tiled_output.py.
+    """
+    save_kwords = {}
+
+    # check if a certain format is specified
+    if 'format' in rule:
+        save_kwords['fformat'] = rule['format']
+
+    if 'format_params' in rule:
+        save_kwords.update(rule['format_params'])
+
+    # set some defaults
+    if 'compression' not in save_kwords:
+        save_kwords['compression'] = 6
+
+    # tiled (cloud optimized) output
+    tile_size = int(save_kwords.pop('tile_size', 0))
+    predictor = save_kwords.pop('predictor', None)
+    overviews = _overview_levels(save_kwords.pop('overviews', None))
+    resampling = save_kwords.pop('overview_resampling', 'average')
+    cloud_optimized = is_true(save_kwords.pop('cloud_optimized', 'false'))
+
+    if 'ninjotiff' in save_kwords['fformat']:
+        if 'inv_def_temperature_cmap' not in save_kwords:
+            save_kwords['inv_def_temperature_cmap'] = False
+
+        if 'omit_filename_path' not in save_kwords:
+            save_kwords['omit_filename_path'] = True
+
+        # ninjotiff is always tiled (default 512) and contains reduced
+        # resolution images
+        if tile_size:
+            save_kwords['tile_width'] = tile_size
+            save_kwords['tile_length'] = tile_size
+        if predictor is not None:
+            LOGGER.warning("ninjotiff does not support a predictor, "
+                           "ignored")
+    else:
+        if cloud_optimized:
+            tile_size = tile_size or 256
+            overviews = overviews or OVERVIEWS_AUTO
+        if tile_size:
+            save_kwords['blocksize'] = tile_size
+        if predictor is not None:
+            gdal_options = dict(save_kwords.get('gdal_options') or {})
+            gdal_options['PREDICTOR'] = str(predictor)
+            save_kwords['gdal_options'] = gdal_options
+        if overviews:
+            save_kwords['overviews'] = overviews
+            save_kwords['overview_resampling'] = resampling
+            save_kwords['cloud_optimized'] = cloud_optimized
+
+    if 'blocksize' not in save_kwords:
+        save_kwords['blocksize'] = 0
+
+    return save_kwords
+
+
+def _overview_levels(value):
+    '''Overview levels of the *overviews* save argument: 'auto' or a
+    comma separated list of reduction factors
+    '''
+    if not value or value == 'none':
+        return None
+    if value == OVERVIEWS_AUTO:
+        return OVERVIEWS_AUTO
+    if isinstance(value, basestring):
+        value = value.split(',')
+    return tuple(int(level) for level in value)
+
+
+def encode_image(geo_img, fname, save_params):
+    '''Save *geo_img* to *fname* with *save_params* (see
+    get_save_arguments) and add the internal overviews.
+    '''
+    save_params = dict(save_params)
+    overviews = save_params.pop('overviews', None)
+    resampling = save_params.pop('overview_resampling', 'average')
+    cloud_optimized = save_params.pop('cloud_optimized', False)
+    # GeoImage.save merges the gdal_options and tags into the image, they
+    # must not leak into the outputs of other rules (or derived images)
+    img = copy.copy(geo_img)
+    for attr in ('gdal_options', 'tags'):
+        value = getattr(img, attr, None)
+        if isinstance(value, dict):
+            setattr(img, attr, dict(value))
+    img.save(fname, **save_params)
+    if overviews:
+        add_overviews(fname, None if overviews == OVERVIEWS_AUTO
+                      else overviews, resampling=resampling,
+                      cloud_optimized=cloud_optimized,
+                      creation_options=geotiff_options(save_params))
 
 
 def get_custom_function(module_name, function_name):
@@ -417,48 +1031,6 @@ def get_custom_function(module_name, function_name):
                    function_name)
 
 
-class DataWriter(Thread):
-
-    """Writes data to disk.
-
-    This is separate from the DataProcessor since it IO takes time and we don't
-    want to block processing.
-    """
-
-    def __init__(self):
-        Thread.__init__(self)
-        self.prod_queue = Queue.Queue()
-        self._loop = True
-
-    def run(self):
-        """Run the thread.
-        """
-        while self._loop:
-            try:
-                fun, args, kwargs = self.prod_queue.get(True, 1)
-            except Queue.Empty:
-                pass
-            else:
-                try:
-                    fun(*args, **kwargs)
-                except BaseException:
-                    LOGGER.exception("Unexpected error")
-                fun = None
-                args = None
-                kwargs = None
-                self.prod_queue.task_done()
-
-    def write(self, fun, *args, **kwargs):
-        '''Write to queue.
-        '''
-        self.prod_queue.put((fun, args, kwargs))
-
-    def stop(self):
-        '''Stop the data writer.
-        '''
-        LOGGER.info("stopping data writer")
-        self._loop = False
-
 # from trollduction.minion import Minion
 
 
@@ -466,6 +1038,10 @@ class DataWriter(Thread):
 class PostProcessor(object):
 
     """PostProcessor takes in messages and generates DataProcessor jobs.
+
+    Received messages, config changes, finished jobs and periodic tasks
+    are handled by an EventLoop, the messages are processed one after
+    the other in an Executor thread.
     """
 
     def __init__(self, config, managed=True):
@@ -476,27 +1052,42 @@ class PostProcessor(object):
         self.td_config = None
         self.product_config = None
         self.listener = None
+        self.topics = None
 
         self.global_data = None
         self.local_data = None
 
         self._loop = True
+        self._busy = False
         self.thr = None
+        self.loop = EventLoop()
+        self.executor = None
+        # periodic timers by name: (interval, timer)
+        self._timers = {}
         self.config_watcher = None
+        self.product_config_watcher = None
+        self.config_cache = ProductConfigCache(
+            helper_functions.read_config_file)
+        self.scheduler = MessageScheduler()
 
         # read everything from the Trollduction config file
         try:
-            self.update_td_config_from_file(config['config_file'],
-                                            config['config_item'])
-
-            self.data_processor = DataProcessor()
+            self.td_config = helper_functions.read_config_file(
+                config['config_file'], config['config_item'])
+            # the data processor (e.g. forked worker processes) is created
+            # before the listener starts its threads
+            self.data_processor = self.create_data_processor()
+            self.update_td_config()
 
             if not managed:
                 self.config_watcher = \
                     ConfigWatcher(config['config_file'],
                                   None,
-                                  self.update_td_config_from_file)
+                                  self._in_loop(
+                                      self.update_td_config_from_file))
                 self.config_watcher.start()
+                self._watch_product_config(
+                    self.td_config['product_config_file'])
 
         except AttributeError:
             self.td_config = config
@@ -507,6 +1098,22 @@ class PostProcessor(object):
         # Minion.start(self)
         # self.thr = Thread(target=self.run_single).start()
 
+    def _in_loop(self, handler):
+        '''Return a callback handing its calls to *handler* over to the
+        event loop (e.g. for the config watcher threads).
+        '''
+        return lambda *args: self.loop.post(handler, *args)
+
+    def _watch_product_config(self, fname):
+        '''(Re)start watching the product config file *fname*.
+        '''
+        if self.product_config_watcher is not None:
+            self.product_config_watcher.stop()
+        self.product_config_watcher = \
+            ConfigWatcher(fname, None,
+                          self._in_loop(self.config_cache.invalidate))
+        self.product_config_watcher.start()
+
     def update_td_config_from_file(self, fname, config_item=None):
         '''Read Trollduction config file and use the new parameters.
         '''
@@ -519,17 +1126,27 @@ class PostProcessor(object):
 
         LOGGER.info('Trollduction configuration read successfully.')
 
-        # Initialize/restart listener
+        # Initialize/restart listener, a running listener is kept (no
+        # gap of the subscriptions) unless the topics changed
+        topics = self.td_config['td_product_finished_topic'].split(',')
         if self.listener is None:
-            self.listener = ListenerContainer(
-                topics=self.td_config['td_product_finished_topic'].split(','))
+            self.listener = self.create_listener(topics)
 #            self.listener = ListenerContainer()
+            self.topics = topics
             LOGGER.info("Listener started")
-        else:
+        elif topics != self.topics:
             #            self.listener.restart_listener('file')
-            self.listener.restart_listener(
-                self.td_config['td_product_finished_topic'].split(','))
+            self.listener.restart_listener(topics)
+            self.topics = topics
             LOGGER.info("Listener restarted")
+        else:
+            LOGGER.debug("Topics unchanged, listener kept")
+
+        watcher = self.product_config_watcher
+        if watcher is not None and \
+                self.td_config.get('product_config_file') not in \
+                (None, watcher.config_file):
+            self._watch_product_config(self.td_config['product_config_file'])
 
         try:
             self.update_product_config(self.td_config['product_config_file'],
@@ -544,35 +1161,82 @@ class PostProcessor(object):
     def update_product_config(self, fname, config_item):
         '''Update area definitions, associated product names, output
         filename prototypes and other relevant information from the
-        given file.
+        given file. The file is parsed only if it changed since the
+        last call.
         '''
 
-        product_config = \
-            helper_functions.read_config_file(fname,
-                                              config_item=config_item)
-
         # add checks, or do we just assume the config to be valid at
         # this point?
-        self.product_config = product_config
+        self.product_config = self.config_cache.get(fname, config_item)
         if self.td_config['product_config_file'] != fname:
             self.td_config['product_config_file'] = fname
+        return self.product_config
 
-        LOGGER.info('Product config read from %s', fname)
+    def log_metrics(self):
+        '''Log the stage latencies, queue waits and writer statistics.
+        '''
+        for stage, summary in sorted(
+                INSTRUMENTATION.stage_totals().iteritems()):
+            LOGGER.info("%s: %d x, mean %.3f s, p90 %.3f s, max %.3f s",
+                        stage, summary['count'], summary['mean'],
+                        summary['p90'], summary['max'])
+        for name, summary in sorted(self.scheduler.stats().iteritems()):
+            LOGGER.info("queue wait of %s: %d x, mean %.3f s, p90 %.3f s, "
+                        "max %.3f s", name, summary['count'],
+                        summary['mean'], summary['p90'], summary['max'])
+        for name, counts in sorted(
+                self.scheduler.coalesce_stats().iteritems()):
+            LOGGER.info("coalesced messages of %s: %d dropped, %d deferred",
+                        name, counts['drop'], counts['defer'])
+
+        if self.data_processor is not None:
+            for name, summary in sorted(
+                    self.data_processor.writer.stats().iteritems()):
+                LOGGER.info("writer lane %s: %d done, %d dropped, %d slow, "
+                            "%.1f MB, max queue %d", name, summary['done'],
+                            summary['dropped'], summary['slow'],
+                            summary['mbytes'], summary['max_queued'])
+
+            LOGGER.info("memory budget: %s",
+                        self.data_processor.memory.stats())
+            output_index = self.data_processor.output_index
+            if output_index is not None:
+                LOGGER.info("output index: %s", output_index.stats())
+        LOGGER.info("area cache: %s", get_area_cache().stats())
+
+    def housekeeping(self):
+        '''Periodic removal of outdated cache entries.
+        '''
+        if self.data_processor is not None:
+            self.data_processor.housekeeping()
 
     def cleanup(self):
         '''Cleanup Trollduction before shutdown.
         '''
 
         LOGGER.info('Shutting down Trollduction.')
+        self.log_metrics()
 
         # more cleanup needed?
         self._loop = False
+        self.loop.stop()
+        if self.executor is not None:
+            self.executor.shutdown()
+            self.executor = None
         if self.data_processor is not None:
             self.data_processor.writer.stop()
+            rrd_sink = get_rrd_sink()
+            if rrd_sink is not None:
+                rrd_sink.stop()
         if self.config_watcher is not None:
             self.config_watcher.stop()
             self.config_watcher = None
+        if self.product_config_watcher is not None:
+            self.product_config_watcher.stop()
+            self.product_config_watcher = None
         if self.listener is not None:
+            # wake up the receiving thread
+            self.listener.queue.put(None)
             self.listener.stop()
             self.listener = None
         if self.data_processor is not None:
@@ -592,29 +1256,195 @@ class PostProcessor(object):
         self.stop()
 
     def run_single(self):
-        """Run trollduction.
+        """Run trollduction until stopped.
+        """
+        if not self._loop:
+            return
+        self.thr = Thread(target=self.receive)
+        self.thr.daemon = True
+        self.thr.start()
+        self.executor = Executor(self.loop, name='postprocessor')
+
+        self.arm_timers()
+        self.loop.post(self._dispatch)
+        try:
+            self.loop.run()
+        except KeyboardInterrupt:
+            LOGGER.info('Keyboard interrupt detected')
+            self.stop()
+            raise
+        finally:
+            self.loop.close()
+
+    def arm_timers(self):
+        """(Re)arm the periodic metrics logging and housekeeping if their
+        intervals in the settings changed (called in the loop): the
+        metrics (stage latencies, queue waits and writer statistics) are
+        logged every metrics_interval seconds (default 0 = only at
+        shutdown), outdated cache entries are removed every
+        housekeeping_interval seconds (default 3600).
+        """
+        settings = self.product_config.settings \
+            if self.product_config is not None else {}
+        intervals = {
+            'metrics': (float(settings.get('metrics_interval', 0)),
+                        self.log_metrics),
+            'housekeeping': (float(settings.get('housekeeping_interval',
+                                                3600)),
+                             self.housekeeping)}
+        for name, (interval, handler) in intervals.iteritems():
+            armed = self._timers.get(name)
+            if armed is not None:
+                if armed[0] == interval:
+                    continue
+                if armed[1] is not None:
+                    self.loop.cancel(armed[1])
+                LOGGER.info("%s interval changed to %s s", name, interval)
+            timer = self.loop.call_every(interval, handler) \
+                if interval > 0 else None
+            self._timers[name] = (interval, timer)
+
+    def receive(self):
+        """Hand the messages received by the listener over to the event
+        loop.
         """
+        msg_queue = None
         while self._loop:
-            # wait for new messages
+            listener = self.listener
+            if listener is None:
+                break
+            if listener.queue is not msg_queue:
+                # restarting the listener replaces its queue, the
+                # messages left in the old one are handed over first
+                while msg_queue is not None:
+                    try:
+                        msg = msg_queue.get(False)
+                    except Queue.Empty:
+                        break
+                    if msg is not None:
+                        self.loop.post(self._on_message, msg)
+                msg_queue = listener.queue
             try:
-                msg = self.listener.queue.get(True, 5)
-            except KeyboardInterrupt:
-                LOGGER.info('Keyboard interrupt detected')
-                self.stop()
-                raise
+                msg = msg_queue.get(True, RECEIVE_TIMEOUT)
             except Queue.Empty:
                 continue
+            if msg is None:
+                break
+            self.loop.post(self._on_message, msg)
+
+    def _on_message(self, msg):
+        self.schedule(msg)
+        self._dispatch()
+
+    def _dispatch(self):
+        """Start processing the most urgent message unless a message is
+        being processed.
+        """
+        if self._busy or not self._loop:
+            return
+        try:
+            msg = self.scheduler.get(False)
+        except Queue.Empty:
+            return
+        self._busy = True
+        self.executor.submit(self.process, (msg,), self._processed)
+
+    def _processed(self, result, error):
+        self._busy = False
+        self._dispatch()
+
+    def schedule(self, msg):
+        """Queue a message in the scheduler according to the scheduling
+        classes of its rules.
+        """
+        sched_classes = None
+        time_eos = None
+        key = None
+        name = msg.subject
+        if msg.type in ["file", "dataset"]:
+            try:
+                name = msg.data.get('uri', msg.subject)
+                self.update_product_config(
+                    self.td_config['product_config_file'],
+                    self.td_config['config_item'])
+                self.scheduler.aging = float(
+                    self.product_config.settings.get('scheduler_aging',
+                                                     300))
+                self.arm_timers()
+                rules = self.match_rules(msg)
+                sched_classes = self.classify(msg, rules)
+                time_eos = self.timeslot(msg, rules)
+                # newer timeslots of the same product supersede older ones
+                key = (msg.type, msg.subject,
+                       msg.data.get('product_name',
+                                    msg.data.get('productname')),
+                       msg.data.get('area', {}).get('name'))
+            except BaseException:
+                LOGGER.exception("Unexpected error")
+        self.scheduler.put(msg, sched_classes, time_eos, key=key,
+                           name=name)
+
+    def match_rules(self, msg):
+        """Return the rules matching *msg*.
+        """
+        rule_index = self.product_config.rule_index
+        if msg.type == 'dataset':
+            ds_proc = rule_index.match_dataset_processor(msg.subject)
+            if ds_proc is None:
+                return []
+            in_filename_base = ds_proc['output_name']
+        else:
+            in_filename_base = os.path.basename(
+                urlparse(msg.data['uri']).path)
+        return match_rules(rule_index, msg, in_filename_base)
 
-            # For 'file' type messages, update product config and run
-            # production
-            if msg.type in ["file", "dataset"]:
-                try:
-                    self.update_product_config(
-                        self.td_config['product_config_file'],
-                        self.td_config['config_item'])
-                    self.data_processor.run(
-                        self.product_config,
-                        msg,
-                        os.path.dirname(self.td_config['product_config_file']))
-                except BaseException:
-                    LOGGER.exception("Unexpected error")
+    def classify(self, msg, rules=None):
+        """Return the scheduling classes of the rules matching *msg*
+        (or of *rules*).
+        """
+        if rules is None:
+            rules = self.match_rules(msg)
+        out_boxes = self.product_config.out_boxes
+        return [SchedulingClass.from_config(
+            rule, out_boxes.get(rule['out_box_ref']))
+            for rule in rules]
+
+    def timeslot(self, msg, rules):
+        """Return the earliest timeslot of the outputs of *rules* for
+        *msg* (the time_name of the rules, by default time_eos), the
+        deadlines of the scheduling classes are relative to it.
+        """
+        duration = timeslot_duration(self.product_config.settings)
+        timeslots = [timeslot for timeslot in
+                     (rule_timeslot(rule, msg.data, duration)
+                      for rule in rules) if timeslot is not None]
+        if timeslots:
+            return min(timeslots)
+        # no rule (e.g. a message not matching any rule)
+        return rule_timeslot({}, msg.data, duration)
+
+    def create_listener(self, topics):
+        """Create the listener receiving the messages of *topics*.
+        """
+        return ListenerContainer(topics=topics)
+
+    def create_data_processor(self):
+        """Create the DataProcessor handling the messages.
+        """
+        return DataProcessor()
+
+    def process(self, msg):
+        """Process a single message.
+        """
+        # For 'file' type messages, update product config and run
+        # production
+        if msg.type in ["file", "dataset"]:
+            try:
+                # the config (and its rule index) is swapped between
+                # messages only
+                product_config = self.update_product_config(
+                    self.td_config['product_config_file'],
+                    self.td_config['config_item'])
+                self.data_processor.run(product_config, msg)
+            except BaseException:
+                LOGGER.exception("Unexpected error")
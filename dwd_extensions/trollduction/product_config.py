@@ -0,0 +1,207 @@
+# -*- coding: utf-8 -*-
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+'''Prebuilt product configuration and a cache to avoid re-reading
+the product config file for every message.
+'''
+
+import logging
+import os
+import threading
+
+from dwd_extensions.trollduction.rule_index import RuleIndex
+
+LOGGER = logging.getLogger("postprocessor")
+
+CONFIG_RULES = 'rules'
+CONFIG_OUT_BOXES = 'out_boxes'
+CONFIG_SETTINGS = 'settings'
+CONFIG_LAYOUT = 'layout'
+CONFIG_PARTS = (CONFIG_RULES, CONFIG_OUT_BOXES, CONFIG_SETTINGS,
+                CONFIG_LAYOUT)
+
+
+class ProductConfig(object):
+
+    """Immutable view of the post_processing part of a product config.
+
+    The raw config dict as returned by
+    trollduction.helper_functions.read_config_file is available via
+    *raw*, the parsed out_boxes, rules, dataset processors and rrd
+    directory via the corresponding attributes, all other single valued
+    post_processing entries via *settings*. Neither the object nor the
+    contained rule dicts must be modified after construction.
+
+    Unchanged parts of a *previous* ProductConfig (rule index, layout
+    handler) are reused instead of being built again.
+    """
+
+    def __init__(self, raw, config_dir=None, previous=None):
+        out_boxes = dict()
+        rules = []
+        dataset_processors = []
+        settings = {'rrd_dir': 'rrd'}
+
+        for key, values in raw['post_processing'].iteritems():
+            if isinstance(values, basestring):
+                settings[key] = values
+            else:
+                # in case of only one element is defined
+                if isinstance(values, dict):
+                    values = [values]
+                for value in values:
+                    if key == 'out_box':
+                        out_boxes[value['name']] = value
+                    elif key == 'rule':
+                        rules.append(value)
+                    elif key == 'dataset_processor':
+                        dataset_processors.append(value)
+
+        self._set('raw', raw)
+        self._set('config_dir', config_dir)
+        self._set('out_boxes', out_boxes)
+        self._set('rules', tuple(rules))
+        self._set('dataset_processors', tuple(dataset_processors))
+        self._set('rrd_dir', settings['rrd_dir'])
+        self._set('settings', settings)
+        changes = config_changes(previous, self)
+        if CONFIG_RULES in changes:
+            self._set('rule_index',
+                      RuleIndex(rules, dataset_processors,
+                                settings.get('rule_signature_pattern')))
+        else:
+            self._set('rule_index', previous.rule_index)
+        if CONFIG_LAYOUT in changes:
+            self._set('_layout_handler', None)
+        else:
+            self._set('_layout_handler', previous._layout_handler)
+
+    def _set(self, name, value):
+        object.__setattr__(self, name, value)
+
+    def __setattr__(self, name, value):
+        raise AttributeError("ProductConfig is immutable")
+
+    def __getitem__(self, key):
+        return self.raw[key]
+
+    @property
+    def layout_handler(self):
+        '''LayoutHandler for this config, created on first access
+        (reads mpop.cfg only once per config).
+        '''
+        if self._layout_handler is None:
+            from dwd_extensions.layout import LayoutHandler
+            self._set('_layout_handler',
+                      LayoutHandler(self.raw, self.config_dir))
+        return self._layout_handler
+
+
+def _layout_raw(config):
+    return (config.config_dir,
+            dict((key, value) for key, value in config.raw.iteritems()
+                 if key != 'post_processing'))
+
+
+def config_changes(old, new):
+    '''Return the set of parts (CONFIG_RULES, CONFIG_OUT_BOXES,
+    CONFIG_SETTINGS, CONFIG_LAYOUT) of the ProductConfig *new* which
+    differ from *old* (all parts if *old* is None).
+    '''
+    if old is None:
+        return set(CONFIG_PARTS)
+    if old is new:
+        return set()
+    changes = set()
+    if old.rules != new.rules or \
+            old.dataset_processors != new.dataset_processors or \
+            old.settings.get('rule_signature_pattern') != \
+            new.settings.get('rule_signature_pattern'):
+        changes.add(CONFIG_RULES)
+    if old.out_boxes != new.out_boxes:
+        changes.add(CONFIG_OUT_BOXES)
+    if old.settings != new.settings:
+        changes.add(CONFIG_SETTINGS)
+    if _layout_raw(old) != _layout_raw(new):
+        changes.add(CONFIG_LAYOUT)
+    return changes
+
+
+_STALE = object()
+
+
+class ProductConfigCache(object):
+
+    """Parses product config files once and hands out the prebuilt
+    ProductConfig until the file changes.
+
+    A cached entry is reloaded when *invalidate* was called (e.g. by a
+    ConfigWatcher) or when the modification time of the file differs
+    from the one seen at the last load, the unchanged parts of the
+    previous config are reused. *hits* and *reloads* count the cache
+    usage.
+    """
+
+    def __init__(self, loader):
+        self._loader = loader
+        self._lock = threading.Lock()
+        self._entries = {}
+        self.hits = 0
+        self.reloads = 0
+
+    def get(self, fname, config_item):
+        '''Return the ProductConfig for *fname* and *config_item*.
+        '''
+        key = (fname, config_item)
+        try:
+            mtime = os.path.getmtime(fname)
+        except OSError:
+            mtime = None
+
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] == mtime:
+                self.hits += 1
+                return entry[1]
+        previous = entry[1] if entry is not None else None
+
+        raw = self._loader(fname, config_item=config_item)
+        config = ProductConfig(raw, os.path.dirname(fname), previous)
+
+        with self._lock:
+            self._entries[key] = (mtime, config)
+            self.reloads += 1
+        LOGGER.info('Product config read from %s (reloads: %d, hits: %d, '
+                    'changed: %s)', fname, self.reloads, self.hits,
+                    ', '.join(sorted(config_changes(previous, config))) or
+                    'nothing')
+        return config
+
+    def invalidate(self, fname=None, config_item=None):
+        '''Mark the cached entries for *fname* (all entries if None) to
+        be reloaded. The signature matches the ConfigWatcher callback.
+        '''
+        with self._lock:
+            if fname is not None:
+                fname = os.path.abspath(fname)
+            for key, (_, config) in self._entries.items():
+                if fname is None or os.path.abspath(key[0]) == fname:
+                    # no modification time matches
+                    self._entries[key] = (_STALE, config)
+
+    def stats(self):
+        '''Return a dict with the cache counters.
+        '''
+        with self._lock:
+            return {'hits': self.hits, 'reloads': self.reloads}
@@ -0,0 +1,274 @@
+# -*- coding: utf-8 -*-
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+'''Offline replay of postprocessor messages
+
+Recorded messages (one encoded posttroll message per line) or messages
+generated from a directory of images are fed into a PostProcessor
+through an in-process stand-in for the ListenerContainer, either at
+maximum speed or paced by the message times. The result is a report of
+throughput, stage latencies and peak memory.
+
+The messages can also only be planned (DataProcessor.plan, no image is
+read or written) to check configurations and to measure the cost of
+rule matching and parameter resolution alone.
+'''
+
+import Queue
+import glob
+import logging
+import os
+import resource
+import sys
+import threading
+import time
+from datetime import datetime
+
+from posttroll.message import Message
+from trollsift import parse
+
+from dwd_extensions.tools.instrumentation import get_instrumentation
+from dwd_extensions.trollduction.postprocessor import DataProcessor
+from dwd_extensions.trollduction.postprocessor import PostProcessor
+from dwd_extensions.trollduction.scheduler import SchedulingClass
+from dwd_extensions.trollduction.sharding import ShardedPostProcessor
+
+LOGGER = logging.getLogger("postprocessor")
+
+_END = object()
+
+
+def load_messages(fname):
+    '''Read the recorded messages of *fname* (one encoded posttroll
+    message per line)
+    '''
+    messages = []
+    with open(fname) as fid:
+        for line in fid:
+            line = line.strip()
+            if line and not line.startswith('#'):
+                messages.append(Message(rawstr=line))
+    return messages
+
+
+def generate_messages(input_dir, pattern, topic='/replay', area=None):
+    '''Create 'file' messages for the files in *input_dir* matching the
+    trollsift *pattern* (e.g. "{product_name}_{area_name}_
+    {time:%Y%m%d%H%M}.tif"). The parsed values become the message data,
+    the area is taken from "area_name" (or *area*). The message time is
+    the parsed "time", so paced replays follow the timeslots.
+    '''
+    messages = []
+    for fname in glob.glob(os.path.join(input_dir, '*')):
+        try:
+            data = parse(pattern, os.path.basename(fname))
+        except ValueError:
+            continue
+        data['uri'] = os.path.abspath(fname)
+        data['source_uri'] = data['uri']
+        if 'product_name' not in data and 'productname' in data:
+            data['product_name'] = data['productname']
+        data['area'] = {'name': data.pop('area_name', area)}
+        msg = Message(topic, 'file', data)
+        if isinstance(data.get('time'), datetime):
+            msg.time = data['time']
+        messages.append(msg)
+    messages.sort(key=lambda msg: (msg.time, msg.data['uri']))
+    return messages
+
+
+class ReplayListener(object):
+
+    """Stand-in for the ListenerContainer, messages are put into its
+    queue by the replay.
+    """
+
+    def __init__(self, topics=None):
+        self.topics = topics
+        self.queue = Queue.Queue()
+
+    def restart_listener(self, topics):
+        '''Change the topics (nothing to restart)
+        '''
+        self.topics = topics
+
+    def stop(self):
+        '''Stop the listener
+        '''
+        pass
+
+
+class ReplayMixin(object):
+
+    """Replaces the listener of a PostProcessor with a ReplayListener and
+    stops processing at the end of the replayed messages.
+    """
+
+    def create_listener(self, topics):
+        return ReplayListener(topics)
+
+    def schedule(self, msg):
+        if msg is _END:
+            # after all replayed messages
+            self.scheduler.put(msg, [SchedulingClass('end', sys.maxint)])
+            return
+        super(ReplayMixin, self).schedule(msg)
+
+    def process(self, msg):
+        if msg is _END:
+            self._loop = False
+            self.loop.stop()
+            return
+        super(ReplayMixin, self).process(msg)
+
+
+class ReplayPostProcessor(ReplayMixin, PostProcessor):
+
+    """PostProcessor fed by a ReplayListener.
+    """
+
+
+class ReplayShardedPostProcessor(ReplayMixin, ShardedPostProcessor):
+
+    """ShardedPostProcessor fed by a ReplayListener.
+    """
+
+
+def _feed(listener, messages, speed):
+    t_start = time.time()
+    t_first = messages[0].time if messages else None
+    for msg in messages:
+        if speed:
+            delay = (msg.time - t_first).total_seconds() / speed - \
+                (time.time() - t_start)
+            if delay > 0:
+                time.sleep(delay)
+        listener.queue.put(msg)
+    listener.queue.put(_END)
+
+
+def replay(post_processor, messages, speed=0):
+    '''Feed *messages* into *post_processor* (with a ReplayListener) and
+    wait until all outputs are written. With *speed* > 0 the messages
+    are paced by their times (1 = real time, 10 = ten times faster).
+    Returns the report dict.
+    '''
+    instrumentation = get_instrumentation()
+    instrumentation.reset()
+    feeder = threading.Thread(target=_feed,
+                              args=(post_processor.listener, messages,
+                                    speed))
+    feeder.daemon = True
+    t_start = time.time()
+    feeder.start()
+    post_processor.run_single()
+    memory = getattr(post_processor, 'memory', None)
+    if post_processor.data_processor is not None:
+        post_processor.data_processor.writer.join()
+        memory = post_processor.data_processor.memory
+    post_processor.stop()
+    elapsed = time.time() - t_start
+
+    report = {'messages': len(messages),
+              'seconds': elapsed,
+              'messages_per_second': len(messages) / elapsed
+              if elapsed > 0 else None,
+              # kilobytes on Linux
+              'peak_rss_kb': resource.getrusage(
+                  resource.RUSAGE_SELF).ru_maxrss,
+              'peak_rss_children_kb': resource.getrusage(
+                  resource.RUSAGE_CHILDREN).ru_maxrss,
+              'stages': instrumentation.stage_totals(),
+              'queue_wait': post_processor.scheduler.stats(),
+              'memory': memory.stats() if memory is not None else None}
+    if hasattr(post_processor, 'metrics'):
+        report['shards'] = post_processor.metrics()['shards']
+    return report
+
+
+def plan(product_config, messages):
+    '''Plan the processing of *messages* with *product_config*. Returns
+    the list of (message, actions) and the report dict.
+    '''
+    instrumentation = get_instrumentation()
+    instrumentation.reset()
+    data_processor = DataProcessor()
+    plans = []
+    t_start = time.time()
+    try:
+        for msg in messages:
+            plans.append((msg, data_processor.plan(product_config, msg)))
+    finally:
+        data_processor.writer.stop()
+    elapsed = time.time() - t_start
+
+    report = {'messages': len(messages),
+              'seconds': elapsed,
+              'messages_per_second': len(messages) / elapsed
+              if elapsed > 0 else None,
+              'outputs': sum(len(actions) for _, actions in plans),
+              'decodes': sum(1 for _, actions in plans
+                             if any(action['decode'] for action in actions)),
+              'peak_rss_kb': resource.getrusage(
+                  resource.RUSAGE_SELF).ru_maxrss,
+              'peak_rss_children_kb': 0,
+              'stages': instrumentation.stage_totals()}
+    return plans, report
+
+
+def format_action(msg, action):
+    '''Return the planned *action* for *msg* as JSON serializable dict
+    (without the rule and the resolved parameters)
+    '''
+    return {'message': msg.data.get('uri', msg.subject),
+            'out_box': action['out_box'],
+            'dest_filename': action['dest_filename'],
+            'rrd_filename': action['rrd_filename'],
+            'timeslot': action['timeslot'].isoformat(),
+            'decode': action['decode'],
+            'dataset_processor': action['dataset_processor'],
+            'encoded_by': action['encoded_by'],
+            'save_arguments': action['save_arguments']}
+
+
+def format_report(report):
+    '''Return the report as text
+    '''
+    lines = ['messages: %d in %.1f s (%.2f msg/s)' %
+             (report['messages'], report['seconds'],
+              report['messages_per_second'] or 0),
+             'peak rss: %.1f MB (children %.1f MB)' %
+             (report['peak_rss_kb'] / 1024.0,
+              report['peak_rss_children_kb'] / 1024.0)]
+    if report.get('memory'):
+        lines.append('images in flight: peak %.1f MB (budget %.0f MB), '
+                     '%d waits for %.1f s' %
+                     (report['memory']['peak_mbytes'],
+                      report['memory']['budget_mbytes'],
+                      report['memory']['waits'],
+                      report['memory']['wait_seconds']))
+    lines.append('%-20s %8s %10s %10s %10s %10s' %
+                 ('stage', 'count', 'mean', 'p50', 'p90', 'p99'))
+    stages = dict(report['stages'])
+    for shard in sorted(report.get('shards', {})):
+        for stage, summary in \
+                report['shards'][shard].get('stages', {}).iteritems():
+            stages['%s[%d]' % (stage, shard)] = summary
+    for name, summary in report.get('queue_wait', {}).iteritems():
+        stages['queue_wait[%s]' % name] = summary
+    for stage, summary in sorted(stages.iteritems()):
+        lines.append('%-20s %8d %10.3f %10.3f %10.3f %10.3f' %
+                     (stage, summary['count'], summary['mean'],
+                      summary['p50'], summary['p90'], summary['p99']))
+    return '\n'.join(lines)
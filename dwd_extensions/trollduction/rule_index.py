@@ -0,0 +1,207 @@
+# -*- coding: utf-8 -*-
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+'''Compiled index of postprocessor rules
+
+Rules are matched with re.match against the input filename, so every
+filename matching a rule starts with the literal prefix of the rule's
+input_pattern. The index groups the precompiled patterns by these
+prefixes and only tries the rules whose prefix fits the filename.
+'''
+
+import logging
+import re
+import threading
+from collections import OrderedDict
+
+LOGGER = logging.getLogger("postprocessor")
+
+_REGEX_SPECIAL = set('.^$*+?{}[]\\|()')
+_QUANTIFIERS = set('*+?{')
+
+
+def is_true(value):
+    '''Check a boolean config value given as string (true/yes/1)
+    '''
+    if isinstance(value, bool):
+        return value
+    return str(value).lower() in ["true", "yes", "1"]
+
+
+def literal_prefix(pattern):
+    '''Return the literal prefix every string matched by *pattern*
+    (used with re.match) starts with.
+    '''
+    # a top level alternative may start with anything
+    depth = 0
+    escaped = False
+    in_class = False
+    for char in pattern:
+        if escaped:
+            escaped = False
+        elif char == '\\':
+            escaped = True
+        elif in_class:
+            in_class = char != ']'
+        elif char == '[':
+            in_class = True
+        elif char == '(':
+            depth += 1
+        elif char == ')':
+            depth -= 1
+        elif char == '|' and depth == 0:
+            return ''
+
+    prefix = []
+    for char in pattern:
+        if char in _REGEX_SPECIAL:
+            # the last literal is optional if followed by a quantifier
+            if char in _QUANTIFIERS and prefix:
+                prefix.pop()
+            break
+        prefix.append(char)
+    return ''.join(prefix)
+
+
+class RuleIndex(object):
+
+    """Precompiled rule and dataset processor patterns.
+
+    *match* returns the rules to apply for an input filename in config
+    order, with only the first rule of each rule_group. If
+    *signature_pattern* is given, the results are memorized per filename
+    signature (the filename with all matches of this regex replaced),
+    otherwise every filename is matched (each filename would be a memo
+    key of its own). A signature pattern must only cover parts of the
+    filenames (like timestamps) the rule patterns do not distinguish.
+    """
+
+    def __init__(self, rules, dataset_processors=(),
+                 signature_pattern=None, memo_size=1024):
+        self.rules = tuple(rules)
+        self._buckets = {}
+        self._groups = []
+        self._positions = {}
+        for idx, rule in enumerate(self.rules):
+            pattern = rule['input_pattern']
+            prefix = literal_prefix(pattern)
+            self._buckets.setdefault(len(prefix), {}).setdefault(
+                prefix, []).append((idx, re.compile(pattern)))
+            self._groups.append(rule.get('rule_group'))
+            self._positions[id(rule)] = idx
+        self._copy_only = tuple(is_true(rule.get('copySrcFileOnly', 'false'))
+                                for rule in self.rules)
+        self._prefix_lengths = sorted(self._buckets.keys())
+
+        self._ds_procs = tuple((re.compile(ds_proc['msg_subject_pattern']),
+                                ds_proc)
+                               for ds_proc in dataset_processors)
+
+        if signature_pattern:
+            self._signature_re = re.compile(signature_pattern)
+        else:
+            self._signature_re = None
+        self._memo = OrderedDict()
+        self._memo_size = memo_size
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def signature(self, filename):
+        '''Return the memo key for *filename* (None without signature
+        pattern)
+        '''
+        if self._signature_re is None:
+            return None
+        return self._signature_re.sub('\0', filename)
+
+    def match(self, filename):
+        '''Return the list of rules to apply for *filename*
+        '''
+        key = self.signature(filename)
+        if key is None:
+            return [self.rules[idx] for idx in self._match_indices(filename)]
+        with self._lock:
+            indices = self._memo.get(key)
+            if indices is not None:
+                self.hits += 1
+                return [self.rules[idx] for idx in indices]
+
+        indices = self._match_indices(filename)
+
+        with self._lock:
+            self.misses += 1
+            self._memo[key] = indices
+            if len(self._memo) > self._memo_size:
+                self._memo.popitem(last=False)
+        return [self.rules[idx] for idx in indices]
+
+    def _match_indices(self, filename):
+        candidates = []
+        for length in self._prefix_lengths:
+            if length > len(filename):
+                break
+            candidates.extend(
+                self._buckets[length].get(filename[:length], ()))
+        candidates.sort()
+
+        indices = []
+        groups = set()
+        for idx, regex in candidates:
+            if regex.match(filename) is None:
+                continue
+            group = self._groups[idx]
+            if group is not None:
+                if group in groups:
+                    continue
+                groups.add(group)
+            indices.append(idx)
+        return tuple(indices)
+
+    def position(self, rule):
+        '''Return the index of *rule* in the config order, None if it is
+        not a rule of the index. Equal rules of a reloaded config are
+        found too.
+        '''
+        idx = self._positions.get(id(rule))
+        if idx is not None and self.rules[idx] is rule:
+            return idx
+        try:
+            return self.rules.index(rule)
+        except ValueError:
+            return None
+
+    def is_copy_src_file_only(self, rule):
+        '''Check if *rule* only copies the source file
+        '''
+        idx = self.position(rule)
+        if idx is None:
+            return is_true(rule.get('copySrcFileOnly', 'false'))
+        return self._copy_only[idx]
+
+    def match_dataset_processor(self, subject):
+        '''Return the first dataset processor matching the message
+        *subject* or None
+        '''
+        for regex, ds_proc in self._ds_procs:
+            if regex.match(subject):
+                return ds_proc
+        return None
+
+    def stats(self):
+        '''Return a dict with the memo counters.
+        '''
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses,
+                    'rules': len(self.rules)}
@@ -0,0 +1,278 @@
+# -*- coding: utf-8 -*-
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+'''Deadline aware scheduling of incoming messages
+
+Every message gets a due time and the message with the earliest due
+time is processed first:
+
+- scheduling classes with a delivery *deadline* are due *deadline*
+  seconds after the end of the timeslot (time_eos),
+- other classes are due *aging* * (1 + *priority*) seconds after their
+  arrival, so that messages of low priority (high number) are delayed
+  by more urgent ones, but not forever.
+
+Without any scheduling class configured all messages have priority 0
+and are processed in the order of arrival.
+
+Out_boxes and rules define their scheduling class with
+<priority_class>, <priority> (0 = most urgent) and <deadline>, *aging*
+is the post_processing setting scheduler_aging (default 300). The
+deadlines are relative to the timeslot of the rules (their <time_name>,
+by default time_eos, the message time plus timeslot_minutes, default
+15), the earliest one if a message matches several rules.
+
+Classes may allow coalescing (<coalesce>drop</coalesce> or defer with
+<coalesce_queue> and <coalesce_age>): if a message of the same product
+and area but a newer timeslot arrives while the queue is longer than
+*coalesce_queue* or the queued message is older than *coalesce_age*
+seconds, the superseded message is dropped (or deferred until the queue
+is empty). Only messages whose classes all allow coalescing are
+affected, so products of other classes stay complete.
+'''
+
+import Queue
+import calendar
+import heapq
+import itertools
+import logging
+import threading
+import time
+
+from dwd_extensions.tools.instrumentation import Histogram
+
+LOGGER = logging.getLogger("postprocessor")
+
+DEFAULT_CLASS = 'default'
+DEFAULT_PRIORITY = 0
+
+COALESCE_DROP = 'drop'
+COALESCE_DEFER = 'defer'
+
+
+def to_epoch(timeslot):
+    '''Convert the (UTC) datetime *timeslot* to seconds since epoch
+    '''
+    return calendar.timegm(timeslot.utctimetuple())
+
+
+class SchedulingClass(object):
+
+    """Scheduling parameters of a group of messages.
+    """
+
+    def __init__(self, name=DEFAULT_CLASS, priority=DEFAULT_PRIORITY,
+                 deadline=None, coalesce=None, coalesce_queue=None,
+                 coalesce_age=None):
+        if coalesce not in (None, COALESCE_DROP, COALESCE_DEFER):
+            raise ValueError("unknown coalesce policy '%s'" % coalesce)
+        self.name = name
+        self.priority = int(priority)
+        self.deadline = float(deadline) if deadline is not None else None
+        self.coalesce = coalesce
+        self.coalesce_queue = int(coalesce_queue) \
+            if coalesce_queue is not None else None
+        self.coalesce_age = float(coalesce_age) \
+            if coalesce_age is not None else None
+
+    @classmethod
+    def from_config(cls, *configs):
+        '''Create the class from *configs* (e.g. rule and out_box
+        dicts), each setting ("priority_class", "priority", "deadline",
+        "coalesce", "coalesce_queue", "coalesce_age") is taken from the
+        first config defining it.
+        '''
+        def _get(key):
+            for config in configs:
+                if config is not None and key in config:
+                    return config[key]
+            return None
+        priority = _get('priority')
+        return cls(_get('priority_class') or DEFAULT_CLASS,
+                   priority if priority is not None else DEFAULT_PRIORITY,
+                   _get('deadline'), _get('coalesce') or None,
+                   _get('coalesce_queue'), _get('coalesce_age'))
+
+    def due(self, arrival, time_eos, aging):
+        '''Return the due time of a message of this class
+        '''
+        if self.deadline is not None and time_eos is not None:
+            return to_epoch(time_eos) + self.deadline
+        return arrival + aging * (1 + self.priority)
+
+    def overloaded(self, queue_size, age):
+        '''Check if superseded messages of this class may be coalesced
+        '''
+        if self.coalesce is None:
+            return False
+        if self.coalesce_queue is None and self.coalesce_age is None:
+            return True
+        return (self.coalesce_queue is not None and
+                queue_size >= self.coalesce_queue) or \
+            (self.coalesce_age is not None and age >= self.coalesce_age)
+
+    def __repr__(self):
+        return 'SchedulingClass(%r, %d, %r)' % (self.name, self.priority,
+                                                self.deadline)
+
+
+class _Entry(object):
+
+    """A queued item
+    """
+
+    __slots__ = ('item', 'arrival', 'sched_class', 'sched_classes', 'key',
+                 'time_eos', 'name', 'removed')
+
+    def __init__(self, item, arrival, sched_class, sched_classes, key,
+                 time_eos, name):
+        self.item = item
+        self.arrival = arrival
+        self.sched_class = sched_class
+        self.sched_classes = sched_classes
+        self.key = key
+        self.time_eos = time_eos
+        self.name = name
+        self.removed = False
+
+
+class MessageScheduler(object):
+
+    """Priority queue of messages ordered by due time (see module
+    documentation). The wait times are kept per scheduling class.
+    """
+
+    def __init__(self, aging=300.0):
+        self.aging = aging
+        self._cond = threading.Condition()
+        self._heap = []
+        self._size = 0
+        self._by_key = {}
+        self._seq = itertools.count()
+        self._wait_stats = {}
+        self._coalesced = {}
+
+    def put(self, item, sched_classes=None, time_eos=None, now=None,
+            key=None, name=None):
+        '''Queue *item*, the most urgent of *sched_classes* is used.
+        Queued items with the same coalescing *key* (e.g. product and
+        area) and an older *time_eos* are superseded by *item*. *name*
+        is used for logging.
+        '''
+        if now is None:
+            now = time.time()
+        sched_classes = sched_classes or [SchedulingClass()]
+        due, sched_class = min(
+            ((cls.due(now, time_eos, self.aging), cls)
+             for cls in sched_classes),
+            key=lambda entry: (entry[0], entry[1].priority))
+        entry = _Entry(item, now, sched_class, sched_classes, key, time_eos,
+                       name)
+        with self._cond:
+            if key is not None and time_eos is not None:
+                self._coalesce(entry, now)
+                self._by_key.setdefault(key, []).append(entry)
+            self._push(due, entry)
+            self._cond.notify()
+
+    def _push(self, due, entry):
+        # called with self._cond acquired
+        heapq.heappush(self._heap, (due, entry.sched_class.priority,
+                                    next(self._seq), entry))
+        self._size += 1
+
+    def _coalesce(self, entry, now):
+        # called with self._cond acquired
+        for old in list(self._by_key.get(entry.key, [])):
+            if old.removed or old.time_eos >= entry.time_eos or \
+                    not all(cls.overloaded(self._size, now - old.arrival)
+                            for cls in old.sched_classes):
+                continue
+            defer = any(cls.coalesce == COALESCE_DEFER
+                        for cls in old.sched_classes)
+            old.removed = True
+            self._size -= 1
+            self._by_key[entry.key].remove(old)
+            action = COALESCE_DEFER if defer else COALESCE_DROP
+            counter = (old.sched_class.name, action)
+            self._coalesced[counter] = self._coalesced.get(counter, 0) + 1
+            LOGGER.info("%s %s (%s), superseded by timeslot %s",
+                        "Deferring" if defer else "Skipping",
+                        old.name or old.key, old.time_eos, entry.time_eos)
+            if defer:
+                # processed when the queue is empty otherwise (no key:
+                # not superseded again)
+                deferred = _Entry(old.item, old.arrival,
+                                  SchedulingClass(
+                                      old.sched_class.name + ' (deferred)',
+                                      old.sched_class.priority),
+                                  old.sched_classes, None, old.time_eos,
+                                  old.name)
+                self._push(float('inf'), deferred)
+
+    def get(self, block=True, timeout=None):
+        '''Return the most urgent item, raises Queue.Empty like
+        Queue.get.
+        '''
+        with self._cond:
+            if block:
+                t_end = time.time() + timeout if timeout is not None \
+                    else None
+                while not self._size:
+                    remaining = t_end - time.time() if t_end is not None \
+                        else 1
+                    if remaining <= 0:
+                        break
+                    self._cond.wait(remaining)
+            if not self._size:
+                raise Queue.Empty
+            entry = heapq.heappop(self._heap)[-1]
+            while entry.removed:
+                entry = heapq.heappop(self._heap)[-1]
+            self._size -= 1
+            if entry.key is not None:
+                self._by_key[entry.key].remove(entry)
+                if not self._by_key[entry.key]:
+                    del self._by_key[entry.key]
+            name = entry.sched_class.name
+            try:
+                hist = self._wait_stats[name]
+            except KeyError:
+                hist = self._wait_stats[name] = Histogram()
+            hist.add(time.time() - entry.arrival)
+        return entry.item
+
+    def qsize(self):
+        '''Return the number of queued items
+        '''
+        with self._cond:
+            return self._size
+
+    def stats(self):
+        '''Return the queue wait time summaries per scheduling class
+        '''
+        with self._cond:
+            return dict((name, hist.to_dict())
+                        for name, hist in self._wait_stats.iteritems())
+
+    def coalesce_stats(self):
+        '''Return the number of dropped and deferred messages per
+        scheduling class
+        '''
+        with self._cond:
+            res = {}
+            for (name, action), num in self._coalesced.iteritems():
+                res.setdefault(name, {COALESCE_DROP: 0,
+                                      COALESCE_DEFER: 0})[action] = num
+            return res
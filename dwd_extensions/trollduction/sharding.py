@@ -0,0 +1,314 @@
+# -*- coding: utf-8 -*-
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+'''Process sharded PostProcessor
+
+The messages received by the listener are distributed to a number of
+worker processes, each running its own DataProcessor. Messages with the
+same routing key (area name, product name or uri) always go to the same
+worker, so their processing order is preserved. Log records and
+processing metrics of the workers are sent back to the main process.
+
+The decoded images of all workers are accounted in a shared memory
+budget, no messages are routed to the workers while it is exhausted.
+
+The messages are scheduled (MessageScheduler of the PostProcessor)
+before they are routed: at most *max_queued* messages per worker are
+routed and not yet processed, the others wait in the scheduler, where
+urgent messages overtake them and newer timeslots supersede them.
+'''
+
+import Queue
+import logging
+import multiprocessing
+import threading
+import time
+import zlib
+
+import trollduction.helper_functions as helper_functions
+
+from dwd_extensions.tools.instrumentation import get_instrumentation
+from dwd_extensions.tools.rrd_utils import get_rrd_sink
+from dwd_extensions.trollduction.data_writer import MemoryBudget
+from dwd_extensions.trollduction.postprocessor import DataProcessor
+from dwd_extensions.trollduction.postprocessor import PostProcessor
+from dwd_extensions.trollduction.product_config import ProductConfigCache
+
+LOGGER = logging.getLogger("postprocessor")
+
+ROUTE_BY_AREA = 'area'
+ROUTE_BY_PRODUCT = 'product'
+ROUTE_BY_URI = 'uri'
+
+MAX_QUEUED = 2
+
+
+def shard_key(msg, route_by):
+    '''Return the routing key of *msg*
+    '''
+    data = msg.data
+    if route_by == ROUTE_BY_AREA:
+        area = data.get('area')
+        if isinstance(area, dict):
+            return str(area.get('name'))
+        return str(area)
+    elif route_by == ROUTE_BY_PRODUCT:
+        return str(data.get('product_name', data.get('productname')))
+    elif route_by == ROUTE_BY_URI:
+        return str(data.get('uri', msg.subject))
+    raise ValueError("unknown routing key '%s'" % route_by)
+
+
+def shard_index(key, num_shards):
+    '''Map *key* to a shard (stable across processes and restarts)
+    '''
+    return (zlib.crc32(key) & 0xffffffff) % num_shards
+
+
+class _QueueLogHandler(logging.Handler):
+
+    """Sends log records to a multiprocessing queue.
+    """
+
+    def __init__(self, queue):
+        logging.Handler.__init__(self)
+        self.queue = queue
+
+    def emit(self, record):
+        try:
+            # make the record picklable
+            if record.exc_info:
+                self.format(record)
+                record.exc_text = record.exc_text or \
+                    logging.Formatter().formatException(record.exc_info)
+                record.exc_info = None
+            record.msg = record.getMessage()
+            record.args = None
+            self.queue.put(('log', record))
+        except Exception:
+            self.handleError(record)
+
+
+def _shard_worker(shard, msg_queue, out_queue, memory_budget=None,
+                  slots=None):
+    '''Main function of a worker process. The queue items are
+    ('config', (product config file, config item)) and ('message', msg),
+    None stops the worker. A slot of the semaphore *slots* is released
+    for every processed message.
+    '''
+    root = logging.getLogger()
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+    root.addHandler(_QueueLogHandler(out_queue))
+
+    config_cache = ProductConfigCache(helper_functions.read_config_file)
+    data_processor = DataProcessor(memory_budget)
+    config_location = None
+    metrics = {'processed': 0, 'errors': 0, 'busy_seconds': 0.0}
+    try:
+        while True:
+            item = msg_queue.get()
+            if item is None:
+                break
+            kind, value = item
+            if kind == 'config':
+                config_location = value
+                continue
+            t_start = time.time()
+            try:
+                product_config = config_cache.get(*config_location)
+                data_processor.run(product_config, value)
+                metrics['processed'] += 1
+            except BaseException:
+                metrics['errors'] += 1
+                LOGGER.exception("Unexpected error")
+            finally:
+                if slots is not None:
+                    slots.release()
+            metrics['busy_seconds'] += time.time() - t_start
+            metrics['queued'] = msg_queue.qsize()
+            metrics['config_cache'] = config_cache.stats()
+            metrics['rule_index'] = data_processor.rule_index.stats() \
+                if data_processor.rule_index is not None else None
+            metrics['stages'] = get_instrumentation().stage_totals()
+            metrics['writer'] = data_processor.writer.stats()
+            metrics['output_index'] = data_processor.output_index.stats() \
+                if data_processor.output_index is not None else None
+            out_queue.put(('metrics', (shard, dict(metrics))))
+    finally:
+        data_processor.writer.join()
+        data_processor.writer.stop()
+        rrd_sink = get_rrd_sink()
+        if rrd_sink is not None:
+            rrd_sink.stop()
+
+
+class ShardedPostProcessor(PostProcessor):
+
+    """PostProcessor distributing the messages to *num_shards* worker
+    processes, routed by *route_by* (area, product or uri). At most
+    *max_queued* messages per worker are routed and not yet processed.
+    """
+
+    def __init__(self, config, num_shards, route_by=ROUTE_BY_AREA,
+                 managed=True, max_queued=MAX_QUEUED):
+        if route_by not in (ROUTE_BY_AREA, ROUTE_BY_PRODUCT, ROUTE_BY_URI):
+            raise ValueError("unknown routing key '%s'" % route_by)
+        self.num_shards = int(num_shards)
+        self.route_by = route_by
+        self.max_queued = max(1, int(max_queued))
+        self.workers = []
+        self.shard_queues = []
+        self.shard_slots = []
+        self.out_queue = None
+        self._collector = None
+        self._metrics = {}
+        self._metrics_lock = threading.Lock()
+        self._config_location = None
+        self.memory = MemoryBudget(shared=True)
+        PostProcessor.__init__(self, config, managed=managed)
+
+    def create_data_processor(self):
+        """Start the worker processes instead of a local DataProcessor
+        (called before the listener is started, so that no threads are
+        forked).
+        """
+        self.out_queue = multiprocessing.Queue()
+        for shard in range(self.num_shards):
+            msg_queue = multiprocessing.Queue()
+            slots = multiprocessing.Semaphore(self.max_queued)
+            worker = multiprocessing.Process(
+                target=_shard_worker,
+                name='postprocessor-shard-%d' % shard,
+                args=(shard, msg_queue, self.out_queue, self.memory,
+                      slots))
+            worker.daemon = True
+            worker.start()
+            self.shard_queues.append(msg_queue)
+            self.shard_slots.append(slots)
+            self.workers.append(worker)
+        LOGGER.info("Started %d postprocessor shards (routed by %s)",
+                    self.num_shards, self.route_by)
+
+        self._collector = threading.Thread(target=self._collect)
+        self._collector.daemon = True
+        self._collector.start()
+        return None
+
+    def update_td_config(self):
+        """Setup Trollduction with the loaded configuration and send the
+        product config to the workers.
+        """
+        PostProcessor.update_td_config(self)
+        self.send_config()
+
+    def send_config(self):
+        """Send the product config file and config item to the workers
+        if they changed, the workers load it before their next message.
+        """
+        try:
+            location = (self.td_config['product_config_file'],
+                        self.td_config['config_item'])
+        except KeyError:
+            return
+        if location == self._config_location:
+            return
+        self._config_location = location
+        for msg_queue in self.shard_queues:
+            msg_queue.put(('config', location))
+
+    def _collect(self):
+        """Handle log records and metrics sent by the workers.
+        """
+        while True:
+            running = self._loop or any(w.is_alive() for w in self.workers)
+            try:
+                kind, item = self.out_queue.get(True, 1)
+            except Queue.Empty:
+                if running:
+                    continue
+                break
+            except (EOFError, IOError):
+                break
+            if kind == 'log':
+                logging.getLogger(item.name).handle(item)
+            elif kind == 'metrics':
+                shard, metrics = item
+                with self._metrics_lock:
+                    self._metrics[shard] = metrics
+
+    def metrics(self):
+        """Return the metrics per shard and their sum.
+        """
+        with self._metrics_lock:
+            per_shard = dict((shard, dict(metrics))
+                             for shard, metrics in self._metrics.items())
+        total = {'processed': 0, 'errors': 0, 'busy_seconds': 0.0,
+                 'queued': 0}
+        for metrics in per_shard.values():
+            for key in total:
+                total[key] += metrics.get(key, 0)
+        return {'shards': per_shard, 'total': total,
+                'memory': self.memory.stats()}
+
+    def process(self, msg):
+        """Route a single message to its shard, waits until the shard
+        has a free slot.
+        """
+        if msg.type in ["file", "dataset"]:
+            try:
+                # backpressure: the messages stay in the scheduler
+                waited = self.memory.admit()
+                if waited:
+                    get_instrumentation().record('memory_wait', waited)
+                shard = shard_index(shard_key(msg, self.route_by),
+                                    self.num_shards)
+                if not self._acquire_slot(shard):
+                    return
+                LOGGER.debug("Routing %s to shard %d", msg.subject, shard)
+                self.shard_queues[shard].put(('message', msg))
+            except BaseException:
+                LOGGER.exception("Unexpected error")
+
+    def _acquire_slot(self, shard):
+        '''Wait for a free slot of *shard*, returns False if stopped
+        meanwhile.
+        '''
+        slots = self.shard_slots[shard]
+        t_start = time.time()
+        while not slots.acquire(True, 1):
+            if not self._loop:
+                return False
+        waited = time.time() - t_start
+        if waited > 0.01:
+            get_instrumentation().record('shard_wait', waited)
+        return True
+
+    def cleanup(self):
+        '''Stop the workers (after they processed the queued messages)
+        and cleanup.
+        '''
+        for msg_queue in self.shard_queues:
+            msg_queue.put(None)
+        for worker in self.workers:
+            worker.join(60)
+            if worker.is_alive():
+                LOGGER.warning("Terminating %s", worker.name)
+                worker.terminate()
+        PostProcessor.cleanup(self)
+        if self._collector is not None:
+            self._collector.join(5)
+            self._collector = None
+        LOGGER.info("Shard metrics: %s", self.metrics()['total'])
+        LOGGER.info("Memory budget: %s", self.memory.stats())
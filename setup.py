@@ -26,6 +26,8 @@ setup(name="dwd_extensions",
                 ],
       scripts=['bin/configure.py',
                'bin/postprocessor.py',
+               'bin/replay_postprocessor.py',
+               'bin/benchmark_tiled_output.py',
                'bin/supervisor_event_launcher.py',
                'bin/check_products_rrd.py',
                'bin/import_uns_xml_file.py',